@@ -11,6 +11,9 @@ locals {
     Product     = var.product_name
     Environment = var.environment
   }
+
+  # Claim-check objects must outlive the messages pointing at them, including in the DLQ (14 days)
+  claim_check_expiration_days = ceil(max(var.sqs_message_retention_seconds, var.sqs_create_dlq ? 1209600 : 0) / 86400) + 1
 }
 
 module "vpc" {
@@ -69,6 +72,8 @@ module "sqs" {
   create_dlq                 = var.sqs_create_dlq
   visibility_timeout_seconds = var.sqs_visibility_timeout_seconds
   message_retention_seconds  = var.sqs_message_retention_seconds
+  fifo_queue                 = var.sqs_fifo_queue
+  high_throughput_fifo       = var.sqs_high_throughput_fifo
   tags                       = local.tags
 }
 
@@ -79,5 +84,15 @@ module "s3" {
   enable_versioning  = var.s3_enable_versioning
   force_destroy      = var.s3_force_destroy
   enable_public_access_block = false  # Disabled due to SCP restrictions
+  lifecycle_rules = [
+    {
+      # Oversized email bodies the microservice offloads to S3 (CLAIM_CHECK_PREFIX)
+      id                                 = "expire-claim-checks"
+      enabled                            = true
+      prefix                             = var.s3_claim_check_prefix
+      expiration_days                    = local.claim_check_expiration_days
+      noncurrent_version_expiration_days = 1
+    }
+  ]
   tags               = local.tags
 }
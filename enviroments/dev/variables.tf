@@ -188,6 +188,18 @@ variable "sqs_message_retention_seconds" {
   default     = 345600
 }
 
+variable "sqs_fifo_queue" {
+  description = "Whether the SQS queue is FIFO (emails ordered per sender)"
+  type        = bool
+  default     = false
+}
+
+variable "sqs_high_throughput_fifo" {
+  description = "Whether a FIFO queue uses per-message-group throughput limits"
+  type        = bool
+  default     = true
+}
+
 # S3 Variables
 variable "s3_bucket_name" {
   description = "The name of the S3 bucket"
@@ -207,3 +219,9 @@ variable "s3_force_destroy" {
   default     = false
 }
 
+variable "s3_claim_check_prefix" {
+  description = "Key prefix of the microservice's claim-check objects (CLAIM_CHECK_PREFIX), expired by a lifecycle rule"
+  type        = string
+  default     = "claim-checks/"
+}
+
@@ -0,0 +1,586 @@
+#!/usr/bin/env python3
+"""
+Local SQS, S3 and SSM stand-in for load tests
+
+A threaded HTTP server answering the subset of each API used by the email
+microservice and the SQS processor, with configurable injected latency. boto3 clients
+reach it through AWS_ENDPOINT_URL (see aws_clients.py in either service).
+
+    SQS  Query (boto3 1.34) and JSON protocols: SendMessage(Batch), ReceiveMessage
+         (long polling, visibility timeouts), DeleteMessage(Batch),
+         ChangeMessageVisibility(Batch), GetQueueAttributes, GetQueueUrl
+    S3   Path-style PutObject, GetObject, HeadBucket, HeadObject and multipart uploads
+    SSM  GetParameter
+
+Every call is counted per operation. GET /_stats returns the counters and queue depth,
+POST /_reset clears the counters (queued messages and objects are kept) and
+POST /_parameters adds SSM parameters from a JSON object.
+
+Usage: python fake_aws.py [--port 4566] [--latency-ms 5] [--jitter-ms 0]
+"""
+import re
+import json
+import time
+import uuid
+import random
+import hashlib
+import argparse
+import threading
+from collections import OrderedDict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from xml.sax.saxutils import escape
+
+SQS_XMLNS = 'http://queue.amazonaws.com/doc/2012-11-05/'
+S3_XMLNS = 'http://s3.amazonaws.com/doc/2006-03-01/'
+
+
+class ServiceError(Exception):
+    """
+    An AWS error response
+    """
+
+    def __init__(self, status, code, message=''):
+        super().__init__(message)
+        self.status = status
+        self.code = code
+        self.message = message
+
+
+class FakeQueue:
+    """
+    One SQS standard queue: visible messages in arrival order and in-flight
+    messages keyed by receipt handle with their visibility deadline
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._visible = OrderedDict()
+        self._in_flight = {}
+        self._condition = threading.Condition()
+
+    def send(self, body, attributes):
+        message = {
+            'MessageId': str(uuid.uuid4()),
+            'Body': body,
+            'MD5OfBody': hashlib.md5(body.encode('utf-8')).hexdigest(),
+            'MessageAttributes': attributes,
+            'SentTimestamp': str(int(time.time() * 1000)),
+            'ReceiveCount': 0
+        }
+        with self._condition:
+            self._visible[message['MessageId']] = message
+            self._condition.notify()
+        return message
+
+    def _requeue_expired(self, now):
+        expired = [handle for handle, (deadline, _) in self._in_flight.items() if deadline <= now]
+        for handle in expired:
+            _, message = self._in_flight.pop(handle)
+            self._visible[message['MessageId']] = message
+
+    def receive(self, max_messages, wait_seconds, visibility_timeout):
+        deadline = time.monotonic() + wait_seconds
+        with self._condition:
+            while True:
+                self._requeue_expired(time.monotonic())
+                if self._visible:
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return []
+                # Wake up periodically so expired in-flight messages reappear
+                self._condition.wait(min(remaining, 0.5))
+            received = []
+            while self._visible and len(received) < max_messages:
+                _, message = self._visible.popitem(last=False)
+                message['ReceiveCount'] += 1
+                handle = f"{message['MessageId']}#{uuid.uuid4().hex}"
+                self._in_flight[handle] = (time.monotonic() + visibility_timeout, message)
+                received.append((handle, message))
+            return received
+
+    def delete(self, handle):
+        with self._condition:
+            if self._in_flight.pop(handle, None) is None:
+                raise ServiceError(400, 'ReceiptHandleIsInvalid', f"Unknown receipt handle {handle}")
+
+    def change_visibility(self, handle, timeout):
+        with self._condition:
+            entry = self._in_flight.get(handle)
+            if entry is None:
+                raise ServiceError(400, 'ReceiptHandleIsInvalid', f"Unknown receipt handle {handle}")
+            self._in_flight[handle] = (time.monotonic() + timeout, entry[1])
+            if timeout == 0:
+                self._requeue_expired(time.monotonic())
+                self._condition.notify_all()
+
+    def counts(self):
+        with self._condition:
+            self._requeue_expired(time.monotonic())
+            return len(self._visible), len(self._in_flight)
+
+
+class FakeAWS:
+    """
+    State shared by all request handlers
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, parameters=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.parameters = dict(parameters or {})
+        self.queues = {}
+        self.objects = {}
+        self.uploads = {}
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.calls = {}
+            self.sent = 0
+            self.deleted = 0
+            self.bytes_sent = 0
+            self.first_receive_at = None
+            self.last_delete_at = None
+
+    def queue(self, url_or_name):
+        name = url_or_name.rstrip('/').rsplit('/', 1)[-1]
+        with self._lock:
+            if name not in self.queues:
+                self.queues[name] = FakeQueue(name)
+            return self.queues[name]
+
+    def record(self, operation, sent=0, deleted=0, received=0, bytes_sent=0):
+        now = time.time()
+        with self._lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+            self.sent += sent
+            self.bytes_sent += bytes_sent
+            self.deleted += deleted
+            if received and self.first_receive_at is None:
+                self.first_receive_at = now
+            if deleted:
+                self.last_delete_at = now
+
+    def delay(self):
+        if self.latency or self.jitter:
+            time.sleep(max(self.latency + random.uniform(-self.jitter, self.jitter), 0))
+
+    def stats(self):
+        queues = {}
+        for name, queue in list(self.queues.items()):
+            visible, in_flight = queue.counts()
+            queues[name] = {'visible': visible, 'in_flight': in_flight}
+        with self._lock:
+            return {
+                'calls': dict(self.calls),
+                'sent': self.sent,
+                'deleted': self.deleted,
+                'bytes_sent': self.bytes_sent,
+                'first_receive_at': self.first_receive_at,
+                'last_delete_at': self.last_delete_at,
+                'queues': queues,
+                'objects': len(self.objects)
+            }
+
+
+def query_entries(params, prefix):
+    """
+    Group flattened Query parameters (Prefix.1.Field=...) into a list of dicts
+    """
+    entries = {}
+    pattern = re.compile(rf'^{re.escape(prefix)}\.(\d+)\.(.+)$')
+    for name, value in params.items():
+        match = pattern.match(name)
+        if match:
+            entries.setdefault(int(match.group(1)), {})[match.group(2)] = value
+    return [entries[index] for index in sorted(entries)]
+
+
+def query_message_attributes(flat):
+    """
+    MessageAttribute.N.Name / .Value.StringValue / .Value.DataType -> attribute dict
+    """
+    attributes = {}
+    for entry in query_entries(flat, 'MessageAttribute'):
+        attributes[entry['Name']] = {
+            'DataType': entry.get('Value.DataType', 'String'),
+            'StringValue': entry.get('Value.StringValue', '')
+        }
+    return attributes
+
+
+class SQSService:
+    """
+    SQS operations on normalized (JSON-shaped) requests and responses
+    """
+
+    OPERATIONS = (
+        'SendMessage', 'SendMessageBatch', 'ReceiveMessage', 'DeleteMessage', 'DeleteMessageBatch',
+        'ChangeMessageVisibility', 'ChangeMessageVisibilityBatch', 'GetQueueAttributes', 'GetQueueUrl'
+    )
+
+    def __init__(self, aws):
+        self.aws = aws
+
+    def operation(self, action):
+        if action not in self.OPERATIONS:
+            raise ServiceError(400, 'InvalidAction', f"Unsupported SQS action {action}")
+        return getattr(self, action)
+
+    def SendMessage(self, request):
+        message = self.aws.queue(request['QueueUrl']).send(
+            request['MessageBody'], request.get('MessageAttributes', {})
+        )
+        self.aws.record('sqs.SendMessage', sent=1, bytes_sent=len(request['MessageBody']))
+        return {'MessageId': message['MessageId'], 'MD5OfMessageBody': message['MD5OfBody']}
+
+    def SendMessageBatch(self, request):
+        queue = self.aws.queue(request['QueueUrl'])
+        successful = []
+        size = 0
+        for entry in request['Entries']:
+            message = queue.send(entry['MessageBody'], entry.get('MessageAttributes', {}))
+            size += len(entry['MessageBody'])
+            successful.append({
+                'Id': entry['Id'],
+                'MessageId': message['MessageId'],
+                'MD5OfMessageBody': message['MD5OfBody']
+            })
+        self.aws.record('sqs.SendMessageBatch', sent=len(successful), bytes_sent=size)
+        return {'Successful': successful, 'Failed': []}
+
+    def ReceiveMessage(self, request):
+        received = self.aws.queue(request['QueueUrl']).receive(
+            int(request.get('MaxNumberOfMessages', 1)),
+            int(request.get('WaitTimeSeconds', 0)),
+            int(request.get('VisibilityTimeout', 30))
+        )
+        self.aws.record('sqs.ReceiveMessage', received=len(received))
+        return {'Messages': [
+            {
+                'MessageId': message['MessageId'],
+                'ReceiptHandle': handle,
+                'MD5OfBody': message['MD5OfBody'],
+                'Body': message['Body'],
+                'Attributes': {
+                    'SentTimestamp': message['SentTimestamp'],
+                    'ApproximateReceiveCount': str(message['ReceiveCount'])
+                },
+                'MessageAttributes': message['MessageAttributes']
+            }
+            for handle, message in received
+        ]}
+
+    def DeleteMessage(self, request):
+        self.aws.queue(request['QueueUrl']).delete(request['ReceiptHandle'])
+        self.aws.record('sqs.DeleteMessage', deleted=1)
+        return {}
+
+    def DeleteMessageBatch(self, request):
+        queue = self.aws.queue(request['QueueUrl'])
+        successful, failed = [], []
+        for entry in request['Entries']:
+            try:
+                queue.delete(entry['ReceiptHandle'])
+                successful.append({'Id': entry['Id']})
+            except ServiceError as e:
+                failed.append({'Id': entry['Id'], 'SenderFault': True, 'Code': e.code, 'Message': e.message})
+        self.aws.record('sqs.DeleteMessageBatch', deleted=len(successful))
+        return {'Successful': successful, 'Failed': failed}
+
+    def ChangeMessageVisibility(self, request):
+        self.aws.queue(request['QueueUrl']).change_visibility(
+            request['ReceiptHandle'], int(request['VisibilityTimeout'])
+        )
+        self.aws.record('sqs.ChangeMessageVisibility')
+        return {}
+
+    def ChangeMessageVisibilityBatch(self, request):
+        queue = self.aws.queue(request['QueueUrl'])
+        successful, failed = [], []
+        for entry in request['Entries']:
+            try:
+                queue.change_visibility(entry['ReceiptHandle'], int(entry['VisibilityTimeout']))
+                successful.append({'Id': entry['Id']})
+            except ServiceError as e:
+                failed.append({'Id': entry['Id'], 'SenderFault': True, 'Code': e.code, 'Message': e.message})
+        self.aws.record('sqs.ChangeMessageVisibilityBatch')
+        return {'Successful': successful, 'Failed': failed}
+
+    def GetQueueAttributes(self, request):
+        visible, in_flight = self.aws.queue(request['QueueUrl']).counts()
+        self.aws.record('sqs.GetQueueAttributes')
+        return {'Attributes': {
+            'ApproximateNumberOfMessages': str(visible),
+            'ApproximateNumberOfMessagesNotVisible': str(in_flight),
+            'ApproximateNumberOfMessagesDelayed': '0'
+        }}
+
+    def GetQueueUrl(self, request):
+        self.aws.record('sqs.GetQueueUrl')
+        return {'QueueUrl': f"http://localhost/000000000000/{request['QueueName']}"}
+
+    def handle_json(self, action, request):
+        return self.operation(action)(request)
+
+    def handle_query(self, action, params):
+        """
+        Translate a Query protocol request to the JSON shape, and the result to XML
+        """
+        request = {name: value for name, value in params.items() if '.' not in name}
+        if action == 'SendMessage':
+            request['MessageAttributes'] = query_message_attributes(params)
+        elif action == 'SendMessageBatch':
+            request['Entries'] = []
+            for entry in query_entries(params, 'SendMessageBatchRequestEntry'):
+                entry['MessageAttributes'] = query_message_attributes(entry)
+                request['Entries'].append(entry)
+        elif action in ('DeleteMessageBatch', 'ChangeMessageVisibilityBatch'):
+            request['Entries'] = query_entries(params, f'{action}RequestEntry')
+        result = self.operation(action)(request)
+        return f'<{action}Response xmlns="{SQS_XMLNS}"><{action}Result>{self._result_xml(action, result)}' \
+               f'</{action}Result><ResponseMetadata><RequestId>{uuid.uuid4()}</RequestId>' \
+               f'</ResponseMetadata></{action}Response>'
+
+    @staticmethod
+    def _result_xml(action, result):
+        if action == 'ReceiveMessage':
+            parts = []
+            for message in result['Messages']:
+                attributes = ''.join(
+                    f'<Attribute><Name>{name}</Name><Value>{value}</Value></Attribute>'
+                    for name, value in message['Attributes'].items()
+                )
+                message_attributes = ''.join(
+                    f"<MessageAttribute><Name>{escape(name)}</Name><Value>"
+                    f"<StringValue>{escape(value.get('StringValue', ''))}</StringValue>"
+                    f"<DataType>{value['DataType']}</DataType></Value></MessageAttribute>"
+                    for name, value in message['MessageAttributes'].items()
+                )
+                parts.append(
+                    f"<Message><MessageId>{message['MessageId']}</MessageId>"
+                    f"<ReceiptHandle>{escape(message['ReceiptHandle'])}</ReceiptHandle>"
+                    f"<MD5OfBody>{message['MD5OfBody']}</MD5OfBody>"
+                    f"<Body>{escape(message['Body'])}</Body>{attributes}{message_attributes}</Message>"
+                )
+            return ''.join(parts)
+        if action == 'GetQueueAttributes':
+            return ''.join(
+                f'<Attribute><Name>{name}</Name><Value>{value}</Value></Attribute>'
+                for name, value in result['Attributes'].items()
+            )
+        if action in ('SendMessageBatch', 'DeleteMessageBatch', 'ChangeMessageVisibilityBatch'):
+            parts = []
+            for entry in result['Successful']:
+                fields = ''.join(f'<{name}>{escape(str(value))}</{name}>' for name, value in entry.items())
+                parts.append(f'<{action}ResultEntry>{fields}</{action}ResultEntry>')
+            for entry in result['Failed']:
+                fields = ''.join(
+                    f'<{name}>{escape(str(value).lower() if isinstance(value, bool) else str(value))}</{name}>'
+                    for name, value in entry.items()
+                )
+                parts.append(f'<BatchResultErrorEntry>{fields}</BatchResultErrorEntry>')
+            return ''.join(parts)
+        return ''.join(f'<{name}>{escape(str(value))}</{name}>' for name, value in result.items())
+
+
+class FakeAWSHandler(BaseHTTPRequestHandler):
+    """
+    Routes requests to SQS, SSM or S3 by their shape
+    """
+
+    protocol_version = 'HTTP/1.1'
+    aws = None
+    sqs = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def _send(self, status, body=b'', content_type='text/xml', headers=None):
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('x-amzn-RequestId', str(uuid.uuid4()))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _send_json(self, status, payload, content_type='application/x-amz-json-1.0'):
+        self._send(status, json.dumps(payload), content_type)
+
+    def _send_error(self, error, protocol):
+        if protocol == 'json':
+            self._send_json(error.status, {'__type': error.code, 'message': error.message})
+        elif protocol == 'query':
+            self._send(error.status, f'<ErrorResponse xmlns="{SQS_XMLNS}"><Error><Type>Sender</Type>'
+                                     f'<Code>{error.code}</Code><Message>{escape(error.message)}</Message>'
+                                     f'</Error><RequestId>{uuid.uuid4()}</RequestId></ErrorResponse>')
+        else:
+            self._send(error.status, f'<Error><Code>{error.code}</Code><Message>{escape(error.message)}'
+                                     f'</Message></Error>')
+
+    def _dispatch(self):
+        url = urlparse(self.path)
+        if url.path.startswith('/_'):
+            return self._control(url.path)
+
+        target = self.headers.get('X-Amz-Target', '')
+        content_type = self.headers.get('Content-Type', '')
+        if self.command == 'POST' and target:
+            return self._json_service(target)
+        if self.command == 'POST' and content_type.startswith('application/x-www-form-urlencoded'):
+            return self._query_service()
+        return self._s3(url)
+
+    def _control(self, path):
+        body = self._body()
+        if path == '/_stats':
+            return self._send_json(200, self.aws.stats(), 'application/json')
+        if path == '/_reset' and self.command == 'POST':
+            self.aws.reset()
+            return self._send_json(200, {'reset': True}, 'application/json')
+        if path == '/_parameters' and self.command == 'POST':
+            self.aws.parameters.update(json.loads(body))
+            return self._send_json(200, {'parameters': len(self.aws.parameters)}, 'application/json')
+        return self._send_json(404, {'message': 'Not found'}, 'application/json')
+
+    def _json_service(self, target):
+        request = json.loads(self._body() or b'{}')
+        prefix, _, action = target.partition('.')
+        self.aws.delay()
+        try:
+            if prefix == 'AmazonSQS':
+                return self._send_json(200, self.sqs.handle_json(action, request))
+            if prefix == 'AmazonSSM' and action == 'GetParameter':
+                self.aws.record('ssm.GetParameter')
+                name = request['Name']
+                if name not in self.aws.parameters:
+                    raise ServiceError(400, 'ParameterNotFound', name)
+                return self._send_json(200, {'Parameter': {
+                    'Name': name, 'Type': 'SecureString', 'Value': self.aws.parameters[name], 'Version': 1
+                }}, 'application/x-amz-json-1.1')
+            raise ServiceError(400, 'InvalidAction', target)
+        except ServiceError as e:
+            self._send_error(e, 'json')
+
+    def _query_service(self):
+        params = {name: values[0] for name, values in parse_qs(self._body().decode('utf-8'), keep_blank_values=True).items()}
+        action = params.pop('Action', '')
+        params.pop('Version', None)
+        self.aws.delay()
+        try:
+            self._send(200, self.sqs.handle_query(action, params))
+        except ServiceError as e:
+            self._send_error(e, 'query')
+
+    def _s3(self, url):
+        body = self._body()
+        query = parse_qs(url.query, keep_blank_values=True)
+        bucket, _, key = url.path.lstrip('/').partition('/')
+        self.aws.delay()
+        objects = self.aws.objects
+        try:
+            if not key:
+                self.aws.record(f's3.{self.command.title()}Bucket')
+                return self._send(200)
+            if self.command == 'PUT' and 'uploadId' in query:
+                upload = self.aws.uploads.get(query['uploadId'][0])
+                if upload is None:
+                    raise ServiceError(404, 'NoSuchUpload', query['uploadId'][0])
+                upload[int(query['partNumber'][0])] = body
+                self.aws.record('s3.UploadPart')
+                return self._send(200, headers={'ETag': f'"{hashlib.md5(body).hexdigest()}"'})
+            if self.command == 'PUT':
+                objects[(bucket, key)] = body
+                self.aws.record('s3.PutObject')
+                return self._send(200, headers={'ETag': f'"{hashlib.md5(body).hexdigest()}"'})
+            if self.command == 'POST' and 'uploads' in query:
+                upload_id = uuid.uuid4().hex
+                self.aws.uploads[upload_id] = {}
+                self.aws.record('s3.CreateMultipartUpload')
+                return self._send(200, f'<InitiateMultipartUploadResult xmlns="{S3_XMLNS}"><Bucket>{bucket}</Bucket>'
+                                       f'<Key>{escape(key)}</Key><UploadId>{upload_id}</UploadId>'
+                                       f'</InitiateMultipartUploadResult>')
+            if self.command == 'POST' and 'uploadId' in query:
+                parts = self.aws.uploads.pop(query['uploadId'][0], None)
+                if parts is None:
+                    raise ServiceError(404, 'NoSuchUpload', query['uploadId'][0])
+                numbers = [int(number) for number in re.findall(rb'<PartNumber>(\d+)</PartNumber>', body)]
+                objects[(bucket, key)] = b''.join(parts[number] for number in numbers)
+                self.aws.record('s3.CompleteMultipartUpload')
+                return self._send(200, f'<CompleteMultipartUploadResult xmlns="{S3_XMLNS}"><Bucket>{bucket}</Bucket>'
+                                       f'<Key>{escape(key)}</Key><ETag>"{uuid.uuid4().hex}"</ETag>'
+                                       f'</CompleteMultipartUploadResult>')
+            if self.command == 'DELETE' and 'uploadId' in query:
+                self.aws.uploads.pop(query['uploadId'][0], None)
+                self.aws.record('s3.AbortMultipartUpload')
+                return self._send(204)
+            if self.command in ('GET', 'HEAD'):
+                self.aws.record(f's3.{self.command.title()}Object')
+                if (bucket, key) not in objects:
+                    raise ServiceError(404, 'NoSuchKey', key)
+                return self._send(200, objects[(bucket, key)], 'application/octet-stream')
+            raise ServiceError(405, 'MethodNotAllowed', self.command)
+        except ServiceError as e:
+            self._send_error(e, 's3')
+
+    def do_GET(self):
+        self._dispatch()
+
+    def do_HEAD(self):
+        self._dispatch()
+
+    def do_PUT(self):
+        self._dispatch()
+
+    def do_POST(self):
+        self._dispatch()
+
+    def do_DELETE(self):
+        self._dispatch()
+
+
+def start_fake_aws(port=4566, latency=0.0, jitter=0.0, parameters=None):
+    """
+    Start the stand-in on a background thread
+    Returns tuple: (server, FakeAWS state)
+    """
+    aws = FakeAWS(latency=latency, jitter=jitter, parameters=parameters)
+    handler = type('Handler', (FakeAWSHandler,), {'aws': aws, 'sqs': SQSService(aws)})
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='fake-aws', daemon=True).start()
+    return server, aws
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=4566)
+    parser.add_argument('--latency-ms', type=float, default=5)
+    parser.add_argument('--jitter-ms', type=float, default=0)
+    parser.add_argument('--parameter', action='append', default=[], metavar='NAME=VALUE',
+                        help='SSM parameter to serve (repeatable)')
+    args = parser.parse_args()
+
+    parameters = dict(parameter.split('=', 1) for parameter in args.parameter)
+    server, _ = start_fake_aws(args.port, args.latency_ms / 1000.0, args.jitter_ms / 1000.0, parameters)
+    print(f"Fake AWS listening on http://127.0.0.1:{args.port}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
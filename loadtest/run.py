@@ -0,0 +1,428 @@
+#!/usr/bin/env python3
+"""
+End-to-end load test: email microservice -> SQS -> sqs-processor -> S3
+
+Starts a local SQS/S3/SSM stand-in (fake_aws.py) with injected latency, the Flask
+app under gunicorn and the SQS processor, each in its own process and all pointed
+at the stand-in through AWS_ENDPOINT_URL. For each payload size it drives /process at a fixed request rate
+(or as fast as --connections allow with --rate 0), waits until the processor has
+drained the queue, and reports:
+
+    requests/sec and p50/p90/p99 latency (measured from each request's scheduled
+    send time, so a slow server cannot hide queueing delay), messages drained/sec,
+    and AWS calls per accepted message by operation
+
+Results are written to --results-dir as JSON; --compare checks them against an
+earlier result file and exits with status 1 if any figure regressed by more than
+--tolerance.
+
+Usage: python loadtest/run.py [--rate 200] [--duration 20] [--sizes 1024,65536]
+                              [--latency-ms 10] [--server-mode wsgi] [--workers 2]
+                              [--label baseline] [--compare loadtest/results/<file>.json]
+"""
+import os
+import sys
+import json
+import time
+import random
+import signal
+import argparse
+import tempfile
+import itertools
+import threading
+import subprocess
+import http.client
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MICROSERVICE_DIR = os.path.join(ROOT, 'microservice')
+PROCESSOR_DIR = os.path.join(ROOT, 'sqs-processor', 'app')
+
+TOKEN = 'loadtest-token'
+TOKEN_PARAMETER = '/email-service/api-token'
+QUEUE_NAME = 'loadtest-queue'
+BUCKET = 'loadtest-bucket'
+# /process answers 200 once published, or 202 once spooled (SQS_PUBLISH_MODE=spool)
+ACCEPTED = (200, 202)
+
+# Words used to build email content that compresses like real text
+WORDS = ('happy', 'new', 'year', 'meeting', 'invoice', 'attached', 'please', 'review', 'the',
+         'report', 'thanks', 'regards', 'schedule', 'tomorrow', 'update', 'project', 'team')
+
+# Figures compared by --compare: name -> True if higher is better
+COMPARED = {
+    'requests_per_second': True,
+    'latency_ms.p50': False,
+    'latency_ms.p99': False,
+    'messages_drained_per_second': True,
+    'aws_calls_per_message.total': False
+}
+
+
+def make_payload(content_bytes, seed=0):
+    rng = random.Random(seed)
+    words = []
+    size = 0
+    while size < content_bytes:
+        word = rng.choice(WORDS)
+        words.append(word)
+        size += len(word) + 1
+    return json.dumps({
+        'token': TOKEN,
+        'data': {
+            'email_subject': 'Load test',
+            'email_sender': 'Load Test <loadtest@example.com>',
+            'email_timestream': str(int(time.time())),
+            'email_content': ' '.join(words)[:content_bytes]
+        }
+    }).encode('utf-8')
+
+
+def percentile(sorted_values, fraction):
+    """
+    Nearest-rank percentile of an already sorted list
+    """
+    if not sorted_values:
+        return 0.0
+    index = min(max(int(round(fraction * len(sorted_values) + 0.5)) - 1, 0), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+def start_process(command, cwd, env, log_path):
+    log = open(log_path, 'ab')
+    return subprocess.Popen(command, cwd=cwd, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+
+def stop_process(process, timeout=60):
+    if process is None or process.poll() is not None:
+        return
+    process.send_signal(signal.SIGTERM)
+    try:
+        process.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+class FakeAWSClient:
+    """
+    Reads and resets the counters of a fake_aws.py process
+    """
+
+    def __init__(self, port):
+        self.port = port
+
+    def _call(self, method, path):
+        connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=10)
+        connection.request(method, path)
+        return json.loads(connection.getresponse().read())
+
+    def stats(self):
+        return self._call('GET', '/_stats')
+
+    def reset(self):
+        self._call('POST', '/_reset')
+
+
+def wait_for(url_host, port, path, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            connection = http.client.HTTPConnection(url_host, port, timeout=2)
+            connection.request('GET', path)
+            if connection.getresponse().status == 200:
+                return True
+        except (OSError, http.client.HTTPException):
+            pass
+        time.sleep(0.5)
+    return False
+
+
+def run_load(port, body, rate, duration, connections):
+    """
+    Send POST /process requests for `duration` seconds
+    With a rate, request i is scheduled at start + i / rate (open loop); with rate 0
+    each connection sends its next request as soon as the previous one completes.
+    Returns tuple: (list of (status, latency_seconds), elapsed_seconds)
+    """
+    results = []
+    counter = itertools.count()
+    total = int(rate * duration) if rate else None
+    start = time.perf_counter() + 0.2
+    headers = {'Content-Type': 'application/json'}
+
+    def worker():
+        connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+        while True:
+            index = next(counter)
+            if total is not None:
+                if index >= total:
+                    break
+                scheduled = start + index / rate
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            else:
+                scheduled = time.perf_counter()
+                if scheduled < start:
+                    time.sleep(start - scheduled)
+                    scheduled = start
+                if scheduled - start >= duration:
+                    break
+            try:
+                connection.request('POST', '/process', body, headers)
+                response = connection.getresponse()
+                response.read()
+                status = response.status
+            except (OSError, http.client.HTTPException):
+                status = 'connection_error'
+                connection.close()
+                connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+            results.append((status, time.perf_counter() - scheduled))
+        connection.close()
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(connections)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, time.perf_counter() - start
+
+
+def wait_for_drain(aws, expected, timeout):
+    """
+    Wait until every accepted message has been deleted from the queue
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        stats = aws.stats()
+        queue = stats['queues'].get(QUEUE_NAME, {'visible': 0, 'in_flight': 0})
+        if stats['deleted'] >= expected and queue['visible'] == 0 and queue['in_flight'] == 0:
+            return stats, True
+        time.sleep(0.2)
+    return aws.stats(), False
+
+
+def summarize(content_bytes, body, results, elapsed, stats, drained, load_end):
+    latencies = sorted(latency for status, latency in results if status in ACCEPTED)
+    accepted = len(latencies)
+    errors = {}
+    for status, _ in results:
+        if status not in ACCEPTED:
+            errors[str(status)] = errors.get(str(status), 0) + 1
+
+    drain_window = None
+    if stats['first_receive_at'] and stats['last_delete_at']:
+        drain_window = stats['last_delete_at'] - stats['first_receive_at']
+    calls = stats['calls']
+    per_message = {
+        operation: round(count / accepted, 3) for operation, count in sorted(calls.items())
+    } if accepted else {}
+    per_message['total'] = round(sum(calls.values()) / accepted, 3) if accepted else 0.0
+
+    return {
+        'content_bytes': content_bytes,
+        'request_bytes': len(body),
+        'requests': len(results),
+        'accepted': accepted,
+        'errors': errors,
+        'duration_seconds': round(elapsed, 3),
+        'requests_per_second': round(accepted / elapsed, 1) if elapsed else 0.0,
+        'latency_ms': {
+            name: round(percentile(latencies, fraction) * 1000, 2)
+            for name, fraction in (('p50', 0.50), ('p90', 0.90), ('p99', 0.99), ('max', 1.0))
+        },
+        'messages_sent': stats['sent'],
+        'messages_deleted': stats['deleted'],
+        'drained': drained,
+        'drain_lag_seconds': round(stats['last_delete_at'] - load_end, 3) if stats['last_delete_at'] else None,
+        'messages_drained_per_second': round(stats['deleted'] / drain_window, 1) if drain_window else 0.0,
+        'aws_calls': calls,
+        'aws_calls_per_message': per_message
+    }
+
+
+def print_result(result):
+    latency = result['latency_ms']
+    print(f"{result['content_bytes']:>8} B  {result['requests_per_second']:>8.1f} req/s  "
+          f"p50 {latency['p50']:>8.2f} ms  p99 {latency['p99']:>8.2f} ms  "
+          f"drained {result['messages_drained_per_second']:>8.1f} msg/s  "
+          f"aws calls/msg {result['aws_calls_per_message']['total']:>6.2f}"
+          + (f"  errors {result['errors']}" if result['errors'] else '')
+          + ('  (queue not drained)' if result['drained'] is False else ''))
+
+
+def lookup(result, path):
+    value = result
+    for part in path.split('.'):
+        value = value.get(part) if isinstance(value, dict) else None
+    return value
+
+
+def compare(results, baseline_path, tolerance):
+    """
+    Print changes against a baseline result file
+    Returns the number of figures that regressed by more than tolerance
+    """
+    with open(baseline_path) as f:
+        baseline = {result['content_bytes']: result for result in json.load(f)['results']}
+    regressions = 0
+    print(f"\nCompared with {baseline_path} (tolerance {tolerance:.0%}):")
+    for result in results:
+        previous = baseline.get(result['content_bytes'])
+        if previous is None:
+            print(f"{result['content_bytes']:>8} B  no baseline")
+            continue
+        for path, higher_is_better in COMPARED.items():
+            old, new = lookup(previous, path), lookup(result, path)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            worse = -change if higher_is_better else change
+            flag = 'REGRESSION' if worse > tolerance else ''
+            regressions += bool(flag)
+            print(f"{result['content_bytes']:>8} B  {path:<30} {old:>10} -> {new:>10}  {change:>+7.1%}  {flag}")
+    return regressions
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rate', type=float, default=200, help='Requests per second, 0 for closed loop')
+    parser.add_argument('--duration', type=float, default=20, help='Seconds of load per payload size')
+    parser.add_argument('--connections', type=int, default=32, help='Concurrent client connections')
+    parser.add_argument('--sizes', default='1024,65536', help='Comma-separated email_content sizes in bytes')
+    parser.add_argument('--latency-ms', type=float, default=10, help='Latency injected into every AWS call')
+    parser.add_argument('--jitter-ms', type=float, default=0)
+    parser.add_argument('--server-mode', choices=['wsgi', 'asgi'], default='wsgi')
+    parser.add_argument('--workers', type=int, default=2, help='gunicorn worker processes')
+    parser.add_argument('--threads', type=int, default=8, help='Threads per WSGI worker')
+    parser.add_argument('--publish-mode', choices=['single', 'batch', 'spool'], default='single')
+    parser.add_argument('--output-mode', choices=['message', 'aggregate', 'parquet'], default='message')
+    parser.add_argument('--sinks', help='Processor SINKS (e.g. s3,stdout); overrides --output-mode')
+    parser.add_argument('--pollers', type=int, default=2)
+    parser.add_argument('--upload-concurrency', type=int, default=8)
+    parser.add_argument('--aggregate-max-age', type=float, default=2,
+                        help='Batch age limit in aggregate/parquet mode, keeps drain time short')
+    parser.add_argument('--drain-timeout', type=float, default=120)
+    parser.add_argument('--aws-port', type=int, default=4566)
+    parser.add_argument('--app-port', type=int, default=18080)
+    parser.add_argument('--processor-port', type=int, default=18081)
+    parser.add_argument('--no-processor', action='store_true', help='Only load the microservice')
+    parser.add_argument('--label', default='run')
+    parser.add_argument('--results-dir', default=os.path.join(ROOT, 'loadtest', 'results'))
+    parser.add_argument('--compare', help='Earlier result file to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.10, help='Allowed regression, as a fraction')
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    endpoint = f"http://127.0.0.1:{args.aws_port}"
+    workdir = tempfile.mkdtemp(prefix='loadtest-')
+    aws = FakeAWSClient(args.aws_port)
+
+    env = dict(os.environ)
+    env.update({
+        'AWS_ENDPOINT_URL': endpoint,
+        'AWS_ACCESS_KEY_ID': 'loadtest',
+        'AWS_SECRET_ACCESS_KEY': 'loadtest',
+        'AWS_REGION': 'us-west-1',
+        'SQS_QUEUE_URL': f"{endpoint}/000000000000/{QUEUE_NAME}",
+        'PYTHONUNBUFFERED': '1'
+    })
+    app_env = dict(env, **{
+        'TOKEN_SSM_PARAMETER': TOKEN_PARAMETER,
+        'SERVER_MODE': args.server_mode,
+        'WSGI_THREADS': str(args.threads),
+        'SQS_PUBLISH_MODE': args.publish_mode,
+        'PROMETHEUS_MULTIPROC_DIR': os.path.join(workdir, 'prometheus'),
+        'SPOOL_DIR': os.path.join(workdir, 'spool'),
+        'CLAIM_CHECK_BUCKET': BUCKET,
+        'MAX_CONTENT_LENGTH': str(max(sizes + [200000])),
+        'MAX_BODY_BYTES': str(max(2 * max(sizes), 1024 * 1024))
+    })
+    processor_env = dict(env, **{
+        'S3_BUCKET_NAME': BUCKET,
+        'CONSUMER_MODE': 'streaming',
+        'OUTPUT_MODE': args.output_mode,
+        'POLLER_COUNT': str(args.pollers),
+        'UPLOAD_CONCURRENCY': str(args.upload_concurrency),
+        'AGGREGATE_MAX_AGE_SECONDS': str(args.aggregate_max_age),
+        'DEDUP_DB_PATH': '',
+        'HEALTH_PORT': str(args.processor_port)
+    })
+    if args.sinks:
+        processor_env['SINKS'] = args.sinks
+
+    gunicorn = [sys.executable, '-m', 'gunicorn', '--config', 'gunicorn.conf.py',
+                '--bind', f"127.0.0.1:{args.app_port}", '--workers', str(args.workers), '--timeout', '60']
+    if args.server_mode == 'asgi':
+        gunicorn += ['--worker-class', 'uvicorn.workers.UvicornWorker', 'asgi:app']
+    else:
+        gunicorn += ['--threads', str(args.threads), 'app:app']
+
+    fake_aws = [sys.executable, 'fake_aws.py', '--port', str(args.aws_port), '--latency-ms', str(args.latency_ms),
+                '--jitter-ms', str(args.jitter_ms), '--parameter', f"{TOKEN_PARAMETER}={TOKEN}"]
+
+    aws_process = app_process = processor_process = None
+    results = []
+    try:
+        aws_process = start_process(fake_aws, os.path.dirname(os.path.abspath(__file__)), env,
+                                    os.path.join(workdir, 'fake_aws.log'))
+        if not wait_for('127.0.0.1', args.aws_port, '/_stats'):
+            sys.exit(f"Fake AWS did not start, see {workdir}/fake_aws.log")
+        app_process = start_process(gunicorn, MICROSERVICE_DIR, app_env, os.path.join(workdir, 'app.log'))
+        if not wait_for('127.0.0.1', args.app_port, '/health'):
+            sys.exit(f"Microservice did not start, see {workdir}/app.log")
+        if not args.no_processor:
+            processor_process = start_process([sys.executable, 'main.py'], PROCESSOR_DIR, processor_env,
+                                              os.path.join(workdir, 'processor.log'))
+            if not wait_for('127.0.0.1', args.processor_port, '/readyz'):
+                sys.exit(f"Processor did not become ready, see {workdir}/processor.log")
+
+        mode = f"{args.rate:g} req/s" if args.rate else f"closed loop, {args.connections} connections"
+        print(f"{mode} for {args.duration:g}s per size, AWS latency {args.latency_ms:g} ms, "
+              f"{args.server_mode} x{args.workers}, publish {args.publish_mode}, output {args.sinks or args.output_mode}")
+        for content_bytes in sizes:
+            body = make_payload(content_bytes)
+            aws.reset()
+            load, elapsed = run_load(args.app_port, body, args.rate, args.duration, args.connections)
+            load_end = time.time()
+            accepted = sum(1 for status, _ in load if status in ACCEPTED)
+            if args.no_processor:
+                stats, drained = aws.stats(), None
+            else:
+                stats, drained = wait_for_drain(aws, accepted, args.drain_timeout)
+            result = summarize(content_bytes, body, load, elapsed, stats, drained, load_end)
+            results.append(result)
+            print_result(result)
+    finally:
+        stop_process(processor_process)
+        stop_process(app_process)
+        stop_process(aws_process)
+
+    os.makedirs(args.results_dir, exist_ok=True)
+    path = os.path.join(args.results_dir, f"{args.label}-{datetime.utcnow().strftime('%Y%m%dT%H%M%SZ')}.json")
+    with open(path, 'w') as f:
+        json.dump({
+            'label': args.label,
+            'created_at': datetime.utcnow().isoformat(),
+            'git_commit': git_commit(),
+            'config': {name: value for name, value in vars(args).items()
+                       if name not in ('compare', 'results_dir', 'label')},
+            'results': results
+        }, f, indent=2)
+    print(f"\nResults written to {path} (logs in {workdir})")
+
+    if args.compare and compare(results, args.compare, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
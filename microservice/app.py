@@ -3,12 +3,33 @@ Email Processing Microservice
 Receives REST requests, validates token and data, then publishes to SQS
 """
 import os
+import re
 import json
+import math
+import time
+import atexit
+import hashlib
 import logging
+import itertools
 from datetime import datetime
-from flask import Flask, request, jsonify
-import boto3
+from flask import Flask, request, jsonify, g, Response
 from botocore.exceptions import ClientError
+from aws_clients import create_client, pool_size
+from token_cache import TokenCache
+from sqs_batcher import SQSBatchPublisher, MAX_BATCH_ENTRIES, chunk_entries, send_batch_with_retry
+from resilience import Resilience, RetryBudget, CircuitBreaker, CircuitOpenError
+from validation import EmailValidator, decode_json, iter_json_batch
+from payload_codec import PayloadEncoder, PayloadTooLargeError, ENCODING_ATTRIBUTE, encoding_attribute
+from spool import SQSSpool, SpoolFullError
+from dedup import DedupWindow, RedisDedupStore, content_key
+from rate_limit import (
+    TokenBucketLimiter, RedisTokenBucketLimiter, RateLimiter, ConcurrencyLimiter, redis_client, sender_key, client_address
+)
+from metrics import (
+    stage_timer, observe_request, record_aws_error, record_retry, record_breaker_state, record_spool,
+    render_metrics, PAYLOAD_ENCODINGS, SPOOL_MESSAGES, REQUESTS_LIMITED, RATE_LIMIT_BACKEND_ERRORS,
+    DUPLICATE_EMAILS, DEDUP_STORE_ERRORS
+)
 
 # Configure logging
 logging.basicConfig(
@@ -19,14 +40,82 @@ logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 
-# AWS clients
-ssm_client = boto3.client('ssm', region_name=os.getenv('AWS_REGION', 'us-west-1'))
-sqs_client = boto3.client('sqs', region_name=os.getenv('AWS_REGION', 'us-west-1'))
-
 # Configuration
 SQS_QUEUE_URL = os.getenv('SQS_QUEUE_URL')
 TOKEN_SSM_PARAMETER = os.getenv('TOKEN_SSM_PARAMETER', '/email-service/api-token')
 REQUIRED_FIELDS = ['email_subject', 'email_sender', 'email_timestream', 'email_content']
+# FIFO queues need a MessageGroupId (one group per sender) and a MessageDeduplicationId
+SQS_FIFO_QUEUE = (SQS_QUEUE_URL or '').endswith('.fifo')
+TOKEN_CACHE_TTL = int(os.getenv('TOKEN_CACHE_TTL_SECONDS', '300'))
+TOKEN_REFRESH_AHEAD = int(os.getenv('TOKEN_REFRESH_AHEAD_SECONDS', '60'))
+TOKEN_STALE_GRACE = int(os.getenv('TOKEN_STALE_GRACE_SECONDS', '600'))
+TOKEN_ROTATION_OVERLAP = int(os.getenv('TOKEN_ROTATION_OVERLAP_SECONDS', '300'))
+SQS_PUBLISH_MODE = os.getenv('SQS_PUBLISH_MODE', 'single')  # 'single', 'batch' or 'spool'
+SQS_BATCH_LINGER_MS = int(os.getenv('SQS_BATCH_LINGER_MS', '10'))
+SQS_BATCH_MAX_RETRIES = int(os.getenv('SQS_BATCH_MAX_RETRIES', '3'))
+SQS_BATCH_MAX_IN_FLIGHT = int(os.getenv('SQS_BATCH_MAX_IN_FLIGHT', '8'))
+SQS_PUBLISH_TIMEOUT = float(os.getenv('SQS_PUBLISH_TIMEOUT_SECONDS', '10'))
+PROCESS_BATCH_MAX_ITEMS = int(os.getenv('PROCESS_BATCH_MAX_ITEMS', '1000'))
+MAX_BODY_BYTES = int(os.getenv('MAX_BODY_BYTES', str(1024 * 1024)))
+MAX_BATCH_BODY_BYTES = int(os.getenv('MAX_BATCH_BODY_BYTES', str(16 * 1024 * 1024)))
+MAX_SUBJECT_LENGTH = int(os.getenv('MAX_SUBJECT_LENGTH', '998'))
+MAX_SENDER_LENGTH = int(os.getenv('MAX_SENDER_LENGTH', '320'))
+MAX_CONTENT_LENGTH = int(os.getenv('MAX_CONTENT_LENGTH', '200000'))
+PAYLOAD_COMPRESS_THRESHOLD = int(os.getenv('PAYLOAD_COMPRESS_THRESHOLD_BYTES', '8192'))
+CLAIM_CHECK_THRESHOLD = int(os.getenv('CLAIM_CHECK_THRESHOLD_BYTES', str(200 * 1024)))
+CLAIM_CHECK_BUCKET = os.getenv('CLAIM_CHECK_BUCKET', '')
+CLAIM_CHECK_PREFIX = os.getenv('CLAIM_CHECK_PREFIX', 'claim-checks/')
+SPOOL_DIR = os.getenv('SPOOL_DIR', '/tmp/email-processor-spool')
+SPOOL_MAX_BYTES = int(os.getenv('SPOOL_MAX_BYTES', str(256 * 1024 * 1024)))
+SPOOL_SEGMENT_BYTES = int(os.getenv('SPOOL_SEGMENT_BYTES', str(16 * 1024 * 1024)))
+SPOOL_FSYNC_INTERVAL_MS = float(os.getenv('SPOOL_FSYNC_INTERVAL_MS', '5'))
+# Token buckets per sender and per client address (requests per second, 0 disables)
+RATE_LIMIT_SENDER_RATE = float(os.getenv('RATE_LIMIT_SENDER_RATE', '0'))
+RATE_LIMIT_SENDER_BURST = float(os.getenv('RATE_LIMIT_SENDER_BURST', '20'))
+RATE_LIMIT_CLIENT_RATE = float(os.getenv('RATE_LIMIT_CLIENT_RATE', '0'))
+RATE_LIMIT_CLIENT_BURST = float(os.getenv('RATE_LIMIT_CLIENT_BURST', '100'))
+RATE_LIMIT_MAX_KEYS = int(os.getenv('RATE_LIMIT_MAX_KEYS', '100000'))
+RATE_LIMIT_REDIS_URL = os.getenv('RATE_LIMIT_REDIS_URL', '')
+RATE_LIMIT_REDIS_TIMEOUT_MS = int(os.getenv('RATE_LIMIT_REDIS_TIMEOUT_MS', '50'))
+# Repeat submissions of an email within this many seconds get the original MessageId (0 disables)
+DEDUP_WINDOW_SECONDS = float(os.getenv('DEDUP_WINDOW_SECONDS', '0'))
+DEDUP_MAX_ENTRIES = int(os.getenv('DEDUP_MAX_ENTRIES', '100000'))
+DEDUP_REDIS_URL = os.getenv('DEDUP_REDIS_URL', '')
+DEDUP_REDIS_TIMEOUT_MS = int(os.getenv('DEDUP_REDIS_TIMEOUT_MS', '50'))
+# Reverse proxies in front of the service whose X-Forwarded-For entries are trusted
+TRUSTED_PROXY_COUNT = int(os.getenv('TRUSTED_PROXY_COUNT', '0'))
+# Requests a worker process admits at once before answering 503 (0 disables)
+MAX_CONCURRENT_REQUESTS = int(os.getenv('MAX_CONCURRENT_REQUESTS', '0'))
+AWS_RETRY_MAX_ATTEMPTS = int(os.getenv('AWS_RETRY_MAX_ATTEMPTS', '3'))
+AWS_RETRY_BASE_DELAY_MS = int(os.getenv('AWS_RETRY_BASE_DELAY_MS', '50'))
+AWS_RETRY_MAX_DELAY_MS = int(os.getenv('AWS_RETRY_MAX_DELAY_MS', '2000'))
+AWS_RETRY_BUDGET_RATIO = float(os.getenv('AWS_RETRY_BUDGET_RATIO', '0.1'))
+CIRCUIT_BREAKER_FAILURES = int(os.getenv('CIRCUIT_BREAKER_FAILURES', '5'))
+CIRCUIT_BREAKER_RESET_SECONDS = float(os.getenv('CIRCUIT_BREAKER_RESET_SECONDS', '30'))
+# Request threads that may call AWS at once: gunicorn threads, or the ASGI executor
+REQUEST_CONCURRENCY = (
+    int(os.getenv('ASYNC_MAX_INFLIGHT', '256')) if os.getenv('SERVER_MODE') == 'asgi'
+    else int(os.getenv('WSGI_THREADS', '2'))
+)
+
+# AWS clients, created per worker process on first use
+# SQS retries are done by sqs_resilience, so botocore makes a single attempt
+ssm_client = create_client('ssm', os.getenv('AWS_REGION', 'us-west-1'), read_timeout=5)
+sqs_client = create_client(
+    'sqs',
+    os.getenv('AWS_REGION', 'us-west-1'),
+    max_pool_connections=pool_size(REQUEST_CONCURRENCY, SQS_BATCH_MAX_IN_FLIGHT),
+    read_timeout=5,
+    max_attempts=1
+)
+# Only used to store claim checks for oversized bodies
+s3_client = create_client(
+    's3',
+    os.getenv('AWS_REGION', 'us-west-1'),
+    max_pool_connections=pool_size(REQUEST_CONCURRENCY),
+    read_timeout=10,
+    max_attempts=1
+)
 
 
 def get_token_from_ssm():
@@ -41,92 +130,958 @@ def get_token_from_ssm():
         return response['Parameter']['Value']
     except ClientError as e:
         logger.error(f"Error retrieving token from SSM: {e}")
+        record_aws_error('ssm', 'GetParameter', e)
         raise
 
 
+# Token cache shared by all threads of a worker process
+token_cache = TokenCache(
+    loader=get_token_from_ssm,
+    ttl=TOKEN_CACHE_TTL,
+    refresh_ahead=TOKEN_REFRESH_AHEAD,
+    stale_grace=TOKEN_STALE_GRACE,
+    rotation_overlap=TOKEN_ROTATION_OVERLAP
+)
+
+
 def validate_token(provided_token):
     """
-    Validate the provided token against the stored token in SSM
+    Validate the provided token against the cached token from SSM
     """
     try:
-        stored_token = get_token_from_ssm()
-        return provided_token == stored_token
+        return token_cache.is_valid(provided_token)
     except Exception as e:
         logger.error(f"Token validation failed: {e}")
         return False
 
 
-def validate_data_fields(data):
+# Single-pass validator for email data (fields, types, lengths, sender, timestamp)
+email_validator = EmailValidator(REQUIRED_FIELDS, {
+    'email_subject': MAX_SUBJECT_LENGTH,
+    'email_sender': MAX_SENDER_LENGTH,
+    'email_content': MAX_CONTENT_LENGTH
+})
+
+
+def validate_email_data(data):
     """
-    Validate that all required fields are present in the data
+    Run field and timestamp validation for a single email
     Returns tuple: (is_valid, error_message)
     """
-    if not isinstance(data, dict):
-        return False, "Data must be a dictionary"
-    
-    missing_fields = [field for field in REQUIRED_FIELDS if field not in data]
-    
-    if missing_fields:
-        return False, f"Missing required fields: {', '.join(missing_fields)}"
-    
-    # Check that all required fields have values (not None or empty string)
-    empty_fields = [field for field in REQUIRED_FIELDS if not data.get(field)]
-    if empty_fields:
-        return False, f"Empty fields not allowed: {', '.join(empty_fields)}"
-    
-    return True, None
+    return email_validator.validate(data)
+
+
+# Shared token buckets when RATE_LIMIT_REDIS_URL is set, otherwise limits are per process
+redis_connection = (
+    redis_client(RATE_LIMIT_REDIS_URL, RATE_LIMIT_REDIS_TIMEOUT_MS / 1000.0) if RATE_LIMIT_REDIS_URL else None
+)
+
+
+def build_rate_limiter(name, rate, burst):
+    """
+    Token-bucket limiter for one kind of key, or None when its rate is 0
+    """
+    if rate <= 0:
+        return None
+    shared = None
+    if redis_connection is not None:
+        shared = RedisTokenBucketLimiter(redis_connection, rate, burst, prefix=f"email-processor:rate:{name}:")
+    return RateLimiter(
+        TokenBucketLimiter(rate, burst, max_keys=RATE_LIMIT_MAX_KEYS),
+        shared,
+        on_error=lambda e: RATE_LIMIT_BACKEND_ERRORS.inc()
+    )
+
+
+sender_limiter = build_rate_limiter('sender', RATE_LIMIT_SENDER_RATE, RATE_LIMIT_SENDER_BURST)
+client_limiter = build_rate_limiter('client', RATE_LIMIT_CLIENT_RATE, RATE_LIMIT_CLIENT_BURST)
+concurrency_limiter = ConcurrencyLimiter(MAX_CONCURRENT_REQUESTS)
+
+
+def build_dedup_window():
+    """
+    Ingest dedup window, shared through Redis when DEDUP_REDIS_URL is set, or None when disabled
+    """
+    if DEDUP_WINDOW_SECONDS <= 0:
+        return None
+    store = None
+    if DEDUP_REDIS_URL:
+        client = redis_client(DEDUP_REDIS_URL, DEDUP_REDIS_TIMEOUT_MS / 1000.0, 'DEDUP_REDIS_URL',
+                              'the dedup window is kept per worker process')
+        store = RedisDedupStore(client) if client is not None else None
+    return DedupWindow(
+        window=DEDUP_WINDOW_SECONDS,
+        max_entries=DEDUP_MAX_ENTRIES,
+        store=store,
+        on_error=lambda e: DEDUP_STORE_ERRORS.inc()
+    )
+
+
+ingest_dedup = build_dedup_window()
+
+
+def dedup_key(data):
+    """
+    Content key of validated email data, or None when neither the dedup window
+    nor a FIFO queue needs one
+    """
+    if ingest_dedup is None and not SQS_FIFO_QUEUE:
+        return None
+    return content_key(data)
+
+
+# Characters SQS accepts in a MessageGroupId
+MESSAGE_GROUP_ID = re.compile(r'^[\x21-\x7e]{1,128}$')
+
+
+def message_group_id(data):
+    """
+    FIFO message group of an email: its sender, so each sender's emails stay in order
+    while different senders are processed in parallel
+    """
+    sender = sender_key(data['email_sender'])
+    if MESSAGE_GROUP_ID.match(sender):
+        return sender
+    return hashlib.sha256(sender.encode('utf-8')).hexdigest()
+
+
+def sqs_message_fields(data, key=None):
+    """
+    Extra SendMessage parameters for an email (key is its content key, if already computed)
+    """
+    if not SQS_FIFO_QUEUE:
+        return {}
+    # SQS drops a FIFO message whose deduplication ID was seen in the last 5 minutes
+    return {
+        'MessageGroupId': message_group_id(data),
+        'MessageDeduplicationId': key or content_key(data)
+    }
+
+
+def remember_queued(key, message_id):
+    """
+    Record a queued email in the dedup window ('' for spooled emails without a MessageId yet)
+    """
+    if ingest_dedup is not None and key is not None:
+        ingest_dedup.put(key, message_id or '')
+
+
+def rate_limit_retry_after(sender=None, remote_addr=None):
+    """
+    Check the client and sender rate limits
+    Returns tuple: (seconds until the request may be retried or 0, name of the limit hit)
+    """
+    if client_limiter is not None and remote_addr:
+        retry_after = client_limiter.acquire(remote_addr)
+        if retry_after:
+            return retry_after, 'client'
+    if sender_limiter is not None and sender:
+        retry_after = sender_limiter.acquire(sender_key(sender))
+        if retry_after:
+            return retry_after, 'sender'
+    return 0, None
+
+
+def request_client_address():
+    """
+    Client address of the current Flask request, for logging and rate limits
+    """
+    return client_address(request.remote_addr, request.headers.get('X-Forwarded-For'), TRUSTED_PROXY_COUNT)
+
+
+def read_body(limit):
+    """
+    Read the request body, rejecting it from Content-Length before reading when possible
+    Returns None if the body exceeds limit bytes
+    """
+    if request.content_length is not None and request.content_length > limit:
+        return None
+    body = request.stream.read(limit + 1)
+    if len(body) > limit:
+        return None
+    return body
+
+
+def payload_too_large(limit):
+    """
+    Response for request bodies over the size limit
+    Returns tuple: (response_body, status_code, headers)
+    """
+    return {
+        'status': 'error',
+        'message': f"Payload exceeds {limit} bytes"
+    }, 413, {}
+
+
+def build_message_attributes(encoding=None):
+    """
+    Message attributes attached to every published email
+    """
+    attributes = {
+        'ContentType': {
+            'StringValue': 'application/json',
+            'DataType': 'String'
+        },
+        'ProcessedAt': {
+            'StringValue': datetime.utcnow().isoformat(),
+            'DataType': 'String'
+        }
+    }
+    if encoding is not None:
+        attributes[ENCODING_ATTRIBUTE] = encoding_attribute(encoding)
+    return attributes
+
+
+def build_resilience(name):
+    """
+    Retries, retry budget and circuit breaker for one AWS service
+    """
+    return Resilience(
+        name,
+        max_attempts=AWS_RETRY_MAX_ATTEMPTS,
+        base_delay=AWS_RETRY_BASE_DELAY_MS / 1000.0,
+        max_delay=AWS_RETRY_MAX_DELAY_MS / 1000.0,
+        budget=RetryBudget(ratio=AWS_RETRY_BUDGET_RATIO),
+        breaker=CircuitBreaker(
+            failure_threshold=CIRCUIT_BREAKER_FAILURES,
+            reset_timeout=CIRCUIT_BREAKER_RESET_SECONDS,
+            on_state_change=lambda state: record_breaker_state(name, state)
+        ),
+        on_retry=record_retry
+    )
+
+
+sqs_resilience = build_resilience('sqs')
+s3_resilience = build_resilience('s3')
+
+
+def put_claim_check(bucket, key, body):
+    """
+    Store the gzip-compressed body of an oversized message in S3
+    """
+    try:
+        s3_resilience.call(
+            s3_client.put_object,
+            Bucket=bucket,
+            Key=key,
+            Body=body,
+            ContentType='application/json',
+            ContentEncoding='gzip'
+        )
+    except ClientError as e:
+        record_aws_error('s3', 'PutObject', e)
+        raise
+
+
+# Compresses large bodies and offloads the largest to S3 (when CLAIM_CHECK_BUCKET is set)
+payload_encoder = PayloadEncoder(
+    compress_threshold=PAYLOAD_COMPRESS_THRESHOLD,
+    claim_check_threshold=CLAIM_CHECK_THRESHOLD,
+    put_object=put_claim_check,
+    bucket=CLAIM_CHECK_BUCKET or None,
+    key_prefix=CLAIM_CHECK_PREFIX
+)
 
 
-def validate_timestamp(timestamp_str):
+def encode_message(data):
     """
-    Validate that the timestamp is a valid Unix timestamp
+    SQS message body and attributes for an email
+    Raises PayloadTooLargeError if it does not fit in a message and claim checks are disabled
+    """
+    message_body, encoding = payload_encoder.encode(json.dumps(data))
+    PAYLOAD_ENCODINGS.labels(encoding=encoding or 'plain').inc()
+    return message_body, build_message_attributes(encoding)
+
+
+def send_message_batch(entries):
+    """
+    Send a list of SendMessageBatch entries to the SQS queue
     """
     try:
-        timestamp = int(timestamp_str)
-        # Check if timestamp is reasonable (between year 2000 and 2100)
-        if timestamp < 946684800 or timestamp > 4102444800:
-            return False, "Timestamp out of reasonable range"
-        return True, None
-    except (ValueError, TypeError):
-        return False, "Invalid timestamp format"
+        response = sqs_resilience.call(
+            sqs_client.send_message_batch,
+            QueueUrl=SQS_QUEUE_URL,
+            Entries=entries
+        )
+    except ClientError as e:
+        record_aws_error('sqs', 'SendMessageBatch', e)
+        raise
+    for failure in response.get('Failed', []):
+        record_aws_error('sqs', 'SendMessageBatch', failure.get('Code', 'Unknown'))
+    return response
+
+
+# Micro-batching publisher used when SQS_PUBLISH_MODE=batch
+sqs_publisher = SQSBatchPublisher(
+    send_batch=send_message_batch,
+    linger=SQS_BATCH_LINGER_MS / 1000.0,
+    max_retries=SQS_BATCH_MAX_RETRIES,
+    max_in_flight=SQS_BATCH_MAX_IN_FLIGHT
+)
+
+
+def record_spool_forwarded(delivered, dropped, snapshot):
+    """
+    Export the progress of the spool forwarder
+    """
+    SPOOL_MESSAGES.labels(outcome='forwarded').inc(delivered)
+    if dropped:
+        SPOOL_MESSAGES.labels(outcome='dropped').inc(dropped)
+    record_spool(snapshot)
+
+
+# Local write-ahead log drained to SQS in the background, used when SQS_PUBLISH_MODE=spool
+sqs_spool = SQSSpool(
+    root=SPOOL_DIR,
+    send_batch=send_message_batch,
+    max_bytes=SPOOL_MAX_BYTES,
+    segment_bytes=SPOOL_SEGMENT_BYTES,
+    fsync_interval=SPOOL_FSYNC_INTERVAL_MS / 1000.0,
+    on_forwarded=record_spool_forwarded
+)
+atexit.register(sqs_spool.close)
+
+
+def spool_messages(items):
+    """
+    Durably accept a list of (index, data, content_key) items for forwarding to SQS
+    All encoded items are appended together, so they share one fsync
+    Returns dict: index -> (success, error or None)
+    """
+    results = {}
+    messages = []
+    accepted = []
+    for index, data, key in items:
+        try:
+            message_body, attributes = encode_message(data)
+            messages.append((message_body, attributes, sqs_message_fields(data, key)))
+            accepted.append(index)
+        except (PayloadTooLargeError, CircuitOpenError, ClientError) as e:
+            results[index] = (False, str(e))
+    if messages:
+        try:
+            sqs_spool.append_many(messages)
+        except SpoolFullError as e:
+            SPOOL_MESSAGES.labels(outcome='rejected').inc(len(messages))
+            logger.warning(f"Spool full: {e}")
+            results.update((index, (False, str(e))) for index in accepted)
+        else:
+            SPOOL_MESSAGES.labels(outcome='accepted').inc(len(messages))
+            results.update((index, (True, None)) for index in accepted)
+        record_spool(sqs_spool.snapshot())
+    return results
+
+
+def spool_message(data, key=None):
+    """
+    Durably accept validated data for forwarding to SQS
+    Raises SpoolFullError when the spool is at its size limit, PayloadTooLargeError
+    for emails that cannot be queued, and ClientError or CircuitOpenError when a
+    claim check cannot be stored
+    """
+    message_body, attributes = encode_message(data)
+    try:
+        sqs_spool.append(message_body, attributes, sqs_message_fields(data, key))
+    except SpoolFullError:
+        SPOOL_MESSAGES.labels(outcome='rejected').inc()
+        raise
+    SPOOL_MESSAGES.labels(outcome='accepted').inc()
+    record_spool(sqs_spool.snapshot())
 
 
-def publish_to_sqs(data):
+def publish_to_sqs(data, key=None):
     """
     Publish validated data to SQS queue
+    Raises CircuitOpenError while SQS (or S3, for claim checks) is failing, so callers
+    can shed load, and PayloadTooLargeError for emails that cannot be queued
     """
+    sqs_resilience.check()
+    
+    try:
+        message_body, attributes = encode_message(data)
+    except ClientError as e:
+        logger.error(f"Error storing claim check in S3: {e}")
+        return False, str(e)
+    
+    if SQS_PUBLISH_MODE == 'batch':
+        try:
+            future = sqs_publisher.submit(message_body, attributes, **sqs_message_fields(data, key))
+            success, message_id_or_error = future.result(timeout=SQS_PUBLISH_TIMEOUT)
+        except Exception as e:
+            logger.error(f"Error publishing to SQS: {e}")
+            return False, str(e)
+        if success:
+            logger.info(f"Message published to SQS. MessageId: {message_id_or_error}")
+            return True, message_id_or_error
+        if isinstance(message_id_or_error, CircuitOpenError):
+            # The circuit opened while the message waited in the batcher: shed it like the check above
+            raise message_id_or_error
+        logger.error(f"Error publishing to SQS: {message_id_or_error}")
+        return False, str(message_id_or_error)
+
     try:
-        response = sqs_client.send_message(
+        response = sqs_resilience.call(
+            sqs_client.send_message,
             QueueUrl=SQS_QUEUE_URL,
-            MessageBody=json.dumps(data),
-            MessageAttributes={
-                'ContentType': {
-                    'StringValue': 'application/json',
-                    'DataType': 'String'
-                },
-                'ProcessedAt': {
-                    'StringValue': datetime.utcnow().isoformat(),
-                    'DataType': 'String'
-                }
-            }
+            MessageBody=message_body,
+            MessageAttributes=attributes,
+            **sqs_message_fields(data, key)
         )
         logger.info(f"Message published to SQS. MessageId: {response['MessageId']}")
         return True, response['MessageId']
     except ClientError as e:
         logger.error(f"Error publishing to SQS: {e}")
+        record_aws_error('sqs', 'SendMessage', e)
         return False, str(e)
 
 
+def publish_batch_to_sqs(items):
+    """
+    Publish a list of (index, data, content_key) items using SendMessageBatch
+    Returns dict: index -> (success, message_id_or_error)
+    """
+    entries = []
+    results = {}
+    for index, data, key in items:
+        try:
+            message_body, attributes = encode_message(data)
+        except (PayloadTooLargeError, CircuitOpenError, ClientError) as e:
+            results[index] = (False, str(e))
+            continue
+        entries.append(dict(sqs_message_fields(data, key), Id=str(index), MessageBody=message_body,
+                            MessageAttributes=attributes))
+    
+    for chunk in chunk_entries(entries):
+        try:
+            chunk_results = send_batch_with_retry(
+                send_message_batch, chunk, max_retries=SQS_BATCH_MAX_RETRIES
+            )
+        except Exception as e:
+            logger.error(f"Error publishing batch to SQS: {e}")
+            chunk_results = {entry['Id']: (False, str(e)) for entry in chunk}
+        for entry_id, (success, message_id_or_error) in chunk_results.items():
+            results[int(entry_id)] = (success, message_id_or_error if success else str(message_id_or_error))
+    return results
+
+
+class BodyTooLargeError(Exception):
+    """
+    Raised while streaming a request body that passes its size limit
+    """
+
+
+class InvalidBodyError(Exception):
+    """
+    Raised while streaming a batch body that turns out not to be valid JSON
+    """
+
+
+class BatchLimitError(Exception):
+    """
+    Raised while streaming a batch that has more than PROCESS_BATCH_MAX_ITEMS items
+    """
+
+
+class BoundedReader:
+    """
+    Request body stream that raises BodyTooLargeError after `limit` bytes
+    Needed for chunked bodies, which have no Content-Length to check up front
+    """
+
+    def __init__(self, stream, limit):
+        self._stream = stream
+        self.limit = limit
+        self.bytes_read = 0
+
+    def _count(self, data):
+        self.bytes_read += len(data)
+        if self.bytes_read > self.limit:
+            raise BodyTooLargeError(self.limit)
+        return data
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.limit - self.bytes_read + 1
+        return self._count(self._stream.read(size))
+
+    def __iter__(self):
+        while True:
+            line = self._count(self._stream.readline(self.limit - self.bytes_read + 1))
+            if not line:
+                return
+            yield line
+
+
+def iter_ndjson_items(lines):
+    """
+    Yield (data_or_None, parse_error) for each non-empty line of an NDJSON body
+    """
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield decode_json(line), None
+        except ValueError:
+            yield None, 'Invalid JSON'
+
+
+def iter_batch_items(items):
+    """
+    Yield (index, data_or_None, parse_error) for each (data, parse_error) item of a batch
+    Raises BatchLimitError instead of reading past PROCESS_BATCH_MAX_ITEMS items
+    """
+    for index, (data, error_message) in enumerate(items):
+        if index >= PROCESS_BATCH_MAX_ITEMS:
+            raise BatchLimitError(PROCESS_BATCH_MAX_ITEMS)
+        yield index, data, error_message
+
+
+def iter_json_items(events):
+    """
+    Yield (data, None) for the remaining data array items of a JSON batch body
+    """
+    try:
+        for event, value in events:
+            if event == 'item':
+                yield value, None
+    except ValueError as e:
+        raise InvalidBodyError(str(e)) from e
+
+
+def batch_too_large():
+    """
+    Response for batches with more than PROCESS_BATCH_MAX_ITEMS items
+    Returns tuple: (response_body, status_code, headers)
+    """
+    return {
+        'status': 'error',
+        'message': f"Batch exceeds {PROCESS_BATCH_MAX_ITEMS} items"
+    }, 413, {}
+
+
+def invalid_json():
+    """
+    Response for request bodies that are not valid JSON
+    Returns tuple: (response_body, status_code, headers)
+    """
+    return {
+        'status': 'error',
+        'message': 'Invalid JSON payload'
+    }, 400, {}
+
+
+def read_batch_head(events, header_token):
+    """
+    Read a JSON batch body up to the point where its items can be processed
+    The body's token wins when it comes before `data`; otherwise X-API-Token is used. Items
+    that come before any token are buffered, so a body with its token after `data` (and no
+    header) is read in full before processing.
+    Returns (token, buffered_items, error_response); error_response is None when the
+    remaining items can be read from events
+    """
+    token = None
+    buffered = []
+    has_array = False
+    for event, value in events:
+        if event == 'token':
+            token = value
+        elif event == 'data':
+            break
+        elif event == 'array':
+            has_array = True
+        else:
+            buffered.append((value, None))
+            if len(buffered) > PROCESS_BATCH_MAX_ITEMS:
+                return None, None, batch_too_large()
+            if token is not None or header_token:
+                return token or header_token, buffered, None
+    if not buffered:
+        return None, None, ({
+            'status': 'error',
+            'message': 'Data must be a non-empty list'
+        }, 400, {})
+    return token or header_token, buffered, None
+
+
+def handle_batch_request(stream, ndjson, header_token, remote_addr):
+    """
+    Validate the token once, then validate and publish each item of a batch body
+    Shared by the WSGI and ASGI apps. The body is parsed incrementally from stream
+    (a JSON object with a data array, or NDJSON when ndjson is set), so at most one
+    item and one SendMessageBatch worth of pending items are held at a time.
+    If the body turns out to be invalid, too large or over PROCESS_BATCH_MAX_ITEMS
+    items part way through, reading stops; the error response then lists the
+    items already queued.
+    Returns tuple: (response_body, status_code, headers)
+    """
+    reader = BoundedReader(stream, MAX_BATCH_BODY_BYTES)
+    if ndjson:
+        token = header_token
+        items = iter_ndjson_items(reader)
+    else:
+        events = iter_json_batch(reader.read)
+        try:
+            token, buffered, error_response = read_batch_head(events, header_token)
+        except ValueError:
+            return invalid_json()
+        except BodyTooLargeError:
+            return payload_too_large(MAX_BATCH_BODY_BYTES)
+        if error_response is not None:
+            return error_response
+        items = itertools.chain(buffered, iter_json_items(events))
+    
+    if not token:
+        return {
+            'status': 'error',
+            'message': 'Token is required'
+        }, 401, {}
+    
+    if not validate_token(token):
+        logger.warning(f"Invalid token attempt from {remote_addr}")
+        return {
+            'status': 'error',
+            'message': 'Invalid token'
+        }, 401, {}
+    
+    # The spool keeps accepting while SQS is down
+    spooled = SQS_PUBLISH_MODE == 'spool'
+    retry_after = 0 if spooled else sqs_resilience.retry_after()
+    if retry_after > 0:
+        return service_unavailable(retry_after)
+    
+    results = []
+    pending = []
+    
+    repeats = []  # (index, index of the same email earlier in this batch)
+    batch_keys = {}
+    
+    def flush():
+        published = spool_messages(pending) if spooled else publish_batch_to_sqs(pending)
+        keys = {index: key for index, _, key in pending}
+        for index, (success, message_id_or_error) in sorted(published.items()):
+            if success:
+                remember_queued(keys[index], message_id_or_error)
+            if success and spooled:
+                results.append({'index': index, 'status': 'success'})
+            elif success:
+                results.append({'index': index, 'status': 'success', 'message_id': message_id_or_error})
+            else:
+                logger.error(f"Failed to publish batch item {index} to SQS: {message_id_or_error}")
+                results.append({'index': index, 'status': 'error', 'message': 'Failed to queue email data'})
+        pending.clear()
+    
+    aborted = None
+    try:
+        for index, item, error_message in iter_batch_items(items):
+            if error_message is None:
+                _, error_message = validate_email_data(item)
+            key = dedup_key(item) if error_message is None else None
+            if ingest_dedup is not None and key is not None:
+                if key in batch_keys:
+                    repeats.append((index, batch_keys[key]))
+                    continue
+                batch_keys[key] = index
+                original_message_id = ingest_dedup.get(key)
+                if original_message_id is not None:
+                    DUPLICATE_EMAILS.inc()
+                    result = {'index': index, 'status': 'success', 'duplicate': True}
+                    if original_message_id:
+                        result['message_id'] = original_message_id
+                    results.append(result)
+                    continue
+            if error_message is None:
+                # Each item counts against the client and sender limits like a /process call
+                retry_after, reason = rate_limit_retry_after(item['email_sender'], remote_addr)
+                if retry_after:
+                    REQUESTS_LIMITED.labels(reason=reason).inc()
+                    results.append({'index': index, 'status': 'error', 'message': 'Rate limit exceeded',
+                                    'retry_after': math.ceil(retry_after)})
+                    continue
+            if error_message is not None:
+                results.append({'index': index, 'status': 'error', 'message': error_message})
+                continue
+            pending.append((index, item, key))
+            if len(pending) >= MAX_BATCH_ENTRIES:
+                flush()
+    except BatchLimitError:
+        aborted = batch_too_large()
+    except BodyTooLargeError:
+        aborted = payload_too_large(MAX_BATCH_BODY_BYTES)
+    except InvalidBodyError:
+        aborted = invalid_json()
+    
+    if aborted is None and pending:
+        flush()
+    
+    # Repeats within the batch share the outcome of the first copy
+    by_index = {result['index']: result for result in results}
+    for index, first_index in repeats:
+        if first_index in by_index:
+            DUPLICATE_EMAILS.inc()
+            results.append(dict(by_index[first_index], index=index, duplicate=True))
+    
+    results.sort(key=lambda result: result['index'])
+    accepted = sum(1 for result in results if result['status'] == 'success')
+    
+    if aborted is not None:
+        body, status_code, headers = aborted
+        logger.warning(f"Batch aborted after {len(results)} item(s), {accepted} queued: {body['message']}")
+        if results:
+            body = dict(body, accepted=accepted, results=results)
+        return body, status_code, headers
+    
+    if not results:
+        return {
+            'status': 'error',
+            'message': 'Data is required'
+        }, 400, {}
+    
+    logger.info(f"Batch processed: {accepted}/{len(results)} item(s) queued")
+    return {
+        'status': 'success' if accepted == len(results) else 'partial',
+        'accepted': accepted,
+        'rejected': len(results) - accepted,
+        'results': results
+    }, 200, {}
+
+
+def health_payload():
+    """
+    Body of the health check response, shared by the WSGI and ASGI apps
+    """
+    return {
+        'status': 'healthy',
+        'service': 'email-processor',
+        'timestamp': datetime.utcnow().isoformat(),
+        'token_cache': token_cache.snapshot(),
+        'sqs_publisher': sqs_publisher.snapshot(),
+        'sqs_circuit': sqs_resilience.snapshot(),
+        's3_circuit': s3_resilience.snapshot(),
+        'spool': sqs_spool.snapshot(),
+        'dedup': ingest_dedup.snapshot() if ingest_dedup else None,
+        'admission': {
+            'concurrency': concurrency_limiter.snapshot(),
+            'sender_rate_limit': sender_limiter.snapshot() if sender_limiter else None,
+            'client_rate_limit': client_limiter.snapshot() if client_limiter else None
+        }
+    }
+
+
+def root_payload():
+    """
+    Body of the root endpoint response, shared by the WSGI and ASGI apps
+    """
+    return {
+        'service': 'email-processor',
+        'version': '1.0.0',
+        'endpoints': {
+            'health': '/health',
+            'process': '/process (POST)',
+            'process_batch': '/process/batch (POST)',
+            'metrics': '/metrics'
+        }
+    }
+
+
+def service_unavailable(retry_after):
+    """
+    Response for requests shed while the SQS circuit is open
+    Returns tuple: (response_body, status_code, headers)
+    """
+    return {
+        'status': 'error',
+        'message': 'Service temporarily unavailable, please retry later'
+    }, 503, {'Retry-After': str(max(math.ceil(retry_after), 1))}
+
+
+def too_many_requests(retry_after, reason):
+    """
+    Response for requests over a rate limit
+    Returns tuple: (response_body, status_code, headers)
+    """
+    REQUESTS_LIMITED.labels(reason=reason).inc()
+    return {
+        'status': 'error',
+        'message': 'Rate limit exceeded, please retry later'
+    }, 429, {'Retry-After': str(max(math.ceil(retry_after), 1))}
+
+
+def overloaded():
+    """
+    Response for requests shed by the concurrency limit
+    Returns tuple: (response_body, status_code, headers)
+    """
+    REQUESTS_LIMITED.labels(reason='concurrency').inc()
+    return service_unavailable(1)
+
+
+def duplicate_response(message_id):
+    """
+    Response for an email already queued within the dedup window
+    Returns tuple: (response_body, status_code, headers)
+    """
+    DUPLICATE_EMAILS.inc()
+    logger.info(f"Duplicate email submission, original MessageId: {message_id or 'pending'}")
+    if not message_id:
+        # Still in the spool, so there is no MessageId to return yet
+        return {
+            'status': 'accepted',
+            'message': 'Email data already accepted for queueing',
+            'duplicate': True
+        }, 202, {}
+    return {
+        'status': 'success',
+        'message': 'Email data already queued',
+        'message_id': message_id,
+        'duplicate': True
+    }, 200, {}
+
+
+def handle_process_request(request_data, remote_addr=None):
+    """
+    Validate a parsed /process payload and publish it to SQS
+    Returns tuple: (response_body, status_code, headers)
+    """
+    if not request_data or not isinstance(request_data, dict):
+        return {
+            'status': 'error',
+            'message': 'Invalid JSON payload'
+        }, 400, {}
+    
+    # Per-client rate limit, checked before any SSM or SQS work
+    retry_after, reason = rate_limit_retry_after(remote_addr=remote_addr)
+    if retry_after:
+        logger.warning(f"Rate limiting client {remote_addr}")
+        return too_many_requests(retry_after, reason)
+    
+    # Extract token and data
+    token = request_data.get('token')
+    data = request_data.get('data')
+    
+    # Validate token presence
+    if not token:
+        return {
+            'status': 'error',
+            'message': 'Token is required'
+        }, 401, {}
+    
+    # Validate data presence
+    if not data:
+        return {
+            'status': 'error',
+            'message': 'Data is required'
+        }, 400, {}
+    
+    # Validate token correctness
+    with stage_timer('token_validation'):
+        is_valid_token = validate_token(token)
+    if not is_valid_token:
+        logger.warning(f"Invalid token attempt from {remote_addr}")
+        return {
+            'status': 'error',
+            'message': 'Invalid token'
+        }, 401, {}
+    
+    # Validate data fields and timestamp
+    with stage_timer('field_validation'):
+        is_valid, error_message = validate_email_data(data)
+    if not is_valid:
+        return {
+            'status': 'error',
+            'message': error_message
+        }, 400, {}
+    
+    # Repeat submissions are answered with the original MessageId without counting
+    # against the sender's rate limit
+    with stage_timer('dedup'):
+        key = dedup_key(data)
+        original_message_id = ingest_dedup.get(key) if ingest_dedup is not None else None
+    if original_message_id is not None:
+        return duplicate_response(original_message_id)
+    
+    retry_after, reason = rate_limit_retry_after(sender=data['email_sender'])
+    if retry_after:
+        logger.warning(f"Rate limiting sender {data['email_sender']!r}")
+        return too_many_requests(retry_after, reason)
+    
+    # Publish to SQS, or accept into the local spool that forwards to SQS
+    try:
+        if SQS_PUBLISH_MODE == 'spool':
+            with stage_timer('spool_append'):
+                spool_message(data, key)
+            remember_queued(key, None)
+            logger.info("Email data accepted into the spool")
+            return {
+                'status': 'accepted',
+                'message': 'Email data accepted for queueing'
+            }, 202, {}
+        with stage_timer('sqs_publish'):
+            success, message_id_or_error = publish_to_sqs(data, key)
+    except SpoolFullError as e:
+        logger.warning(f"Shedding request, spool full: {e}")
+        return service_unavailable(max(sqs_resilience.retry_after(), 1))
+    except CircuitOpenError as e:
+        logger.warning(f"Shedding request: {e}")
+        return service_unavailable(e.retry_after)
+    except PayloadTooLargeError as e:
+        logger.warning(f"Rejecting email: {e}")
+        return {
+            'status': 'error',
+            'message': 'Email too large to queue'
+        }, 413, {}
+    except ClientError as e:
+        logger.error(f"Error storing claim check in S3: {e}")
+        return {
+            'status': 'error',
+            'message': 'Failed to queue email data'
+        }, 500, {}
+    
+    if success:
+        remember_queued(key, message_id_or_error)
+        logger.info(f"Email data processed successfully. MessageId: {message_id_or_error}")
+        return {
+            'status': 'success',
+            'message': 'Email data processed and queued',
+            'message_id': message_id_or_error
+        }, 200, {}
+    else:
+        logger.error(f"Failed to publish to SQS: {message_id_or_error}")
+        return {
+            'status': 'error',
+            'message': 'Failed to queue email data'
+        }, 500, {}
+
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+
+@app.after_request
+def record_request_metrics(response):
+    endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    if endpoint != '/metrics':
+        observe_request(endpoint, request.method, response.status_code,
+                        time.perf_counter() - g.request_start)
+    return response
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """
+    Prometheus metrics endpoint (aggregated across gunicorn workers)
+    """
+    body, content_type = render_metrics()
+    return Response(body, status=200, content_type=content_type)
+
+
 @app.route('/health', methods=['GET'])
 def health_check():
     """
     Health check endpoint for ELB
     """
-    return jsonify({
-        'status': 'healthy',
-        'service': 'email-processor',
-        'timestamp': datetime.utcnow().isoformat()
-    }), 200
+    return jsonify(health_payload()), 200
 
 
 @app.route('/process', methods=['POST'])
@@ -135,74 +1090,26 @@ def process_email():
     Main endpoint to process email data
     Validates token and data, then publishes to SQS
     """
+    if not concurrency_limiter.acquire():
+        body, status_code, headers = overloaded()
+        return jsonify(body), status_code, headers
     try:
-        # Parse request JSON
-        request_data = request.get_json()
+        body = read_body(MAX_BODY_BYTES)
+        if body is None:
+            body, status_code, headers = payload_too_large(MAX_BODY_BYTES)
+            return jsonify(body), status_code, headers
         
-        if not request_data:
+        # Parse request JSON
+        try:
+            with stage_timer('json_parse'):
+                request_data = decode_json(body)
+        except ValueError:
             return jsonify({
                 'status': 'error',
                 'message': 'Invalid JSON payload'
             }), 400
-        
-        # Extract token and data
-        token = request_data.get('token')
-        data = request_data.get('data')
-        
-        # Validate token presence
-        if not token:
-            return jsonify({
-                'status': 'error',
-                'message': 'Token is required'
-            }), 401
-        
-        # Validate data presence
-        if not data:
-            return jsonify({
-                'status': 'error',
-                'message': 'Data is required'
-            }), 400
-        
-        # Validate token correctness
-        if not validate_token(token):
-            logger.warning(f"Invalid token attempt from {request.remote_addr}")
-            return jsonify({
-                'status': 'error',
-                'message': 'Invalid token'
-            }), 401
-        
-        # Validate data fields
-        is_valid, error_message = validate_data_fields(data)
-        if not is_valid:
-            return jsonify({
-                'status': 'error',
-                'message': error_message
-            }), 400
-        
-        # Validate timestamp
-        is_valid_timestamp, timestamp_error = validate_timestamp(data['email_timestream'])
-        if not is_valid_timestamp:
-            return jsonify({
-                'status': 'error',
-                'message': f"Invalid timestamp: {timestamp_error}"
-            }), 400
-        
-        # Publish to SQS
-        success, message_id_or_error = publish_to_sqs(data)
-        
-        if success:
-            logger.info(f"Email data processed successfully. MessageId: {message_id_or_error}")
-            return jsonify({
-                'status': 'success',
-                'message': 'Email data processed and queued',
-                'message_id': message_id_or_error
-            }), 200
-        else:
-            logger.error(f"Failed to publish to SQS: {message_id_or_error}")
-            return jsonify({
-                'status': 'error',
-                'message': 'Failed to queue email data'
-            }), 500
+        body, status_code, headers = handle_process_request(request_data, request_client_address())
+        return jsonify(body), status_code, headers
             
     except Exception as e:
         logger.error(f"Unexpected error processing request: {e}")
@@ -210,6 +1117,41 @@ def process_email():
             'status': 'error',
             'message': 'Internal server error'
         }), 500
+    finally:
+        concurrency_limiter.release()
+
+
+@app.route('/process/batch', methods=['POST'])
+def process_email_batch():
+    """
+    Bulk endpoint to process many emails in one request
+    Accepts {"token": ..., "data": [...]} as JSON, or an NDJSON body
+    (one data object per line) with the token in the X-API-Token header.
+    Validates the token once, then validates and publishes each item.
+    """
+    if not concurrency_limiter.acquire():
+        body, status_code, headers = overloaded()
+        return jsonify(body), status_code, headers
+    try:
+        if request.content_length is not None and request.content_length > MAX_BATCH_BODY_BYTES:
+            body, status_code, headers = payload_too_large(MAX_BATCH_BODY_BYTES)
+            return jsonify(body), status_code, headers
+        body, status_code, headers = handle_batch_request(
+            request.stream,
+            request.mimetype == 'application/x-ndjson',
+            request.headers.get('X-API-Token'),
+            request_client_address()
+        )
+        return jsonify(body), status_code, headers
+    
+    except Exception as e:
+        logger.error(f"Unexpected error processing batch request: {e}")
+        return jsonify({
+            'status': 'error',
+            'message': 'Internal server error'
+        }), 500
+    finally:
+        concurrency_limiter.release()
 
 
 @app.route('/', methods=['GET'])
@@ -217,14 +1159,7 @@ def root():
     """
     Root endpoint with service information
     """
-    return jsonify({
-        'service': 'email-processor',
-        'version': '1.0.0',
-        'endpoints': {
-            'health': '/health',
-            'process': '/process (POST)'
-        }
-    }), 200
+    return jsonify(root_payload()), 200
 
 
 if __name__ == '__main__':
@@ -233,6 +1168,9 @@ if __name__ == '__main__':
         logger.error("SQS_QUEUE_URL environment variable is required")
         exit(1)
     
+    if SQS_PUBLISH_MODE == 'spool':
+        sqs_spool.start()
+    
     port = int(os.getenv('PORT', 8080))
     logger.info(f"Starting email processor service on port {port}")
     app.run(host='0.0.0.0', port=port, debug=False)
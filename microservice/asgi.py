@@ -0,0 +1,266 @@
+"""
+ASGI serving mode for the Email Processing Microservice
+Serves /, /health, /process, /process/batch and /metrics with the same validation and
+response shapes as the Flask app, running blocking SSM/SQS work on a bounded thread pool so
+hundreds of requests can be in flight per worker process.
+
+Run with: gunicorn -k uvicorn.workers.UvicornWorker asgi:app
+"""
+import os
+import json
+import time
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import app as wsgi_app
+from metrics import stage_timer, observe_request, render_metrics
+from validation import decode_json
+from rate_limit import client_address
+
+logger = logging.getLogger(__name__)
+
+# Upper bound on concurrently executing SSM/SQS calls per worker process
+ASYNC_MAX_INFLIGHT = int(os.getenv('ASYNC_MAX_INFLIGHT', '256'))
+
+executor = ThreadPoolExecutor(max_workers=ASYNC_MAX_INFLIGHT, thread_name_prefix='aws-io')
+
+ROUTES = ('/health', '/', '/process', '/process/batch')
+
+
+class ClientDisconnected(Exception):
+    """
+    The client went away before the request body was complete
+    """
+
+
+def header(scope, name):
+    """
+    Value of a request header (name in lower case bytes), or None
+    """
+    for header_name, value in scope.get('headers', []):
+        if header_name == name:
+            return value.decode('latin-1')
+    return None
+
+
+def declared_length(scope):
+    """
+    Content-Length of the request, or None when absent or malformed
+    """
+    value = header(scope, b'content-length')
+    try:
+        return int(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+async def read_body(scope, receive, limit):
+    """
+    Read the full request body from the ASGI receive channel
+    Returns None if the body exceeds limit bytes; a too-large Content-Length
+    is rejected before any of the body is read. Raises ClientDisconnected if
+    the client disconnects mid-body, so a truncated payload is never processed
+    """
+    length = declared_length(scope)
+    if length is not None and length > limit:
+        return None
+    chunks = []
+    size = 0
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            raise ClientDisconnected()
+        chunk = message.get('body', b'')
+        size += len(chunk)
+        if size > limit:
+            return None
+        chunks.append(chunk)
+        if not message.get('more_body', False):
+            break
+    return b''.join(chunks)
+
+
+class ReceiveStream:
+    """
+    Blocking file-like view of the request body for code running on the executor
+    Each read waits for the next chunk from the event loop's receive channel, so at
+    most one chunk of the body is held at a time. Raises ClientDisconnected if the
+    client disconnects mid-body
+    """
+
+    def __init__(self, receive, loop):
+        self._receive = receive
+        self._loop = loop
+        self._buffer = b''
+        self._more = True
+
+    def _fill(self):
+        message = asyncio.run_coroutine_threadsafe(self._receive(), self._loop).result()
+        if message['type'] == 'http.disconnect':
+            self._more = False
+            raise ClientDisconnected()
+        self._buffer += message.get('body', b'')
+        self._more = message.get('more_body', False)
+
+    def _take(self, size):
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            while self._more:
+                self._fill()
+            return self._take(len(self._buffer))
+        while self._more and not self._buffer:
+            self._fill()
+        return self._take(size)
+
+    def readline(self, size=-1):
+        while self._more and b'\n' not in self._buffer and (size is None or size < 0 or len(self._buffer) < size):
+            self._fill()
+        end = self._buffer.find(b'\n') + 1 or len(self._buffer)
+        if size is not None and size >= 0:
+            end = min(end, size)
+        return self._take(end)
+
+
+def remote_address(scope):
+    """
+    Client address of the request, honouring TRUSTED_PROXY_COUNT
+    """
+    client = scope.get('client')
+    return client_address(client[0] if client else None, header(scope, b'x-forwarded-for'),
+                          wsgi_app.TRUSTED_PROXY_COUNT)
+
+
+async def send_json(send, body, status_code, headers=None):
+    """
+    Send a JSON response
+    """
+    payload = json.dumps(body).encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status_code,
+        'headers': [
+            (b'content-type', b'application/json'),
+            (b'content-length', str(len(payload)).encode())
+        ] + [(name.lower().encode(), value.encode()) for name, value in (headers or {}).items()]
+    })
+    await send({'type': 'http.response.body', 'body': payload})
+
+
+async def process_email(scope, receive):
+    """
+    Async /process handler; parsing happens on the event loop, AWS calls on the executor
+    Returns tuple: (response_body, status_code, headers)
+    """
+    # Shed excess requests here, before they wait for an executor thread
+    if not wsgi_app.concurrency_limiter.acquire():
+        return wsgi_app.overloaded()
+    try:
+        body = await read_body(scope, receive, wsgi_app.MAX_BODY_BYTES)
+        if body is None:
+            return wsgi_app.payload_too_large(wsgi_app.MAX_BODY_BYTES)
+
+        try:
+            with stage_timer('json_parse'):
+                request_data = decode_json(body)
+        except ValueError:
+            return {'status': 'error', 'message': 'Invalid JSON payload'}, 400, {}
+        if not isinstance(request_data, dict):
+            return {'status': 'error', 'message': 'Invalid JSON payload'}, 400, {}
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            executor, wsgi_app.handle_process_request, request_data, remote_address(scope)
+        )
+    finally:
+        wsgi_app.concurrency_limiter.release()
+
+
+async def process_email_batch(scope, receive):
+    """
+    Async /process/batch handler; the body is streamed from the receive channel
+    to the executor, which validates and publishes it item by item as it arrives,
+    like the WSGI app. A disconnect part way through stops reading: items already
+    queued stay queued and nothing is sent back
+    Returns tuple: (response_body, status_code, headers)
+    """
+    if not wsgi_app.concurrency_limiter.acquire():
+        return wsgi_app.overloaded()
+    try:
+        length = declared_length(scope)
+        if length is not None and length > wsgi_app.MAX_BATCH_BODY_BYTES:
+            return wsgi_app.payload_too_large(wsgi_app.MAX_BATCH_BODY_BYTES)
+
+        content_type = header(scope, b'content-type') or ''
+        ndjson = content_type.split(';')[0].strip().lower() == 'application/x-ndjson'
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            executor, wsgi_app.handle_batch_request, ReceiveStream(receive, loop), ndjson,
+            header(scope, b'x-api-token'), remote_address(scope)
+        )
+    finally:
+        wsgi_app.concurrency_limiter.release()
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            executor.shutdown(wait=True)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    """
+    ASGI entry point
+    """
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+
+    path = scope['path']
+    method = scope['method']
+    start = time.perf_counter()
+
+    if path == '/metrics' and method == 'GET':
+        payload, content_type = render_metrics()
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [(b'content-type', content_type.encode())]
+        })
+        await send({'type': 'http.response.body', 'body': payload})
+        return
+
+    headers = {}
+    try:
+        if path == '/health' and method == 'GET':
+            body, status_code = wsgi_app.health_payload(), 200
+        elif path == '/' and method == 'GET':
+            body, status_code = wsgi_app.root_payload(), 200
+        elif path == '/process' and method == 'POST':
+            body, status_code, headers = await process_email(scope, receive)
+        elif path == '/process/batch' and method == 'POST':
+            body, status_code, headers = await process_email_batch(scope, receive)
+        elif path in ROUTES:
+            body, status_code = {'status': 'error', 'message': 'Method not allowed'}, 405
+        else:
+            body, status_code = {'status': 'error', 'message': 'Not found'}, 404
+    except ClientDisconnected:
+        # Nobody is left to answer; record it the way proxies log it (499)
+        logger.info(f"Client disconnected before sending the full {method} {path} body")
+        body, status_code = None, 499
+    except Exception as e:
+        logger.error(f"Unexpected error processing request: {e}")
+        body, status_code = {'status': 'error', 'message': 'Internal server error'}, 500
+
+    if body is not None:
+        await send_json(send, body, status_code, headers)
+    endpoint = path if path in ROUTES else 'unmatched'
+    observe_request(endpoint, method, status_code, time.perf_counter() - start)
@@ -0,0 +1,121 @@
+"""
+botocore client factory
+Shared by the email microservice and the SQS processor (each service ships its own copy
+because their images are built from separate directories; keep the copies identical,
+test_app.py fails when they differ).
+
+Clients are created lazily, on first use in each process, so gunicorn workers forked
+from a preloaded master never share connection pools or sockets. Pool size, timeouts,
+TCP keepalive, retry mode and endpoint can be tuned per deployment:
+
+    AWS_MAX_POOL_CONNECTIONS       Connections per client (default: sized by the caller)
+    AWS_CONNECT_TIMEOUT_SECONDS    TCP connect timeout (default 2)
+    AWS_READ_TIMEOUT_SECONDS       Socket read timeout (default: set by the caller)
+    AWS_TCP_KEEPALIVE              Enable TCP keepalive on pooled connections (default true)
+    AWS_RETRY_MODE                 botocore retry mode: adaptive, standard or legacy (default adaptive)
+    AWS_ENDPOINT_URL[_<SERVICE>]   Endpoint override, e.g. a local stand-in for tests
+"""
+import os
+import logging
+import threading
+import boto3
+from botocore.config import Config
+
+logger = logging.getLogger(__name__)
+
+# botocore's own default pool size
+DEFAULT_POOL_CONNECTIONS = 10
+
+
+def pool_size(*concurrency):
+    """
+    Connection pool size covering the given numbers of concurrent callers
+    AWS_MAX_POOL_CONNECTIONS overrides the computed value
+    """
+    configured = os.getenv('AWS_MAX_POOL_CONNECTIONS')
+    if configured:
+        return int(configured)
+    return max(DEFAULT_POOL_CONNECTIONS, sum(concurrency))
+
+
+def endpoint_url(service_name):
+    """
+    Endpoint override for a service, if any
+    """
+    service_variable = 'AWS_ENDPOINT_URL_' + service_name.upper().replace('-', '_')
+    return os.getenv(service_variable) or os.getenv('AWS_ENDPOINT_URL') or None
+
+
+def client_config(max_pool_connections=DEFAULT_POOL_CONNECTIONS, read_timeout=60, max_attempts=None):
+    """
+    botocore Config from the environment
+
+    Args:
+        max_pool_connections (int): Connections kept per client
+        read_timeout (float): Default read timeout when AWS_READ_TIMEOUT_SECONDS is unset
+        max_attempts (int): Total attempts made by botocore, or None for the mode's default
+            (1 when the caller retries itself)
+    """
+    retries = {'mode': os.getenv('AWS_RETRY_MODE', 'adaptive')}
+    if max_attempts is not None:
+        retries['total_max_attempts'] = max_attempts
+    return Config(
+        max_pool_connections=max_pool_connections,
+        connect_timeout=float(os.getenv('AWS_CONNECT_TIMEOUT_SECONDS', '2')),
+        read_timeout=float(os.getenv('AWS_READ_TIMEOUT_SECONDS', str(read_timeout))),
+        tcp_keepalive=os.getenv('AWS_TCP_KEEPALIVE', 'true').lower() == 'true',
+        retries=retries
+    )
+
+
+class LazyClient:
+    """
+    Proxy for a boto3 client that is created on first use in each process
+    Attribute access is forwarded to the underlying client
+    """
+
+    def __init__(self, service_name, region_name, config):
+        self.service_name = service_name
+        self.region_name = region_name
+        self.config = config
+        self._client = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        """
+        The client for the current process
+        """
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._lock:
+                if self._pid != pid:
+                    # A session per process: boto3 sessions are not fork- or thread-safe to share
+                    session = boto3.session.Session()
+                    self._client = session.client(
+                        self.service_name,
+                        region_name=self.region_name,
+                        endpoint_url=endpoint_url(self.service_name),
+                        config=self.config
+                    )
+                    self._pid = pid
+                    logger.info(
+                        f"Created {self.service_name} client (pool {self.config.max_pool_connections}, "
+                        f"retry mode {self.config.retries.get('mode')})"
+                    )
+        return self._client
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+
+def create_client(service_name, region_name, max_pool_connections=DEFAULT_POOL_CONNECTIONS,
+                  read_timeout=60, max_attempts=None):
+    """
+    Lazily created, tuned boto3 client
+    """
+    return LazyClient(
+        service_name,
+        region_name,
+        client_config(max_pool_connections, read_timeout=read_timeout, max_attempts=max_attempts)
+    )
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""
+Benchmark: WSGI (gunicorn-style thread slots) vs ASGI serving of /process
+
+Both modes run in-process against a local SQS/SSM stand-in that sleeps for a
+configurable latency, so the numbers reflect how many publishes each mode can
+keep in flight rather than real AWS performance.
+
+Usage: python bench_serving.py [--requests 2000] [--latency-ms 20]
+                               [--wsgi-slots 8] [--concurrency 256]
+"""
+import os
+import json
+import time
+import asyncio
+import logging
+import argparse
+import threading
+import statistics
+from concurrent.futures import ThreadPoolExecutor
+
+os.environ.setdefault('SQS_QUEUE_URL', 'https://sqs.local/000000000000/bench-queue')
+os.environ.setdefault('AWS_REGION', 'us-west-1')
+
+import app as wsgi_app
+import asgi
+
+TOKEN = 'bench-token'
+PAYLOAD = json.dumps({
+    'data': {
+        'email_subject': 'Benchmark',
+        'email_sender': 'bench@example.com',
+        'email_timestream': '1693561101',
+        'email_content': 'x' * 512
+    },
+    'token': TOKEN
+}).encode('utf-8')
+
+
+class FakeSSM:
+    """SSM stand-in returning a fixed token"""
+    def get_parameter(self, Name, WithDecryption):
+        return {'Parameter': {'Value': TOKEN}}
+
+
+class FakeSQS:
+    """SQS stand-in with injected latency that counts API calls"""
+    def __init__(self, latency):
+        self.latency = latency
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def _call(self):
+        with self._lock:
+            self.calls += 1
+        time.sleep(self.latency)
+
+    def send_message(self, **kwargs):
+        self._call()
+        return {'MessageId': 'bench'}
+
+    def send_message_batch(self, QueueUrl, Entries):
+        self._call()
+        return {'Successful': [{'Id': e['Id'], 'MessageId': 'bench'} for e in Entries]}
+
+
+def summarize(name, latencies, elapsed, sqs):
+    latencies.sort()
+    p99 = latencies[int(len(latencies) * 0.99) - 1]
+    print(f"{name:<6} {len(latencies) / elapsed:>10.1f} req/s  "
+          f"p50 {statistics.median(latencies) * 1000:>8.1f} ms  "
+          f"p99 {p99 * 1000:>8.1f} ms  "
+          f"sqs calls {sqs.calls}")
+
+
+def run_wsgi(total, slots, sqs):
+    """Drive the Flask app from a fixed number of thread slots (gunicorn workers x threads)"""
+    latencies = []
+    lock = threading.Lock()
+    local = threading.local()
+
+    def one_request(_):
+        if not hasattr(local, 'client'):
+            local.client = wsgi_app.app.test_client()
+        start = time.perf_counter()
+        response = local.client.post('/process', data=PAYLOAD, content_type='application/json')
+        assert response.status_code == 200, response.data
+        with lock:
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=slots) as pool:
+        list(pool.map(one_request, range(total)))
+    return latencies, time.perf_counter() - start
+
+
+async def run_asgi(total, concurrency):
+    """Drive the ASGI app with up to `concurrency` requests in flight"""
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one_request():
+        async with semaphore:
+            sent = []
+
+            async def receive():
+                return {'type': 'http.request', 'body': PAYLOAD, 'more_body': False}
+
+            async def send(message):
+                sent.append(message)
+
+            scope = {'type': 'http', 'path': '/process', 'method': 'POST', 'client': ('127.0.0.1', 0)}
+            start = time.perf_counter()
+            await asgi.app(scope, receive, send)
+            assert sent[0]['status'] == 200, sent
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one_request() for _ in range(total)))
+    return latencies, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--latency-ms', type=float, default=20)
+    parser.add_argument('--wsgi-slots', type=int, default=8)
+    parser.add_argument('--concurrency', type=int, default=256)
+    parser.add_argument('--publish-mode', choices=['single', 'batch'], default='single')
+    args = parser.parse_args()
+
+    # Per-request INFO logging would dominate the measurement
+    logging.getLogger().setLevel(logging.WARNING)
+    wsgi_app.ssm_client = FakeSSM()
+    wsgi_app.SQS_PUBLISH_MODE = args.publish_mode
+
+    print(f"{args.requests} requests, SQS latency {args.latency_ms} ms, publish mode {args.publish_mode}")
+
+    sqs = FakeSQS(args.latency_ms / 1000.0)
+    wsgi_app.sqs_client = sqs
+    latencies, elapsed = run_wsgi(args.requests, args.wsgi_slots, sqs)
+    summarize('wsgi', latencies, elapsed, sqs)
+
+    sqs = FakeSQS(args.latency_ms / 1000.0)
+    wsgi_app.sqs_client = sqs
+    latencies, elapsed = asyncio.run(run_asgi(args.requests, args.concurrency))
+    summarize('asgi', latencies, elapsed, sqs)
+
+
+if __name__ == '__main__':
+    main()
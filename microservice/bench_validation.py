@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+Benchmark: request parsing and validation, original path vs fast path
+
+original  json.loads + validate_data_fields + validate_timestamp (kept in test_app.py)
+fast      validation.decode_json (orjson when installed) + EmailValidator
+
+Also times how long /process takes to turn away an oversized body, which the
+Content-Length check rejects before the body is read.
+
+Usage: python bench_validation.py [--iterations 2000] [--sizes 1024,65536,196608]
+"""
+import os
+import json
+import time
+import logging
+import argparse
+import statistics
+
+os.environ.setdefault('SQS_QUEUE_URL', 'https://sqs.local/000000000000/bench-queue')
+os.environ.setdefault('AWS_REGION', 'us-west-1')
+
+import app as wsgi_app
+import validation
+from test_app import validate_data_fields, validate_timestamp
+
+
+def make_body(content_size):
+    return json.dumps({
+        'data': {
+            'email_subject': 'Benchmark',
+            'email_sender': 'Bench <bench@example.com>',
+            'email_timestream': '1693561101',
+            'email_content': 'x' * content_size
+        },
+        'token': 'bench-token'
+    }).encode('utf-8')
+
+
+def original_path(body):
+    request_data = json.loads(body)
+    data = request_data.get('data')
+    is_valid, error_message = validate_data_fields(data)
+    if is_valid:
+        is_valid, error_message = validate_timestamp(data['email_timestream'])
+    return is_valid
+
+
+def fast_path(body):
+    request_data = validation.decode_json(body)
+    is_valid, _ = wsgi_app.email_validator.validate(request_data.get('data'))
+    return is_valid
+
+
+def measure(fn, body, iterations):
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        assert fn(body)
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples)
+
+
+def measure_rejection(iterations):
+    """Median time to answer /process with 413 for a body twice the limit"""
+    client = wsgi_app.app.test_client()
+    body = b'x' * (wsgi_app.MAX_BODY_BYTES * 2)
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        response = client.post('/process', data=body, content_type='application/json')
+        samples.append(time.perf_counter() - start)
+        assert response.status_code == 413, response.data
+    return statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=2000)
+    parser.add_argument('--sizes', default='1024,65536,196608',
+                        help='Comma-separated email_content sizes in bytes')
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    decoder = 'orjson' if validation.orjson is not None else 'json (orjson not installed)'
+    print(f"{args.iterations} iterations per size, fast-path decoder: {decoder}")
+
+    for size in (int(size) for size in args.sizes.split(',')):
+        body = make_body(size)
+        original = measure(original_path, body, args.iterations)
+        fast = measure(fast_path, body, args.iterations)
+        print(f"{len(body):>9} B  original {original * 1e6:>9.1f} us  "
+              f"fast {fast * 1e6:>9.1f} us  speedup {original / fast:>5.2f}x")
+
+    rejection = measure_rejection(max(args.iterations // 20, 10))
+    print(f"413 for a {wsgi_app.MAX_BODY_BYTES * 2} B body: {rejection * 1e6:.1f} us")
+
+
+if __name__ == '__main__':
+    main()
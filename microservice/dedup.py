@@ -0,0 +1,154 @@
+"""
+Ingest-side deduplication of repeated email submissions
+Upstream retries resubmit the same email, and each copy would become its own SQS
+message and S3 object. content_key() hashes the normalized email fields, and
+DedupWindow remembers the MessageId published for each key for `window` seconds, so a
+repeat is answered with the original MessageId instead of being queued again.
+
+Keys live in an in-memory LRU bounded by max_entries. An optional store (e.g.
+RedisDedupStore) shares the window across workers and pods; store errors are logged
+and the email is treated as new, so a store outage never blocks ingest. Detection is
+best effort: copies submitted at the same moment can both be queued (a FIFO queue's
+MessageDeduplicationId catches those).
+"""
+import json
+import math
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+def content_key(data):
+    """
+    Hex SHA-256 of the email fields that identify a submission
+    Surrounding whitespace, sender case and line endings are normalized so that
+    resubmissions of the same email by different clients match.
+    """
+    normalized = [
+        str(data['email_sender']).strip().lower(),
+        str(data['email_subject']).strip(),
+        str(int(data['email_timestream'])),
+        str(data['email_content']).replace('\r\n', '\n').strip()
+    ]
+    return hashlib.sha256(json.dumps(normalized).encode('utf-8')).hexdigest()
+
+
+class RedisDedupStore:
+    """
+    Dedup window shared through Redis; keys expire with the window
+
+    Args:
+        client: redis.Redis client
+        prefix (str): Prefix of the Redis keys
+    """
+
+    def __init__(self, client, prefix='email-processor:dedup:'):
+        self._client = client
+        self.prefix = prefix
+
+    def get(self, key):
+        """
+        Returns tuple: (message_id, seconds_left_in_window), or None if the key is unknown
+        """
+        pipeline = self._client.pipeline(transaction=False)
+        pipeline.get(self.prefix + key)
+        pipeline.pttl(self.prefix + key)
+        value, ttl_ms = pipeline.execute()
+        if value is None:
+            return None
+        return value.decode('utf-8'), max(ttl_ms, 0) / 1000.0
+
+    def put(self, key, message_id, ttl):
+        self._client.set(self.prefix + key, message_id, ex=max(math.ceil(ttl), 1))
+
+
+class DedupWindow:
+    """
+    Recently queued content keys and their MessageIds
+
+    Args:
+        window (float): Seconds a key is remembered
+        max_entries (int): Keys kept in memory; the oldest are evicted first
+        store: Optional shared store with get(key) -> (message_id, seconds_left) or None,
+            and put(key, message_id, ttl)
+        on_error (callable): on_error(exception) when the store fails
+        clock (callable): Time source (overridable for tests)
+    """
+
+    def __init__(self, window=300, max_entries=100000, store=None, on_error=None, clock=time.time):
+        self.window = window
+        self.max_entries = max_entries
+        self.store = store
+        self._on_error = on_error
+        self._clock = clock
+        self._entries = OrderedDict()  # key -> (message_id, queued_at), oldest first
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0}
+
+    def get(self, key):
+        """
+        MessageId the key was queued with inside the window, or None if it is new
+        Emails accepted into the spool have no MessageId yet and return ''.
+        """
+        now = self._clock()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now - entry[1] < self.window:
+                self.stats['hits'] += 1
+                return entry[0]
+        shared = None
+        if self.store is not None:
+            try:
+                shared = self.store.get(key)
+            except Exception as e:
+                self._store_failed(e)
+        with self._lock:
+            if shared is None:
+                self.stats['misses'] += 1
+                return None
+            self.stats['hits'] += 1
+            message_id, seconds_left = shared
+            # Expire locally when the shared entry does, not a full window from now
+            self._remember(key, message_id, now - self.window + seconds_left, now)
+        return message_id
+
+    def put(self, key, message_id):
+        """
+        Remember that the key was queued as message_id ('' when not known yet)
+        """
+        now = self._clock()
+        with self._lock:
+            self._remember(key, message_id, now, now)
+        if self.store is not None:
+            try:
+                self.store.put(key, message_id, self.window)
+            except Exception as e:
+                self._store_failed(e)
+
+    def _remember(self, key, message_id, queued_at, now):
+        self._entries[key] = (message_id, queued_at)
+        self._entries.move_to_end(key)
+        # Entries are in the order they were stored, so expired ones are mostly at the
+        # front; one learned from the store may expire sooner, which get() checks
+        while self._entries:
+            oldest_key, (_, oldest_at) = next(iter(self._entries.items()))
+            if len(self._entries) <= self.max_entries and now - oldest_at < self.window:
+                break
+            del self._entries[oldest_key]
+
+    def _store_failed(self, error):
+        logger.warning(f"Dedup store unavailable, treating email as new: {error}")
+        if self._on_error is not None:
+            self._on_error(error)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.stats, keys=len(self._entries), window=self.window, shared=self.store is not None)
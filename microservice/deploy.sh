@@ -78,17 +78,25 @@ aws ssm put-parameter \
     --overwrite \
     --region us-west-1 2>/dev/null || echo "Token already exists or created successfully"
 
-# Step 7: Update ConfigMap with correct values
-echo -e "${YELLOW}Step 7: Updating Kubernetes ConfigMap...${NC}"
+# Step 7: Let the service account role write claim-check objects (CLAIM_CHECK_BUCKET)
+echo -e "${YELLOW}Step 7: Granting S3 access for claim checks...${NC}"
+aws iam put-role-policy \
+    --role-name email-processor-role \
+    --policy-name EmailProcessorClaimCheck \
+    --policy-document file://claim-check-iam-policy.json 2>/dev/null || \
+    echo "Role email-processor-role not found; attach claim-check-iam-policy.json to the service account role before setting CLAIM_CHECK_BUCKET"
+
+# Step 8: Update ConfigMap with correct values
+echo -e "${YELLOW}Step 8: Updating Kubernetes ConfigMap...${NC}"
 sed -i.bak "s|ACCOUNT_ID|${AWS_ACCOUNT_ID}|g" k8s/configmap.yaml
 sed -i.bak "s|ACCOUNT_ID|${AWS_ACCOUNT_ID}|g" k8s/serviceaccount.yaml
 
-# Step 8: Update Deployment with correct image
-echo -e "${YELLOW}Step 8: Updating Deployment configuration...${NC}"
+# Step 9: Update Deployment with correct image
+echo -e "${YELLOW}Step 9: Updating Deployment configuration...${NC}"
 sed -i.bak "s|<ECR_REGISTRY>|${ECR_REGISTRY}|g" k8s/deployment.yaml
 
-# Step 9: Apply Kubernetes manifests
-echo -e "${YELLOW}Step 9: Applying Kubernetes manifests...${NC}"
+# Step 10: Apply Kubernetes manifests
+echo -e "${YELLOW}Step 10: Applying Kubernetes manifests...${NC}"
 
 kubectl apply -f k8s/namespace.yaml
 kubectl apply -f k8s/configmap.yaml
@@ -104,8 +112,8 @@ else
     exit 1
 fi
 
-# Step 10: Wait for deployment to be ready
-echo -e "${YELLOW}Step 10: Waiting for deployment to be ready...${NC}"
+# Step 11: Wait for deployment to be ready
+echo -e "${YELLOW}Step 11: Waiting for deployment to be ready...${NC}"
 kubectl rollout status deployment/email-processor -n email-processor --timeout=300s
 
 if [ $? -eq 0 ]; then
@@ -115,8 +123,8 @@ else
     exit 1
 fi
 
-# Step 11: Get service information
-echo -e "${YELLOW}Step 11: Getting service information...${NC}"
+# Step 12: Get service information
+echo -e "${YELLOW}Step 12: Getting service information...${NC}"
 echo ""
 echo -e "${GREEN}Deployment completed successfully!${NC}"
 echo ""
@@ -0,0 +1,30 @@
+"""
+Gunicorn configuration
+Prepares the Prometheus multi-process directory shared by all workers and
+starts per-worker background work that must not wait for the first request
+"""
+import os
+import glob
+
+
+def on_starting(server):
+    """Remove metric files left over from a previous run"""
+    multiproc_dir = os.getenv('PROMETHEUS_MULTIPROC_DIR')
+    if multiproc_dir:
+        os.makedirs(multiproc_dir, exist_ok=True)
+        for path in glob.glob(os.path.join(multiproc_dir, '*.db')):
+            os.remove(path)
+
+
+def child_exit(server, worker):
+    """Drop live gauges of a worker that exited"""
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
+
+
+def post_worker_init(worker):
+    """Open the worker's spool and start forwarding anything left in it"""
+    if os.getenv('SQS_PUBLISH_MODE') == 'spool':
+        import app
+        app.sqs_spool.start()
@@ -0,0 +1,162 @@
+"""
+Prometheus metrics for the Email Processing Microservice
+Multi-process safe: when PROMETHEUS_MULTIPROC_DIR is set (gunicorn), every
+worker writes its samples there and /metrics aggregates all workers.
+"""
+import os
+import time
+from contextlib import contextmanager
+from prometheus_client import (
+    Counter, Gauge, Histogram, CollectorRegistry, REGISTRY, CONTENT_TYPE_LATEST, generate_latest, multiprocess
+)
+
+# Request latency buckets tuned for a service whose hot path is one SQS call
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+REQUEST_COUNT = Counter(
+    'email_processor_requests_total',
+    'HTTP requests by endpoint, method and status',
+    ['endpoint', 'method', 'status']
+)
+
+REQUEST_LATENCY = Histogram(
+    'email_processor_request_duration_seconds',
+    'HTTP request latency by endpoint, method and status',
+    ['endpoint', 'method', 'status'],
+    buckets=LATENCY_BUCKETS
+)
+
+STAGE_LATENCY = Histogram(
+    'email_processor_stage_duration_seconds',
+    'Time spent in each /process stage (json_parse, token_validation, field_validation, dedup, sqs_publish, spool_append)',
+    ['stage'],
+    buckets=LATENCY_BUCKETS
+)
+
+AWS_ERRORS = Counter(
+    'email_processor_aws_errors_total',
+    'AWS API errors by service, operation and error code',
+    ['service', 'operation', 'code']
+)
+
+AWS_RETRIES = Counter(
+    'email_processor_aws_retries_total',
+    'AWS calls retried by the resilience layer, by service and error code',
+    ['service', 'code']
+)
+
+CIRCUIT_BREAKER_OPENS = Counter(
+    'email_processor_circuit_breaker_opens_total',
+    'Times a dependency circuit breaker opened',
+    ['service']
+)
+
+# 0 = closed, 1 = half open, 2 = open; the worst live worker is reported
+CIRCUIT_BREAKER_STATE = Gauge(
+    'email_processor_circuit_breaker_state',
+    'Circuit breaker state by dependency (0 closed, 1 half open, 2 open)',
+    ['service'],
+    multiprocess_mode='livemax'
+)
+BREAKER_STATE_VALUES = {'closed': 0, 'half_open': 1, 'open': 2}
+
+PAYLOAD_ENCODINGS = Counter(
+    'email_processor_payload_encodings_total',
+    'Published message bodies by encoding (plain, gzip+base64, s3-claim-check)',
+    ['encoding']
+)
+
+
+REQUESTS_LIMITED = Counter(
+    'email_processor_requests_limited_total',
+    'Requests turned away by admission control (sender, client or concurrency limit)',
+    ['reason']
+)
+
+RATE_LIMIT_BACKEND_ERRORS = Counter(
+    'email_processor_rate_limit_backend_errors_total',
+    'Failed shared rate limit checks (requests allowed on local limits only)'
+)
+
+DUPLICATE_EMAILS = Counter(
+    'email_processor_duplicate_emails_total',
+    'Submissions answered from the dedup window instead of being queued again'
+)
+
+DEDUP_STORE_ERRORS = Counter(
+    'email_processor_dedup_store_errors_total',
+    'Failed shared dedup store calls (emails treated as new)'
+)
+
+SPOOL_MESSAGES = Counter(
+    'email_processor_spool_messages_total',
+    'Messages handled by the local spool (accepted, rejected, forwarded, dropped)',
+    ['outcome']
+)
+
+SPOOL_PENDING = Gauge(
+    'email_processor_spool_pending_messages',
+    'Messages spooled locally and not yet forwarded to SQS',
+    multiprocess_mode='livesum'
+)
+
+SPOOL_BYTES = Gauge(
+    'email_processor_spool_bytes',
+    'Disk used by unforwarded spool segments',
+    multiprocess_mode='livesum'
+)
+
+
+@contextmanager
+def stage_timer(stage):
+    """Time a block of the request hot path"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_LATENCY.labels(stage=stage).observe(time.perf_counter() - start)
+
+
+def observe_request(endpoint, method, status, duration):
+    """Record one finished HTTP request"""
+    REQUEST_COUNT.labels(endpoint=endpoint, method=method, status=str(status)).inc()
+    REQUEST_LATENCY.labels(endpoint=endpoint, method=method, status=str(status)).observe(duration)
+
+
+def record_aws_error(service, operation, error):
+    """Count a botocore ClientError (or an error code string) by its AWS error code"""
+    if isinstance(error, str):
+        code = error
+    else:
+        code = getattr(error, 'response', {}).get('Error', {}).get('Code', type(error).__name__)
+    AWS_ERRORS.labels(service=service, operation=operation, code=code).inc()
+
+
+def record_retry(service, code):
+    """Count one retried AWS call"""
+    AWS_RETRIES.labels(service=service, code=code).inc()
+
+
+def record_breaker_state(service, state):
+    """Export a circuit breaker state change"""
+    CIRCUIT_BREAKER_STATE.labels(service=service).set(BREAKER_STATE_VALUES[state])
+    if state == 'open':
+        CIRCUIT_BREAKER_OPENS.labels(service=service).inc()
+
+
+def record_spool(snapshot):
+    """Update the spool gauges from a spool snapshot"""
+    SPOOL_PENDING.set(snapshot.get('pending', 0))
+    SPOOL_BYTES.set(snapshot.get('bytes', 0))
+
+
+def render_metrics():
+    """
+    Return (body, content_type) for the /metrics endpoint
+    """
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
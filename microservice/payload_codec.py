@@ -0,0 +1,123 @@
+"""
+Compression and S3 claim checks for SQS message bodies
+Shared by the email microservice and the SQS processor (each service ships its own copy
+because their images are built from separate directories; keep the copies identical,
+test_app.py fails when they differ).
+
+Bodies above a size threshold are gzip-compressed and base64-encoded. Bodies that are
+still too large once compressed are stored in S3 and replaced by a small claim-check
+pointer. The encoding is named in the PayloadEncoding message attribute, so messages
+without it (small bodies, older publishers) are plain JSON and pass through unchanged.
+"""
+import gzip
+import json
+import uuid
+import base64
+from datetime import datetime
+
+ENCODING_ATTRIBUTE = 'PayloadEncoding'
+GZIP = 'gzip+base64'
+CLAIM_CHECK = 's3-claim-check'
+
+# SQS rejects messages (body plus attributes) over 256 KiB
+SQS_MAX_MESSAGE_BYTES = 256 * 1024
+
+
+class PayloadTooLargeError(Exception):
+    """
+    Raised when a body does not fit in an SQS message and no claim-check bucket is configured
+    """
+
+
+def compress(body):
+    """
+    gzip and base64 a text body
+    """
+    return base64.b64encode(gzip.compress(body.encode('utf-8'))).decode('ascii')
+
+
+def decompress(encoded):
+    """
+    Inverse of compress()
+    """
+    return gzip.decompress(base64.b64decode(encoded)).decode('utf-8')
+
+
+def encoding_attribute(encoding):
+    """
+    Message attribute naming a body encoding
+    """
+    return {'DataType': 'String', 'StringValue': encoding}
+
+
+def message_encoding(message):
+    """
+    Body encoding of a received SQS message, or None for plain bodies
+    """
+    attribute = message.get('MessageAttributes', {}).get(ENCODING_ATTRIBUTE)
+    return attribute.get('StringValue') if attribute else None
+
+
+def decode_body(body, encoding, fetch):
+    """
+    Original text of an encoded message body
+
+    Args:
+        body (str): SQS message body
+        encoding (str): Value of the PayloadEncoding attribute, or None
+        fetch (callable): fetch(bucket, key) -> bytes, reads a claim-check object
+    """
+    if encoding is None:
+        return body
+    if encoding == GZIP:
+        return decompress(body)
+    if encoding == CLAIM_CHECK:
+        pointer = json.loads(body)['claim_check']
+        return gzip.decompress(fetch(pointer['bucket'], pointer['key'])).decode('utf-8')
+    raise ValueError(f"Unknown payload encoding: {encoding}")
+
+
+class PayloadEncoder:
+    """
+    Chooses the encoding of outgoing message bodies
+
+    Args:
+        compress_threshold (int): Bodies of at least this many bytes are compressed
+        claim_check_threshold (int): Bodies still over this many bytes after compression
+            are stored in S3
+        put_object (callable): put_object(bucket, key, body_bytes) writing a claim-check object
+        bucket (str): Claim-check bucket, or None to reject bodies over the threshold
+        key_prefix (str): S3 prefix for claim-check objects
+    """
+
+    def __init__(self, compress_threshold=8192, claim_check_threshold=200 * 1024, put_object=None,
+                 bucket=None, key_prefix='claim-checks/'):
+        self.compress_threshold = compress_threshold
+        self.claim_check_threshold = claim_check_threshold
+        self._put_object = put_object
+        self.bucket = bucket
+        self.key_prefix = key_prefix
+
+    def encode(self, body):
+        """
+        Returns tuple: (message_body, encoding or None)
+        Raises PayloadTooLargeError if the body cannot be sent
+        """
+        size = len(body.encode('utf-8'))
+        if size < self.compress_threshold and size <= self.claim_check_threshold:
+            return body, None
+
+        compressed = gzip.compress(body.encode('utf-8'))
+        encoded = base64.b64encode(compressed).decode('ascii')
+        if len(encoded) <= self.claim_check_threshold:
+            return encoded, GZIP
+
+        if not self.bucket or self._put_object is None:
+            raise PayloadTooLargeError(
+                f"Message body is {size} bytes ({len(encoded)} compressed), "
+                f"over the {self.claim_check_threshold} byte limit"
+            )
+        key = f"{self.key_prefix}{datetime.utcnow().strftime('%Y/%m/%d')}/{uuid.uuid4()}.json.gz"
+        self._put_object(self.bucket, key, compressed)
+        pointer = {'claim_check': {'bucket': self.bucket, 'key': key, 'size': size}}
+        return json.dumps(pointer), CLAIM_CHECK
@@ -0,0 +1,238 @@
+"""
+Admission control for /process
+TokenBucketLimiter keeps a token bucket per key (sender, client address) in process
+memory: every lookup is O(1) and the number of keys is bounded, with idle and least
+recently used keys evicted first. RedisTokenBucketLimiter keeps the same buckets in
+Redis so a limit holds across gunicorn workers and pods; RateLimiter checks the local
+buckets first, so keys already over their limit are rejected without a Redis round
+trip. ConcurrencyLimiter caps the requests a worker has in flight, so bursts are shed
+before they queue up on SSM and SQS calls.
+"""
+import re
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+try:
+    import redis
+except ImportError:  # Shared limits need the redis package; local limits work without it
+    redis = None
+
+logger = logging.getLogger(__name__)
+
+# Address part of "Display Name <address>"
+_BRACKETED_ADDRESS = re.compile(r'<([^<>]+)>\s*$')
+
+
+def sender_key(sender):
+    """
+    Rate-limit key for an email_sender value: the address when there is one, case-folded
+    """
+    match = _BRACKETED_ADDRESS.search(sender)
+    return (match.group(1) if match else sender).strip().lower()
+
+
+def client_address(remote_addr, forwarded_for=None, trusted_proxies=0):
+    """
+    Address of the client behind trusted_proxies reverse proxies (e.g. 1 for the ALB)
+    Each proxy appends the address it received the request from to X-Forwarded-For,
+    so the client is the entry trusted_proxies from the end; anything before it
+    could have been sent by the client itself.
+    """
+    if trusted_proxies <= 0 or not forwarded_for:
+        return remote_addr
+    hops = [hop.strip() for hop in forwarded_for.split(',') if hop.strip()]
+    if len(hops) < trusted_proxies:
+        return remote_addr
+    return hops[-trusted_proxies]
+
+
+class TokenBucketLimiter:
+    """
+    In-process token buckets, one per key
+
+    Args:
+        rate (float): Tokens added per second
+        burst (float): Bucket capacity
+        max_keys (int): Most keys tracked; the least recently used are evicted
+        clock (callable): Monotonic time source (overridable for tests)
+    """
+
+    def __init__(self, rate, burst, max_keys=100000, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._clock = clock
+        # A bucket idle this long is full again, so forgetting it changes nothing
+        self._idle_after = burst / rate
+        self._buckets = OrderedDict()  # key -> [tokens, last_update], oldest first
+        self._lock = threading.Lock()
+        self.stats = {'allowed': 0, 'limited': 0, 'evicted': 0}
+
+    def acquire(self, key, cost=1):
+        """
+        Take cost tokens from the key's bucket
+        Returns 0 when allowed, otherwise the seconds until enough tokens are available
+        """
+        now = self._clock()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [self.burst, now]
+            else:
+                self._buckets.move_to_end(key)
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+
+            if bucket[0] >= cost:
+                bucket[0] -= cost
+                retry_after = 0
+                self.stats['allowed'] += 1
+            else:
+                retry_after = (cost - bucket[0]) / self.rate
+                self.stats['limited'] += 1
+
+            # Drop the least recently used key if it is idle (or over max_keys)
+            oldest_key, (_, last_update) = next(iter(self._buckets.items()))
+            if len(self._buckets) > self.max_keys or (
+                    oldest_key != key and now - last_update >= self._idle_after):
+                del self._buckets[oldest_key]
+                self.stats['evicted'] += 1
+        return retry_after
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.stats, keys=len(self._buckets))
+
+
+# Token bucket update done atomically in Redis; the bucket expires once it would be full
+# again. Returns the retry delay as a string because Redis truncates Lua numbers to integers.
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(bucket[1]) or burst
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local retry_after = 0
+if tokens >= cost then
+    tokens = tokens - cost
+else
+    retry_after = (cost - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000) + 1000)
+return tostring(retry_after)
+"""
+
+
+class RedisTokenBucketLimiter:
+    """
+    Token buckets shared through Redis
+
+    Args:
+        client: redis.Redis client
+        rate (float): Tokens added per second
+        burst (float): Bucket capacity
+        prefix (str): Prefix of the Redis keys
+    """
+
+    def __init__(self, client, rate, burst, prefix):
+        self.rate = rate
+        self.burst = burst
+        self.prefix = prefix
+        self._script = client.register_script(TOKEN_BUCKET_SCRIPT)
+
+    def acquire(self, key, cost=1):
+        """
+        Returns 0 when allowed, otherwise the seconds until enough tokens are available
+        """
+        return float(self._script(keys=[self.prefix + key], args=[self.rate, self.burst, cost]))
+
+
+def redis_client(url, timeout, setting='RATE_LIMIT_REDIS_URL', fallback='rate limits apply per worker process'):
+    """
+    Redis client for shared state, or None when the redis package is missing
+    setting and fallback name the environment variable and what happens without Redis in the warning
+    """
+    if redis is None:
+        logger.warning(f"{setting} is set but the redis package is not installed; {fallback}")
+        return None
+    return redis.Redis.from_url(url, socket_timeout=timeout, socket_connect_timeout=timeout)
+
+
+class RateLimiter:
+    """
+    Local token buckets in front of an optional shared backend
+
+    A key is rejected locally when this process alone has used up its limit; otherwise
+    the shared backend decides. If the backend fails the request is allowed (the local
+    bucket still applies), so a Redis outage cannot take /process down.
+
+    Args:
+        local (TokenBucketLimiter): Per-process buckets
+        shared (RedisTokenBucketLimiter): Cluster-wide buckets, or None
+        on_error (callable): on_error(exception) when the shared backend fails
+    """
+
+    def __init__(self, local, shared=None, on_error=None):
+        self.local = local
+        self.shared = shared
+        self._on_error = on_error
+
+    def acquire(self, key, cost=1):
+        retry_after = self.local.acquire(key, cost)
+        if retry_after or self.shared is None:
+            return retry_after
+        try:
+            return self.shared.acquire(key, cost)
+        except Exception as e:
+            logger.warning(f"Shared rate limit check failed, allowing request: {e}")
+            if self._on_error is not None:
+                self._on_error(e)
+            return 0
+
+    def clear(self):
+        self.local.clear()
+
+    def snapshot(self):
+        return dict(self.local.snapshot(), shared=self.shared is not None)
+
+
+class ConcurrencyLimiter:
+    """
+    Non-blocking cap on requests in flight; acquire() fails instead of queueing
+
+    Args:
+        limit (int): Most requests admitted at once (0 disables the limit)
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self._in_flight = 0
+        self._lock = threading.Lock()
+        self.rejected = 0
+
+    def acquire(self):
+        with self._lock:
+            if self.limit and self._in_flight >= self.limit:
+                self.rejected += 1
+                return False
+            self._in_flight += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self._in_flight -= 1
+
+    def snapshot(self):
+        with self._lock:
+            return {'limit': self.limit, 'in_flight': self._in_flight, 'rejected': self.rejected}
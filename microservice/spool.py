@@ -0,0 +1,545 @@
+"""
+Durable local spool for SQS_PUBLISH_MODE=spool
+Validated messages are appended to an on-disk write-ahead log and acknowledged once
+fsynced; a background forwarder sends them to SQS in log order with SendMessageBatch.
+Client latency no longer depends on SQS latency, and messages accepted during an SQS
+outage are delivered when it recovers, including after a restart.
+
+Layout: each gunicorn worker claims its own slot directory under the spool root
+(worker-0, worker-1, ... guarded by an flock), holding numbered append-only segment
+files and a checkpoint of the last forwarded position. Fully forwarded segments are
+deleted. Records are framed as (length, crc32, payload) so a torn write at the end
+of a segment after a crash is detected and skipped.
+"""
+import os
+import json
+import time
+import fcntl
+import random
+import struct
+import logging
+import threading
+import zlib
+
+from resilience import CircuitOpenError
+from sqs_batcher import MAX_BATCH_ENTRIES, MAX_BATCH_BYTES
+
+logger = logging.getLogger(__name__)
+
+HEADER = struct.Struct('>II')  # payload length, crc32
+CHECKPOINT = 'checkpoint.json'
+
+
+class SpoolFullError(Exception):
+    """
+    Raised when accepting a message would take the spool over its size limit,
+    or when the spool can no longer write to disk
+    """
+
+
+def segment_name(sequence):
+    return f"segment-{sequence:012d}.log"
+
+
+def segment_sequence(name):
+    return int(name[len('segment-'):-len('.log')])
+
+
+def claim_slot(root):
+    """
+    Lock the first free worker slot directory under root
+    Returns tuple: (slot_directory, lock_file); the lock is held while the file is open
+    """
+    os.makedirs(root, exist_ok=True)
+    slot = 0
+    while True:
+        directory = os.path.join(root, f'worker-{slot}')
+        os.makedirs(directory, exist_ok=True)
+        lock_file = open(os.path.join(directory, 'lock'), 'w')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return directory, lock_file
+        except BlockingIOError:
+            lock_file.close()
+            slot += 1
+
+
+def scan_records(path, offset=0):
+    """
+    Count the intact records of a segment from offset
+    Returns tuple: (record_count, end_offset_of_last_intact_record)
+    """
+    count = 0
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        while True:
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size:
+                break
+            length, crc = HEADER.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                break
+            count += 1
+            offset += HEADER.size + length
+    return count, offset
+
+
+class Spool:
+    """
+    Append-only segmented log with group commit
+
+    Args:
+        directory (str): Slot directory owned by this process
+        max_bytes (int): Total size of unforwarded segments before appends are refused
+        segment_bytes (int): Size at which a new segment file is started
+        fsync_interval (float): How long the syncer waits to gather more appends
+            into one fsync (0 syncs as soon as anything is pending)
+
+    A failed write or fsync breaks the spool: what the failed call left in the
+    segment (and in the page cache) is unknown, so appends waiting for it and
+    every later append raise SpoolFullError, while records made durable before
+    the failure are still forwarded.
+    """
+
+    def __init__(self, directory, max_bytes=256 * 1024 * 1024, segment_bytes=16 * 1024 * 1024,
+                 fsync_interval=0.005):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        self.fsync_interval = fsync_interval
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._sizes = {}
+        self._written_seq = 0
+        self._synced_seq = 0
+        self._error = None
+        self.stats = {'appended': 0, 'forwarded': 0, 'rejected': 0, 'fsyncs': 0}
+        self._recover()
+        self._syncer = threading.Thread(target=self._run_syncer, name='spool-fsync', daemon=True)
+        self._syncer.start()
+
+    def _recover(self):
+        """
+        Resume from the checkpoint: older segments are deleted, the rest are forwarded
+        before anything appended from now on, which goes to a new segment
+        """
+        segments = sorted(
+            segment_sequence(name) for name in os.listdir(self.directory)
+            if name.startswith('segment-') and name.endswith('.log')
+        )
+        read_segment, read_offset = (segments[0] if segments else 1), 0
+        checkpoint_path = os.path.join(self.directory, CHECKPOINT)
+        if os.path.exists(checkpoint_path):
+            with open(checkpoint_path) as f:
+                checkpoint = json.load(f)
+            read_segment, read_offset = checkpoint['segment'], checkpoint['offset']
+
+        self.pending = 0
+        for sequence in segments:
+            path = os.path.join(self.directory, segment_name(sequence))
+            if sequence < read_segment:
+                os.remove(path)
+                continue
+            self._sizes[sequence] = os.path.getsize(path)
+            count, _ = scan_records(path, read_offset if sequence == read_segment else 0)
+            self.pending += count
+        if self.pending:
+            logger.info(f"Recovered {self.pending} unforwarded message(s) from spool {self.directory}")
+
+        self._read = (read_segment, read_offset)
+        self._read_file = None
+        self._read_file_segment = None
+        self._write_segment = max([read_segment] + list(self._sizes)) + 1
+        self._write_file = open(os.path.join(self.directory, segment_name(self._write_segment)), 'ab')
+        self._sizes[self._write_segment] = 0
+        # Everything before the new write segment is already on disk
+        self._durable = (self._write_segment, 0)
+        self._fsync_directory()
+
+    def _fsync_directory(self):
+        fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def size(self):
+        """
+        Bytes held by unforwarded segments
+        """
+        with self._cond:
+            return sum(self._sizes.values())
+
+    def append_many(self, payloads):
+        """
+        Append records and wait until they are fsynced
+        Raises SpoolFullError if they would exceed max_bytes
+        """
+        frames = b''.join(HEADER.pack(len(payload), zlib.crc32(payload)) + payload for payload in payloads)
+        with self._cond:
+            if self._stopped:
+                raise SpoolFullError('Spool is closed')
+            if self._error is not None:
+                raise SpoolFullError(f"Spool cannot write to disk: {self._error}") from self._error
+            if sum(self._sizes.values()) + len(frames) > self.max_bytes:
+                self.stats['rejected'] += len(payloads)
+                raise SpoolFullError(f"Spool holds {sum(self._sizes.values())} of {self.max_bytes} bytes")
+            try:
+                if self._sizes[self._write_segment] and self._sizes[self._write_segment] + len(frames) > self.segment_bytes:
+                    self._roll()
+                self._write_file.write(frames)
+            except OSError as e:
+                self._break(e)
+                raise SpoolFullError(f"Spool cannot write to disk: {e}") from e
+            self._sizes[self._write_segment] += len(frames)
+            self._written_seq += 1
+            target = self._written_seq
+            self.pending += len(payloads)
+            self.stats['appended'] += len(payloads)
+            self._cond.notify_all()
+            while self._synced_seq < target and not self._stopped and self._error is None:
+                self._cond.wait()
+            if self._synced_seq < target and self._error is not None:
+                raise SpoolFullError(f"Spool cannot write to disk: {self._error}") from self._error
+
+    def append(self, payload):
+        self.append_many([payload])
+
+    def _roll(self):
+        """
+        Start a new segment; the old one is fsynced first (called with the lock held)
+        """
+        self._sync_locked()
+        self._write_file.close()
+        self._write_segment += 1
+        self._write_file = open(os.path.join(self.directory, segment_name(self._write_segment)), 'ab')
+        self._sizes[self._write_segment] = 0
+        self._fsync_directory()
+
+    def _sync_locked(self):
+        self._write_file.flush()
+        os.fsync(self._write_file.fileno())
+        self.stats['fsyncs'] += 1
+        self._synced_seq = self._written_seq
+        self._durable = (self._write_segment, self._sizes[self._write_segment])
+        self._cond.notify_all()
+
+    def _break(self, error):
+        """
+        Record a failed write or fsync and wake everyone waiting on it (called with the lock held)
+        """
+        logger.error(f"Spool {self.directory} failed to write to disk, refusing new messages: {error}")
+        self._error = error
+        self._cond.notify_all()
+
+    def _run_syncer(self):
+        while True:
+            with self._cond:
+                while self._synced_seq == self._written_seq and not self._stopped:
+                    self._cond.wait()
+                if self._stopped or self._error is not None:
+                    return
+            if self.fsync_interval:
+                # Group commit: let concurrent appends join this fsync
+                time.sleep(self.fsync_interval)
+            with self._cond:
+                if self._synced_seq != self._written_seq and self._error is None:
+                    try:
+                        self._sync_locked()
+                    except OSError as e:
+                        self._break(e)
+                        return
+
+    def read_batch(self, max_records, max_bytes, timeout=1.0):
+        """
+        Read up to max_records fsynced records (and at most max_bytes of payload) after
+        the read position, waiting up to timeout for some to arrive
+        Returns tuple: (payloads, position after them) to pass to commit()
+        """
+        with self._cond:
+            if self._read >= self._durable and not self._stopped:
+                self._cond.wait(timeout)
+            durable = self._durable
+
+        payloads = []
+        total = 0
+        segment, offset = self._read
+        while len(payloads) < max_records and (segment, offset) < durable:
+            limit = durable[1] if segment == durable[0] else self._sizes.get(segment, 0)
+            if offset >= limit:
+                segment, offset = segment + 1, 0
+                continue
+            if self._read_file is None or self._read_file_segment != segment:
+                if self._read_file is not None:
+                    self._read_file.close()
+                self._read_file = open(os.path.join(self.directory, segment_name(segment)), 'rb')
+                self._read_file_segment = segment
+            self._read_file.seek(offset)
+            header = self._read_file.read(HEADER.size)
+            length, crc = HEADER.unpack(header) if len(header) == HEADER.size else (None, None)
+            payload = self._read_file.read(length) if length is not None and offset + HEADER.size + length <= limit else b''
+            if length is None or len(payload) != length or zlib.crc32(payload) != crc:
+                logger.error(f"Skipping damaged tail of spool segment {segment} at offset {offset}")
+                segment, offset = segment + 1, 0
+                continue
+            if payloads and total + length > max_bytes:
+                break
+            payloads.append(payload)
+            total += length
+            offset += HEADER.size + length
+
+        self._read = (segment, offset)
+        return payloads, (segment, offset)
+
+    def commit(self, position, count):
+        """
+        Record that everything before position has been forwarded
+        """
+        checkpoint_path = os.path.join(self.directory, CHECKPOINT)
+        with open(checkpoint_path + '.tmp', 'w') as f:
+            json.dump({'segment': position[0], 'offset': position[1]}, f)
+        os.replace(checkpoint_path + '.tmp', checkpoint_path)
+
+        with self._cond:
+            self.pending -= count
+            self.stats['forwarded'] += count
+            finished = [sequence for sequence in self._sizes if sequence < position[0]]
+            for sequence in finished:
+                del self._sizes[sequence]
+        for sequence in finished:
+            if self._read_file is not None and self._read_file_segment == sequence:
+                self._read_file.close()
+                self._read_file = None
+            os.remove(os.path.join(self.directory, segment_name(sequence)))
+
+    def wake(self):
+        """
+        Wake a reader blocked in read_batch()
+        """
+        with self._cond:
+            self._cond.notify_all()
+
+    @property
+    def read_position(self):
+        """
+        (segment, offset) of the next record read_batch() returns
+        """
+        return self._read
+
+    def rewind(self, position):
+        """
+        Move the read position back, so records read but not forwarded are read again
+        """
+        self._read = position
+
+    def snapshot(self):
+        with self._cond:
+            return dict(self.stats, pending=self.pending, bytes=sum(self._sizes.values()),
+                        segments=len(self._sizes), broken=self._error is not None)
+
+    def close(self):
+        with self._cond:
+            if self._stopped:
+                return
+            if self._synced_seq != self._written_seq and self._error is None:
+                try:
+                    self._sync_locked()
+                except OSError as e:
+                    self._break(e)
+            self._stopped = True
+            self._write_file.close()
+            self._cond.notify_all()
+
+
+class SpoolForwarder:
+    """
+    Sends spooled messages to SQS in spool order, one SendMessageBatch at a time
+
+    Entries SQS rejects as sender faults (e.g. an invalid body) are dropped and
+    logged; every other failure is retried with capped, jittered backoff until the
+    batch is delivered, so a long SQS outage only delays delivery. Records that
+    cannot be decoded are dropped and logged too, so one corrupt record never
+    stops forwarding.
+
+    Args:
+        spool (Spool): Spool to drain
+        send_batch (callable): send_batch(entries) -> SendMessageBatch response
+        base_delay (float): Initial retry backoff in seconds
+        max_delay (float): Maximum retry backoff in seconds
+        on_forwarded (callable): on_forwarded(delivered, dropped, spool_snapshot) after each batch
+    """
+
+    def __init__(self, spool, send_batch, base_delay=0.1, max_delay=5.0, on_forwarded=None):
+        self.spool = spool
+        self._send_batch = send_batch
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._on_forwarded = on_forwarded
+        self._stop = threading.Event()
+        self.dropped = 0
+        self._thread = threading.Thread(target=self._run, name='spool-forwarder', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        delay = self.base_delay
+        while not self._stop.is_set():
+            start = self.spool.read_position
+            try:
+                self._forward_batch(start)
+                delay = self.base_delay
+            except Exception as e:
+                # e.g. an I/O error reading a segment: retry from the same position
+                logger.error(f"Spool forwarder error, retrying in {delay:.1f}s: {e}")
+                self.spool.rewind(start)
+                self._stop.wait(delay)
+                delay = min(self.max_delay, delay * 2)
+
+    def _forward_batch(self, start):
+        """Read, send and commit the next batch of spooled records"""
+        # A record's framed JSON is never smaller than its batch entry, so reading
+        # at most MAX_BATCH_BYTES keeps the SendMessageBatch call within limits
+        payloads, position = self.spool.read_batch(MAX_BATCH_ENTRIES, MAX_BATCH_BYTES)
+        if not payloads:
+            return
+        entries = []
+        corrupt = 0
+        for payload in payloads:
+            try:
+                record = json.loads(payload)
+                entries.append(dict(record.get('fields', {}), Id=str(len(entries)), MessageBody=record['body'],
+                                    MessageAttributes=record['attributes']))
+            except (ValueError, TypeError, KeyError, AttributeError) as e:
+                corrupt += 1
+                logger.error(f"Dropping spooled record that cannot be decoded ({e}): {payload[:200]!r}")
+        outcome = self._deliver(entries) if entries else (0, 0)
+        if outcome is None:
+            self.spool.rewind(start)
+            return
+        delivered, dropped = outcome
+        self.dropped += corrupt
+        self.spool.commit(position, len(payloads))
+        if self._on_forwarded is not None:
+            try:
+                self._on_forwarded(delivered, dropped + corrupt, self.spool.snapshot())
+            except Exception as e:
+                logger.error(f"Error reporting spool forwarding progress: {e}")
+
+    def _deliver(self, entries):
+        """
+        Send entries until each one is delivered or dropped
+        Returns tuple: (delivered, dropped), or None if stopped first
+        """
+        pending = {entry['Id']: entry for entry in entries}
+        delivered = dropped = 0
+        delay = self.base_delay
+        while pending:
+            if self._stop.is_set():
+                return None
+            try:
+                response = self._send_batch(list(pending.values()))
+            except CircuitOpenError as e:
+                self._stop.wait(e.retry_after)
+                continue
+            except Exception as e:
+                logger.warning(f"Spool forwarding failed, retrying in {delay:.1f}s: {e}")
+                self._stop.wait(delay)
+                delay = min(self.max_delay, random.uniform(self.base_delay, delay * 3))
+                continue
+            for success in response.get('Successful', []):
+                if pending.pop(success['Id'], None) is not None:
+                    delivered += 1
+            retry = False
+            for failure in response.get('Failed', []):
+                if failure.get('SenderFault'):
+                    pending.pop(failure['Id'], None)
+                    dropped += 1
+                    logger.error(f"Dropping spooled message rejected by SQS: "
+                                 f"{failure.get('Code')}: {failure.get('Message', '')}")
+                else:
+                    retry = True
+            if pending and retry:
+                self._stop.wait(delay)
+                delay = min(self.max_delay, random.uniform(self.base_delay, delay * 3))
+        self.dropped += dropped
+        return delivered, dropped
+
+    def stop(self, timeout=5):
+        self._stop.set()
+        self.spool.wake()
+        self._thread.join(timeout)
+
+
+class SQSSpool:
+    """
+    Per-process spool and forwarder, opened lazily so each gunicorn worker
+    (after fork) claims its own slot directory
+    """
+
+    def __init__(self, root, send_batch, max_bytes, segment_bytes, fsync_interval, on_forwarded=None):
+        self.root = root
+        self._send_batch = send_batch
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        self.fsync_interval = fsync_interval
+        self._on_forwarded = on_forwarded
+        self._lock = threading.Lock()
+        self._pid = None
+        self._spool = None
+        self._forwarder = None
+        self._lock_file = None
+
+    def start(self):
+        """
+        Open this process's spool slot and start its forwarder now, so
+        messages left by a previous worker are forwarded without waiting
+        for the first request
+        """
+        self._ensure_open()
+
+    def _ensure_open(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                return self._spool
+            directory, self._lock_file = claim_slot(self.root)
+            self._spool = Spool(directory, self.max_bytes, self.segment_bytes, self.fsync_interval)
+            self._forwarder = SpoolForwarder(self._spool, self._send_batch, on_forwarded=self._on_forwarded)
+            self._pid = os.getpid()
+            logger.info(f"Spooling messages to {directory}")
+            return self._spool
+
+    def append(self, message_body, message_attributes, entry_fields=None):
+        """
+        Durably accept one message for forwarding
+        entry_fields are extra SendMessageBatch entry parameters (e.g. MessageDeduplicationId)
+        Raises SpoolFullError when the spool is full
+        """
+        self.append_many([(message_body, message_attributes, entry_fields)])
+
+    def append_many(self, messages):
+        """
+        Durably accept a list of (message_body, message_attributes, entry_fields) with a single fsync
+        """
+        payloads = []
+        for body, attributes, fields in messages:
+            record = {'body': body, 'attributes': attributes}
+            if fields:
+                record['fields'] = fields
+            payloads.append(json.dumps(record, separators=(',', ':')).encode('utf-8'))
+        self._ensure_open().append_many(payloads)
+
+    def snapshot(self):
+        """Spool counters for monitoring (empty until the spool is opened in this process)"""
+        with self._lock:
+            if self._pid != os.getpid():
+                return {}
+            return dict(self._spool.snapshot(), dropped=self._forwarder.dropped)
+
+    def close(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                return
+            self._forwarder.stop()
+            self._spool.close()
+            self._lock_file.close()
+            self._pid = None
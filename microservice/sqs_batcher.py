@@ -0,0 +1,203 @@
+"""
+Micro-batching SQS publisher
+Coalesces messages from concurrent requests into SendMessageBatch calls
+"""
+import os
+import time
+import queue
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# SendMessageBatch limits
+MAX_BATCH_ENTRIES = 10
+MAX_BATCH_BYTES = 256 * 1024
+
+
+def entry_size(entry):
+    """
+    Size of a batch entry as counted by SQS (body plus attribute names, types and values)
+    """
+    size = len(entry['MessageBody'].encode('utf-8'))
+    for name, attribute in entry.get('MessageAttributes', {}).items():
+        size += len(name.encode('utf-8')) + len(attribute['DataType'].encode('utf-8'))
+        size += len(attribute.get('StringValue', '').encode('utf-8'))
+    return size
+
+
+def chunk_entries(entries):
+    """
+    Split entries into lists that fit a single SendMessageBatch call
+    """
+    chunk, chunk_bytes = [], 0
+    for entry in entries:
+        size = entry_size(entry)
+        if chunk and (len(chunk) >= MAX_BATCH_ENTRIES or chunk_bytes + size > MAX_BATCH_BYTES):
+            yield chunk
+            chunk, chunk_bytes = [], 0
+        chunk.append(entry)
+        chunk_bytes += size
+    if chunk:
+        yield chunk
+
+
+def send_batch_with_retry(send_batch, entries, max_retries=3, backoff=0.05):
+    """
+    Send one batch, retrying entries that failed on the SQS side
+    Whole-call failures are not retried here: send_batch goes through the resilience
+    layer, which has already retried the call, so retrying again would multiply attempts
+    Returns dict: entry Id -> (success, message_id_or_error); the error is a string for
+    entries SQS rejected and the raised exception when a call failed as a whole
+    """
+    pending = {entry['Id']: entry for entry in entries}
+    results = {}
+    attempt = 0
+
+    while pending:
+        try:
+            response = send_batch(list(pending.values()))
+        except Exception as e:
+            logger.warning(f"SendMessageBatch failed: {e}")
+            for entry_id in pending:
+                results[entry_id] = (False, e)
+            break
+
+        for success in response.get('Successful', []):
+            pending.pop(success['Id'], None)
+            results[success['Id']] = (True, success['MessageId'])
+
+        for failure in response.get('Failed', []):
+            # Sender faults (e.g. invalid body) will never succeed on retry
+            if failure.get('SenderFault') or attempt >= max_retries:
+                pending.pop(failure['Id'], None)
+                results[failure['Id']] = (False, f"{failure.get('Code')}: {failure.get('Message', '')}")
+
+        if pending and attempt >= max_retries:
+            # Entries missing from both lists of the final response
+            for entry_id in pending:
+                results[entry_id] = (False, 'No result returned by SQS')
+            break
+
+        attempt += 1
+        if pending:
+            time.sleep(backoff * (2 ** (attempt - 1)))
+
+    return results
+
+
+class SQSBatchPublisher:
+    """
+    Background publisher that groups submitted messages into SendMessageBatch calls
+
+    A batch is sent as soon as it is full (10 entries / 256 KB) or when the
+    first message in it has waited `linger` seconds. Up to `max_in_flight`
+    batches are sent concurrently. Threads are started lazily so they are
+    created in each gunicorn worker after fork.
+    """
+
+    def __init__(self, send_batch, linger=0.01, max_retries=3, max_in_flight=8):
+        self._send_batch = send_batch
+        self.linger = linger
+        self.max_retries = max_retries
+        self.max_in_flight = max_in_flight
+        self._lock = threading.Lock()
+        self._queue = None
+        self._thread = None
+        self._senders = None
+        self._in_flight = None
+        self._pid = None
+        self._next_id = 0
+        self.stats = {
+            'messages': 0,
+            'batches': 0,
+            'failed': 0
+        }
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+                return
+            self._queue = queue.Queue()
+            self._pid = os.getpid()
+            self._senders = ThreadPoolExecutor(max_workers=self.max_in_flight, thread_name_prefix='sqs-batch-send')
+            self._in_flight = threading.BoundedSemaphore(self.max_in_flight)
+            self._thread = threading.Thread(target=self._run, name='sqs-batch-publisher', daemon=True)
+            self._thread.start()
+
+    def submit(self, message_body, message_attributes=None, **entry_fields):
+        """
+        Queue a message for publishing
+        entry_fields are extra SendMessageBatch entry parameters (e.g. MessageDeduplicationId)
+        Returns a Future resolving to (success, message_id_or_error)
+        """
+        self._ensure_started()
+        future = Future()
+        with self._lock:
+            self._next_id += 1
+            entry_id = str(self._next_id)
+        entry = dict(entry_fields, Id=entry_id, MessageBody=message_body)
+        if message_attributes:
+            entry['MessageAttributes'] = message_attributes
+        self._queue.put((entry, future))
+        return future
+
+    def _collect(self, carry):
+        """
+        Gather up to one batch worth of queued items, waiting at most `linger`
+        after the first item. Returns (batch, carry_over_item)
+        """
+        first = carry if carry is not None else self._queue.get()
+        batch = [first]
+        batch_bytes = entry_size(first[0])
+        deadline = time.monotonic() + self.linger
+
+        while len(batch) < MAX_BATCH_ENTRIES:
+            remaining = deadline - time.monotonic()
+            try:
+                item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            size = entry_size(item[0])
+            if batch_bytes + size > MAX_BATCH_BYTES:
+                return batch, item
+            batch.append(item)
+            batch_bytes += size
+
+        return batch, None
+
+    def _run(self):
+        carry = None
+        while True:
+            batch, carry = self._collect(carry)
+            # Block collection while all senders are busy so batches fill up
+            self._in_flight.acquire()
+            self._senders.submit(self._send, batch)
+
+    def _send(self, batch):
+        futures = {entry['Id']: future for entry, future in batch}
+        try:
+            results = send_batch_with_retry(
+                self._send_batch,
+                [entry for entry, _ in batch],
+                max_retries=self.max_retries
+            )
+        except Exception as e:
+            logger.error(f"Unexpected error publishing batch to SQS: {e}")
+            results = {entry_id: (False, e) for entry_id in futures}
+        finally:
+            self._in_flight.release()
+
+        with self._lock:
+            self.stats['batches'] += 1
+            self.stats['messages'] += len(batch)
+            self.stats['failed'] += sum(1 for success, _ in results.values() if not success)
+
+        for entry_id, future in futures.items():
+            future.set_result(results.get(entry_id, (False, 'No result returned by SQS')))
+
+    def snapshot(self):
+        """Return a copy of the publisher counters for monitoring"""
+        with self._lock:
+            return dict(self.stats)
@@ -117,4 +117,15 @@ curl -s -w "\nHTTP Status: %{http_code}\n" -X POST "${SERVICE_URL}/process" \
   }"
 echo ""
 
+# Test 8: Batch Request
+echo -e "${YELLOW}Test 8: Batch Request (NDJSON)${NC}"
+printf '%s\n' \
+  '{"email_subject": "Batch 1", "email_sender": "John doe", "email_timestream": "1693561101", "email_content": "First"}' \
+  '{"email_subject": "Batch 2", "email_sender": "John doe", "email_timestream": "1693561102", "email_content": "Second"}' | \
+curl -s -w "\nHTTP Status: %{http_code}\n" -X POST "${SERVICE_URL}/process/batch" \
+  -H "Content-Type: application/x-ndjson" \
+  -H "X-API-Token: ${TOKEN}" \
+  --data-binary @-
+echo ""
+
 echo -e "${GREEN}All tests completed!${NC}"
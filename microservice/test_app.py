@@ -3,9 +3,21 @@ Unit tests for the email processing microservice
 """
 import os
 import json
+import time
+import asyncio
+import threading
 import pytest
 from unittest.mock import patch, MagicMock
-from app import app, validate_token, validate_data_fields, validate_timestamp
+from app import app, token_cache, sqs_resilience, REQUIRED_FIELDS
+from app import validate_email_data, email_validator, payload_encoder, message_group_id, MAX_BODY_BYTES, MAX_SUBJECT_LENGTH, MAX_CONTENT_LENGTH
+from token_cache import TokenCache
+import asgi
+from sqs_batcher import SQSBatchPublisher, chunk_entries, send_batch_with_retry
+from resilience import CircuitBreaker, RetryBudget
+from payload_codec import decode_body, decompress, GZIP, CLAIM_CHECK
+from spool import Spool, SQSSpool, SpoolFullError, segment_name
+from dedup import DedupWindow, RedisDedupStore, content_key
+from rate_limit import TokenBucketLimiter, RateLimiter, ConcurrencyLimiter, sender_key, client_address, redis_client
 
 
 @pytest.fixture
@@ -34,7 +46,11 @@ def mock_aws():
             'MessageId': 'test-message-id-12345'
         }
         
+        token_cache.clear()
+        sqs_resilience.breaker.record_success()
         yield mock_ssm, mock_sqs
+        token_cache.clear()
+        sqs_resilience.breaker.record_success()
 
 
 def test_health_check(client):
@@ -216,6 +232,41 @@ def test_invalid_json(client):
     assert response.status_code == 400
 
 
+def validate_data_fields(data):
+    """
+    Field checks of the original /process handler, kept as the oracle for EmailValidator
+    Returns tuple: (is_valid, error_message)
+    """
+    if not isinstance(data, dict):
+        return False, "Data must be a dictionary"
+    
+    missing_fields = [field for field in REQUIRED_FIELDS if field not in data]
+    
+    if missing_fields:
+        return False, f"Missing required fields: {', '.join(missing_fields)}"
+    
+    # Check that all required fields have values (not None or empty string)
+    empty_fields = [field for field in REQUIRED_FIELDS if not data.get(field)]
+    if empty_fields:
+        return False, f"Empty fields not allowed: {', '.join(empty_fields)}"
+    
+    return True, None
+
+
+def validate_timestamp(timestamp_str):
+    """
+    Timestamp check of the original /process handler, kept as the oracle for EmailValidator
+    """
+    try:
+        timestamp = int(timestamp_str)
+        # Check if timestamp is reasonable (between year 2000 and 2100)
+        if timestamp < 946684800 or timestamp > 4102444800:
+            return False, "Timestamp out of reasonable range"
+        return True, None
+    except (ValueError, TypeError):
+        return False, "Invalid timestamp format"
+
+
 def test_validate_data_fields():
     """Test data field validation function"""
     # Valid data
@@ -256,3 +307,1192 @@ def test_validate_timestamp():
     is_valid, error = validate_timestamp("999999999999")
     assert is_valid is False
     assert error is not None
+
+
+def test_token_cached_across_requests(client, mock_aws):
+    """Test that SSM is only called once while the token is cached"""
+    mock_ssm, _ = mock_aws
+    payload = {
+        "data": {
+            "email_subject": "Test",
+            "email_sender": "Test",
+            "email_timestream": "1693561101",
+            "email_content": "Test"
+        },
+        "token": "$DJISA<$#45ex3RtYr"
+    }
+    
+    for _ in range(3):
+        response = client.post('/process',
+                              data=json.dumps(payload),
+                              content_type='application/json')
+        assert response.status_code == 200
+    
+    assert mock_ssm.get_parameter.call_count == 1
+    stats = token_cache.snapshot()
+    assert stats['misses'] == 1
+    assert stats['hits'] == 2
+
+
+class FakeClock:
+    """Manually advanced clock for cache tests"""
+    def __init__(self):
+        self.now = 1000.0
+    
+    def __call__(self):
+        return self.now
+
+
+def test_token_cache_stale_while_error():
+    """Test that the last token is served when SSM fails after expiry"""
+    clock = FakeClock()
+    loader = MagicMock(return_value='token-a')
+    cache = TokenCache(loader, ttl=10, refresh_ahead=0, stale_grace=30, clock=clock)
+    
+    assert cache.is_valid('token-a') is True
+    
+    loader.side_effect = Exception('SSM throttled')
+    clock.now += 15
+    assert cache.is_valid('token-a') is True
+    assert cache.snapshot()['stale_served'] == 1
+    
+    # Beyond the grace window the error propagates
+    clock.now += 30
+    with pytest.raises(Exception):
+        cache.is_valid('token-a')
+
+
+def test_token_cache_backs_off_during_outage():
+    """Test that requests during an SSM outage share one failed call and back off"""
+    clock = FakeClock()
+    loader = MagicMock(return_value='token-a')
+    cache = TokenCache(loader, ttl=10, refresh_ahead=0, stale_grace=300, retry_base=1, retry_max=4, clock=clock)
+    cache.get_tokens()
+
+    def failing_load():
+        time.sleep(0.2)
+        raise Exception('SSM throttled')
+    loader.side_effect = failing_load
+    clock.now += 11
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.is_valid('token-a'))) for _ in range(10)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [True] * 10
+    assert loader.call_count == 2
+    assert time.time() - start < 1
+
+    # No SSM call until the backoff has passed; the backoff doubles up to retry_max
+    clock.now += 0.5
+    assert cache.is_valid('token-a') is True
+    assert loader.call_count == 2
+    for expected_calls, delay in [(3, 1), (4, 2), (5, 4), (6, 4)]:
+        clock.now += delay
+        cache.get_tokens()
+        assert loader.call_count == expected_calls
+        cache.get_tokens()
+        assert loader.call_count == expected_calls
+
+    # Recovery resets the backoff
+    loader.side_effect = None
+    clock.now += 4
+    cache.get_tokens()
+    assert loader.call_count == 7
+    assert cache.snapshot()['refresh_errors'] == 5
+
+
+def test_token_cache_background_refresh_backs_off():
+    """Test that a failed refresh-ahead backs off instead of retrying on every request"""
+    clock = FakeClock()
+    loader = MagicMock(return_value='token-a')
+    cache = TokenCache(loader, ttl=20, refresh_ahead=15, retry_base=2, retry_max=8, clock=clock)
+    cache.get_tokens()
+    loader.side_effect = Exception('SSM throttled')
+    
+    def refreshes_finish():
+        deadline = time.time() + 5
+        while cache._refreshing and time.time() < deadline:
+            time.sleep(0.01)
+        assert not cache._refreshing
+    
+    clock.now += 6
+    for _ in range(5):
+        assert cache.is_valid('token-a') is True
+        refreshes_finish()
+    assert loader.call_count == 2
+    assert cache.snapshot()['refresh_errors'] == 1
+    
+    # The next background attempt waits for the backoff
+    clock.now += 2
+    cache.get_tokens()
+    refreshes_finish()
+    assert loader.call_count == 3
+    
+    loader.side_effect = None
+    loader.return_value = 'token-b'
+    clock.now += 1
+    cache.get_tokens()
+    assert loader.call_count == 3
+    clock.now += 3
+    cache.get_tokens()
+    refreshes_finish()
+    assert loader.call_count == 4
+    assert cache.get_tokens()[0] == 'token-b'
+
+
+def test_token_cache_rotation_overlap():
+    """Test that the previous token is accepted during the overlap window"""
+    clock = FakeClock()
+    loader = MagicMock(return_value='token-a')
+    cache = TokenCache(loader, ttl=10, refresh_ahead=0, rotation_overlap=60, clock=clock)
+    
+    assert cache.is_valid('token-a') is True
+    
+    loader.return_value = 'token-b'
+    clock.now += 11
+    assert cache.is_valid('token-b') is True
+    assert cache.is_valid('token-a') is True
+    
+    clock.now += 61
+    assert cache.is_valid('token-b') is True
+    assert cache.is_valid('token-a') is False
+
+
+def test_token_cache_refresh_ahead():
+    """Test that a background refresh starts shortly before expiry"""
+    clock = FakeClock()
+    loader = MagicMock(return_value='token-a')
+    cache = TokenCache(loader, ttl=10, refresh_ahead=5, clock=clock)
+    
+    cache.get_tokens()
+    clock.now += 6
+    with patch('token_cache.threading.Thread') as mock_thread:
+        cache.get_tokens()
+        mock_thread.assert_called_once()
+        mock_thread.return_value.start.assert_called_once()
+    
+    # Running the refresh reloads the token and clears the in-progress flag
+    cache._refresh_in_background()
+    assert loader.call_count == 2
+    assert cache.snapshot()['refreshes'] == 2
+
+
+def test_valid_request_batch_mode(client, mock_aws):
+    """Test that batch publish mode resolves the request with its own MessageId"""
+    _, mock_sqs = mock_aws
+    mock_sqs.send_message_batch.side_effect = lambda QueueUrl, Entries: {
+        'Successful': [{'Id': e['Id'], 'MessageId': f"batch-{e['Id']}"} for e in Entries]
+    }
+    payload = {
+        "data": {
+            "email_subject": "Test",
+            "email_sender": "Test",
+            "email_timestream": "1693561101",
+            "email_content": "Test"
+        },
+        "token": "$DJISA<$#45ex3RtYr"
+    }
+    
+    with patch('app.SQS_PUBLISH_MODE', 'batch'):
+        response = client.post('/process',
+                              data=json.dumps(payload),
+                              content_type='application/json')
+    
+    assert response.status_code == 200
+    data = json.loads(response.data)
+    assert data['message_id'].startswith('batch-')
+    mock_sqs.send_message.assert_not_called()
+
+
+def test_batch_publisher_coalesces_messages():
+    """Test that concurrently submitted messages share SendMessageBatch calls"""
+    calls = []
+    
+    def send_batch(entries):
+        calls.append(len(entries))
+        return {'Successful': [{'Id': e['Id'], 'MessageId': f"id-{e['MessageBody']}"} for e in entries]}
+    
+    publisher = SQSBatchPublisher(send_batch, linger=0.2)
+    futures = [publisher.submit(str(i)) for i in range(25)]
+    results = [future.result(timeout=5) for future in futures]
+    
+    assert results == [(True, f"id-{i}") for i in range(25)]
+    assert sum(calls) == 25
+    assert max(calls) <= 10
+    assert len(calls) == 3
+
+
+def test_send_batch_retries_failed_entries():
+    """Test that server-side entry failures are retried and sender faults are not"""
+    attempts = []
+    
+    def send_batch(entries):
+        attempts.append([e['Id'] for e in entries])
+        if len(attempts) == 1:
+            return {
+                'Successful': [{'Id': '1', 'MessageId': 'm1'}],
+                'Failed': [
+                    {'Id': '2', 'SenderFault': False, 'Code': 'InternalError'},
+                    {'Id': '3', 'SenderFault': True, 'Code': 'InvalidMessageContents'}
+                ]
+            }
+        return {'Successful': [{'Id': e['Id'], 'MessageId': f"m{e['Id']}"} for e in entries]}
+    
+    entries = [{'Id': str(i), 'MessageBody': 'x'} for i in (1, 2, 3)]
+    results = send_batch_with_retry(send_batch, entries, backoff=0)
+    
+    assert results['1'] == (True, 'm1')
+    assert results['2'] == (True, 'm2')
+    assert results['3'][0] is False
+    assert attempts == [['1', '2', '3'], ['2']]
+
+
+def test_send_batch_does_not_retry_whole_call_failures():
+    """Test that a failed call is left to the resilience layer instead of being retried again"""
+    error = Exception('ServiceUnavailable')
+    send_batch = MagicMock(side_effect=error)
+
+    entries = [{'Id': str(i), 'MessageBody': 'x'} for i in (1, 2)]
+    results = send_batch_with_retry(send_batch, entries, backoff=0)
+
+    assert send_batch.call_count == 1
+    assert results == {'1': (False, error), '2': (False, error)}
+
+
+def test_chunk_entries_respects_limits():
+    """Test that batches stay within the entry count and payload size limits"""
+    small = [{'Id': str(i), 'MessageBody': 'x'} for i in range(23)]
+    assert [len(c) for c in chunk_entries(small)] == [10, 10, 3]
+    
+    large = [{'Id': str(i), 'MessageBody': 'x' * 100 * 1024} for i in range(5)]
+    assert [len(c) for c in chunk_entries(large)] == [2, 2, 1]
+
+
+def _batch_send_side_effect(QueueUrl, Entries):
+    return {'Successful': [{'Id': e['Id'], 'MessageId': f"msg-{e['Id']}"} for e in Entries]}
+
+
+def test_process_batch_json(client, mock_aws):
+    """Test bulk endpoint with a JSON list of emails"""
+    mock_ssm, mock_sqs = mock_aws
+    mock_sqs.send_message_batch.side_effect = _batch_send_side_effect
+    valid = {
+        "email_subject": "Test",
+        "email_sender": "Test",
+        "email_timestream": "1693561101",
+        "email_content": "Test"
+    }
+    payload = {
+        "data": [valid] * 12 + [dict(valid, email_timestream="bad")],
+        "token": "$DJISA<$#45ex3RtYr"
+    }
+    
+    response = client.post('/process/batch',
+                          data=json.dumps(payload),
+                          content_type='application/json')
+    
+    assert response.status_code == 200
+    data = json.loads(response.data)
+    assert data['status'] == 'partial'
+    assert data['accepted'] == 12
+    assert data['rejected'] == 1
+    assert data['results'][0] == {'index': 0, 'status': 'success', 'message_id': 'msg-0'}
+    assert data['results'][12]['status'] == 'error'
+    assert 'timestamp' in data['results'][12]['message'].lower()
+    assert mock_sqs.send_message_batch.call_count == 2
+    assert mock_ssm.get_parameter.call_count == 1
+
+
+def test_process_batch_ndjson(client, mock_aws):
+    """Test bulk endpoint with an NDJSON body and header token"""
+    _, mock_sqs = mock_aws
+    mock_sqs.send_message_batch.side_effect = _batch_send_side_effect
+    valid = {
+        "email_subject": "Test",
+        "email_sender": "Test",
+        "email_timestream": "1693561101",
+        "email_content": "Test"
+    }
+    body = "\n".join([json.dumps(valid), "not json", json.dumps(valid)]) + "\n"
+    
+    response = client.post('/process/batch',
+                          data=body,
+                          content_type='application/x-ndjson',
+                          headers={'X-API-Token': '$DJISA<$#45ex3RtYr'})
+    
+    assert response.status_code == 200
+    data = json.loads(response.data)
+    assert [r['status'] for r in data['results']] == ['success', 'error', 'success']
+    assert data['results'][1]['message'] == 'Invalid JSON'
+
+
+def test_process_batch_ndjson_stops_at_item_limit(client, mock_aws):
+    """Test that an NDJSON body over the item limit is rejected without reading the rest"""
+    _, mock_sqs = mock_aws
+    mock_sqs.send_message_batch.side_effect = _batch_send_side_effect
+    line = json.dumps(VALID_PAYLOAD['data']) + "\n"
+
+    with patch('app.PROCESS_BATCH_MAX_ITEMS', 3):
+        response = client.post('/process/batch',
+                              data=line * 1000,
+                              content_type='application/x-ndjson',
+                              headers={'X-API-Token': VALID_PAYLOAD['token']})
+
+    assert response.status_code == 413
+    data = json.loads(response.data)
+    assert 'exceeds 3 items' in data['message']
+    # Items not yet sent when the limit was hit are not queued
+    assert 'results' not in data
+    mock_sqs.send_message_batch.assert_not_called()
+
+
+def test_process_batch_json_is_parsed_incrementally(client, mock_aws):
+    """Test that a JSON batch body is streamed item by item and a broken tail stops processing"""
+    from validation import iter_json_batch
+    import io
+    body = json.dumps({'token': 't', 'data': [{'n': i} for i in range(1000)]}).encode()
+    stream = io.BytesIO(body)
+    events = iter_json_batch(stream.read, chunk_size=1024)
+    assert next(events) == ('token', 't')
+    assert next(events) == ('array', None)
+    assert next(events) == ('item', {'n': 0})
+    assert stream.tell() < len(body) / 4
+    assert sum(1 for event, _ in events if event == 'item') == 999
+
+    _, mock_sqs = mock_aws
+    mock_sqs.send_message_batch.side_effect = _batch_send_side_effect
+    items = ',\n'.join([json.dumps(VALID_PAYLOAD['data'])] * 12)
+    broken = '{"token": "%s", "data": [%s, {"email_subject": ' % (VALID_PAYLOAD['token'], items)
+    response = client.post('/process/batch', data=broken, content_type='application/json')
+
+    assert response.status_code == 400
+    data = json.loads(response.data)
+    assert data['message'] == 'Invalid JSON payload'
+    assert data['accepted'] == 10
+    assert mock_sqs.send_message_batch.call_count == 1
+
+
+def test_process_batch_invalid_token(client, mock_aws):
+    """Test bulk endpoint rejects the whole batch on an invalid token"""
+    _, mock_sqs = mock_aws
+    payload = {"data": [{"email_subject": "Test"}], "token": "invalid-token"}
+    
+    response = client.post('/process/batch',
+                          data=json.dumps(payload),
+                          content_type='application/json')
+    
+    assert response.status_code == 401
+    mock_sqs.send_message_batch.assert_not_called()
+
+
+def test_process_batch_requires_list(client, mock_aws):
+    """Test bulk endpoint with a non-list data field"""
+    payload = {"data": {"email_subject": "Test"}, "token": "$DJISA<$#45ex3RtYr"}
+    
+    response = client.post('/process/batch',
+                          data=json.dumps(payload),
+                          content_type='application/json')
+    
+    assert response.status_code == 400
+
+
+def asgi_request(method, path, body=b'', headers=(), messages=None):
+    """Call the ASGI app directly and return (status_code, parsed_body)"""
+    sent = []
+    received = iter(messages or [{'type': 'http.request', 'body': body, 'more_body': False}])
+    
+    async def receive():
+        return next(received)
+    
+    async def send(message):
+        sent.append(message)
+    
+    scope = {'type': 'http', 'method': method, 'path': path, 'client': ('127.0.0.1', 1234),
+             'headers': [(name.encode(), value.encode()) for name, value in headers]}
+    asyncio.run(asgi.app(scope, receive, send))
+    if not sent:
+        return None, None
+    return sent[0]['status'], json.loads(sent[1]['body'])
+
+
+def test_asgi_health_and_root():
+    """Test ASGI health and root endpoints"""
+    status, data = asgi_request('GET', '/health')
+    assert status == 200
+    assert data['status'] == 'healthy'
+    
+    status, data = asgi_request('GET', '/')
+    assert status == 200
+    assert 'endpoints' in data
+
+
+def test_asgi_valid_request(mock_aws):
+    """Test ASGI /process matches the Flask response"""
+    payload = {
+        "data": {
+            "email_subject": "Happy new year!",
+            "email_sender": "John doe",
+            "email_timestream": "1693561101",
+            "email_content": "Just want to say... Happy new year!!!"
+        },
+        "token": "$DJISA<$#45ex3RtYr"
+    }
+    
+    status, data = asgi_request('POST', '/process', json.dumps(payload).encode())
+    assert status == 200
+    assert data['status'] == 'success'
+    assert data['message_id'] == 'test-message-id-12345'
+
+
+def test_asgi_invalid_requests(mock_aws):
+    """Test ASGI /process validation errors"""
+    status, data = asgi_request('POST', '/process', b'not valid json')
+    assert status == 400
+    
+    payload = {"data": {"email_subject": "Test"}, "token": "invalid-token"}
+    status, data = asgi_request('POST', '/process', json.dumps(payload).encode())
+    assert status == 401
+    assert 'Invalid token' in data['message']
+    
+    status, data = asgi_request('GET', '/process')
+    assert status == 405
+    
+    status, data = asgi_request('POST', '/process', b'x' * (MAX_BODY_BYTES + 1))
+    assert status == 413
+
+
+def test_asgi_process_batch(client, mock_aws):
+    """Test ASGI /process/batch matches the Flask response for JSON and NDJSON bodies"""
+    _, mock_sqs = mock_aws
+    mock_sqs.send_message_batch.side_effect = lambda QueueUrl, Entries: {
+        'Successful': [{'Id': e['Id'], 'MessageId': f"msg-{e['Id']}"} for e in Entries],
+        'Failed': []
+    }
+    item = {
+        "email_subject": "Test",
+        "email_sender": "Test",
+        "email_timestream": "1693561101",
+        "email_content": "Test"
+    }
+    payload = {"token": "$DJISA<$#45ex3RtYr", "data": [item, {"email_subject": "Test"}]}
+    
+    status, data = asgi_request('POST', '/process/batch', json.dumps(payload).encode(),
+                                headers=[('content-type', 'application/json')])
+    response = client.post('/process/batch', data=json.dumps(payload), content_type='application/json')
+    assert status == response.status_code
+    assert data == json.loads(response.data)
+    
+    body = '\n'.join(json.dumps(item) for _ in range(3)).encode()
+    status, data = asgi_request('POST', '/process/batch', body, headers=[
+        ('content-type', 'application/x-ndjson; charset=utf-8'),
+        ('x-api-token', '$DJISA<$#45ex3RtYr')
+    ])
+    assert status == 200
+    assert data['accepted'] == 3
+    
+    status, data = asgi_request('POST', '/process/batch', body,
+                                headers=[('content-type', 'application/x-ndjson')])
+    assert status == 401
+    
+    status, data = asgi_request('GET', '/process/batch')
+    assert status == 405
+
+
+def test_asgi_process_batch_streams_body(mock_aws):
+    """Test that ASGI /process/batch publishes items while the rest of the body is still arriving"""
+    _, mock_sqs = mock_aws
+    mock_sqs.send_message_batch.side_effect = lambda QueueUrl, Entries: {
+        'Successful': [{'Id': e['Id'], 'MessageId': f"msg-{e['Id']}"} for e in Entries],
+        'Failed': []
+    }
+    item = json.dumps({
+        "email_subject": "Test",
+        "email_sender": "Test",
+        "email_timestream": "1693561101",
+        "email_content": "Test"
+    })
+    published_before_end = []
+    
+    def chunks(body):
+        # Two chunks per item, so items are split across receive() calls
+        for start in range(0, len(body), len(item) // 2):
+            yield {'type': 'http.request', 'body': body[start:start + len(item) // 2], 'more_body': True}
+        published_before_end.append(mock_sqs.send_message_batch.call_count)
+        yield {'type': 'http.request', 'body': b'', 'more_body': False}
+    
+    body = f'{{"token": "$DJISA<$#45ex3RtYr", "data": [{", ".join([item] * 12)}]}}'.encode()
+    status, data = asgi_request('POST', '/process/batch', messages=chunks(body),
+                                headers=[('content-type', 'application/json')])
+    assert status == 200 and data['accepted'] == 12
+    
+    body = '\n'.join([item] * 12).encode()
+    status, data = asgi_request('POST', '/process/batch', messages=chunks(body), headers=[
+        ('content-type', 'application/x-ndjson'),
+        ('x-api-token', '$DJISA<$#45ex3RtYr')
+    ])
+    assert status == 200 and data['accepted'] == 12
+    assert published_before_end == [1, 3]
+    
+    # A chunked body with no Content-Length is still capped while it is read
+    with patch('app.MAX_BATCH_BODY_BYTES', 1000):
+        status, data = asgi_request('POST', '/process/batch', messages=chunks(body), headers=[
+            ('content-type', 'application/x-ndjson'),
+            ('x-api-token', '$DJISA<$#45ex3RtYr')
+        ])
+    assert status == 413
+
+
+def test_asgi_aborts_on_client_disconnect(mock_aws):
+    """Test that a body cut short by a disconnect is never validated or published"""
+    _, mock_sqs = mock_aws
+    payload = json.dumps({
+        "data": {
+            "email_subject": "Test",
+            "email_sender": "Test",
+            "email_timestream": "1693561101",
+            "email_content": "Test"
+        },
+        "token": "$DJISA<$#45ex3RtYr"
+    }).encode()
+    
+    for path in ('/process', '/process/batch'):
+        status, data = asgi_request('POST', path, messages=[
+            {'type': 'http.request', 'body': payload[:20], 'more_body': True},
+            {'type': 'http.disconnect'}
+        ])
+        assert status is None
+    mock_sqs.send_message.assert_not_called()
+    mock_sqs.send_message_batch.assert_not_called()
+
+
+def test_metrics_endpoint(client, mock_aws):
+    """Test that /metrics exposes request and stage metrics"""
+    payload = {
+        "data": {
+            "email_subject": "Test",
+            "email_sender": "Test",
+            "email_timestream": "1693561101",
+            "email_content": "Test"
+        },
+        "token": "$DJISA<$#45ex3RtYr"
+    }
+    client.post('/process', data=json.dumps(payload), content_type='application/json')
+    
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    body = response.data.decode()
+    assert 'email_processor_requests_total{endpoint="/process",method="POST",status="200"}' in body
+    assert 'email_processor_stage_duration_seconds_count{stage="sqs_publish"}' in body
+    assert 'email_processor_stage_duration_seconds_count{stage="token_validation"}' in body
+
+
+def test_metrics_count_aws_errors(client, mock_aws):
+    """Test that SQS errors are counted by error code"""
+    from botocore.exceptions import ClientError
+    _, mock_sqs = mock_aws
+    mock_sqs.send_message.side_effect = ClientError(
+        {'Error': {'Code': 'ThrottlingException', 'Message': 'Rate exceeded'}}, 'SendMessage'
+    )
+    payload = {
+        "data": {
+            "email_subject": "Test",
+            "email_sender": "Test",
+            "email_timestream": "1693561101",
+            "email_content": "Test"
+        },
+        "token": "$DJISA<$#45ex3RtYr"
+    }
+    response = client.post('/process', data=json.dumps(payload), content_type='application/json')
+    assert response.status_code == 500
+    
+    body = client.get('/metrics').data.decode()
+    assert 'email_processor_aws_errors_total{code="ThrottlingException",operation="SendMessage",service="sqs"}' in body
+
+
+VALID_PAYLOAD = {
+    "data": {
+        "email_subject": "Test",
+        "email_sender": "Test",
+        "email_timestream": "1693561101",
+        "email_content": "Test"
+    },
+    "token": "$DJISA<$#45ex3RtYr"
+}
+
+
+def test_sqs_throttling_is_retried(client, mock_aws):
+    """Test that a throttled SendMessage is retried and the request succeeds"""
+    from botocore.exceptions import ClientError
+    _, mock_sqs = mock_aws
+    mock_sqs.send_message.side_effect = [
+        ClientError({'Error': {'Code': 'ThrottlingException', 'Message': 'Rate exceeded'}}, 'SendMessage'),
+        {'MessageId': 'test-message-id-12345'}
+    ]
+    with patch.object(sqs_resilience, '_sleep'):
+        response = client.post('/process', data=json.dumps(VALID_PAYLOAD), content_type='application/json')
+    
+    assert response.status_code == 200
+    assert mock_sqs.send_message.call_count == 2
+    assert 'email_processor_aws_retries_total{code="ThrottlingException",service="sqs"}' in client.get('/metrics').data.decode()
+
+
+def test_open_circuit_sheds_load(client, mock_aws):
+    """Test that requests get 503 with Retry-After while the SQS circuit is open"""
+    _, mock_sqs = mock_aws
+    for _ in range(sqs_resilience.breaker.failure_threshold):
+        sqs_resilience.breaker.record_failure()
+    
+    response = client.post('/process', data=json.dumps(VALID_PAYLOAD), content_type='application/json')
+    assert response.status_code == 503
+    assert int(response.headers['Retry-After']) >= 1
+    mock_sqs.send_message.assert_not_called()
+    
+    response = client.post('/process/batch', data=json.dumps({
+        'token': VALID_PAYLOAD['token'], 'data': [VALID_PAYLOAD['data']]
+    }), content_type='application/json')
+    assert response.status_code == 503
+
+
+def test_batch_mode_sheds_load_when_circuit_opens_in_batcher(client, mock_aws):
+    """Test that a circuit opening while a message waits in the batcher gives 503, not 500"""
+    from concurrent.futures import Future
+    from resilience import CircuitOpenError
+    future = Future()
+    future.set_result((False, CircuitOpenError('sqs', 7)))
+    publisher = MagicMock()
+    publisher.submit.return_value = future
+
+    with patch('app.SQS_PUBLISH_MODE', 'batch'), patch('app.sqs_publisher', publisher):
+        response = client.post('/process', data=json.dumps(VALID_PAYLOAD), content_type='application/json')
+
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '7'
+
+
+def test_circuit_breaker_half_open_probe():
+    """Test that an open circuit lets one probe through after the reset timeout"""
+    now = [0.0]
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10, clock=lambda: now[0])
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == 'open'
+    assert not breaker.allow()
+    assert breaker.retry_after() == 10
+    
+    now[0] = 10.0
+    assert breaker.allow()
+    assert not breaker.allow()  # only one probe at a time
+    breaker.record_failure()
+    assert breaker.state == 'open'
+    
+    now[0] = 20.0
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == 'closed'
+
+
+def test_retry_budget_limits_retries():
+    """Test that retries stop once the budget is spent"""
+    budget = RetryBudget(ratio=0.5, min_per_second=0, clock=lambda: 0.0)
+    spent = sum(1 for _ in range(20) if budget.withdraw())
+    assert spent == 10
+    budget.deposit()
+    budget.deposit()
+    assert budget.withdraw()
+    assert not budget.withdraw()
+
+
+@pytest.mark.parametrize('module', ['resilience.py', 'aws_clients.py', 'payload_codec.py'])
+def test_shared_modules_match_processor_copies(module):
+    """Test that the modules shipped by both services have not drifted apart"""
+    here = os.path.dirname(os.path.abspath(__file__))
+    processor_copy = os.path.join(here, '..', 'sqs-processor', 'app', module)
+    if not os.path.exists(processor_copy):
+        pytest.skip('SQS processor sources not available')
+    with open(os.path.join(here, module), 'rb') as ours, open(processor_copy, 'rb') as theirs:
+        assert ours.read() == theirs.read(), f"{module} differs from sqs-processor/app/{module}"
+
+
+def test_oversized_body_rejected(client, mock_aws):
+    """Test that bodies over the limit get 413 without being published"""
+    _, mock_sqs = mock_aws
+    response = client.post('/process', data=b'x' * (MAX_BODY_BYTES + 1), content_type='application/json')
+    assert response.status_code == 413
+    mock_sqs.send_message.assert_not_called()
+
+
+def test_field_limits_and_sender_format(client, mock_aws):
+    """Test field length, type and sender format validation"""
+    cases = [
+        ('email_subject', 'x' * (MAX_SUBJECT_LENGTH + 1), f"Field email_subject exceeds {MAX_SUBJECT_LENGTH} characters"),
+        ('email_content', 'x' * (MAX_CONTENT_LENGTH + 1), f"Field email_content exceeds {MAX_CONTENT_LENGTH} characters"),
+        ('email_content', ['not', 'a', 'string'], "Field email_content must be a string"),
+        ('email_sender', 'John <john@example>', "Invalid email_sender format"),
+        ('email_sender', 'John\r\nBcc: x@example.com', "Invalid email_sender format"),
+    ]
+    for field, value, message in cases:
+        payload = {'token': VALID_PAYLOAD['token'], 'data': dict(VALID_PAYLOAD['data'], **{field: value})}
+        response = client.post('/process', data=json.dumps(payload), content_type='application/json')
+        assert response.status_code == 400
+        assert json.loads(response.data)['message'] == message
+    
+    for sender in ('John doe', 'john@example.com', 'John Doe <john@example.com>'):
+        assert validate_email_data(dict(VALID_PAYLOAD['data'], email_sender=sender)) == (True, None)
+
+
+def test_email_validator_matches_legacy_checks():
+    """Test that the single-pass validator reports the same errors as the field and timestamp checks"""
+    samples = [
+        [],
+        {},
+        {'email_subject': 'Test'},
+        dict(VALID_PAYLOAD['data']),
+        dict(VALID_PAYLOAD['data'], email_content=''),
+        dict(VALID_PAYLOAD['data'], email_content=None, email_subject=''),
+        dict(VALID_PAYLOAD['data'], email_timestream='not-a-number'),
+        dict(VALID_PAYLOAD['data'], email_timestream='123'),
+        dict(VALID_PAYLOAD['data'], email_timestream=1693561101),
+        dict(VALID_PAYLOAD['data'], email_timestream=1693561101.5),
+        dict(VALID_PAYLOAD['data'], email_timestream=123.0),
+        dict(VALID_PAYLOAD['data'], email_timestream='1693561101.5'),
+        dict(VALID_PAYLOAD['data'], email_timestream=True),
+    ]
+    for data in samples:
+        is_valid, error_message = validate_data_fields(data)
+        if is_valid:
+            is_valid, error_message = validate_timestamp(data['email_timestream'])
+            if not is_valid:
+                error_message = f"Invalid timestamp: {error_message}"
+        assert email_validator.validate(data) == (is_valid, error_message)
+
+
+def published_message(mock_sqs):
+    """Body and PayloadEncoding of the message passed to send_message"""
+    kwargs = mock_sqs.send_message.call_args.kwargs
+    encoding = kwargs['MessageAttributes'].get('PayloadEncoding', {}).get('StringValue')
+    return kwargs['MessageBody'], encoding
+
+
+def test_large_email_is_compressed(client, mock_aws):
+    """Test that bodies over the compression threshold are sent gzip-compressed"""
+    _, mock_sqs = mock_aws
+    data = dict(VALID_PAYLOAD['data'], email_content='Happy new year! ' * 4000)
+    response = client.post('/process', data=json.dumps({'token': VALID_PAYLOAD['token'], 'data': data}),
+                           content_type='application/json')
+    assert response.status_code == 200
+    
+    body, encoding = published_message(mock_sqs)
+    assert encoding == GZIP
+    assert len(body) < 4000
+    assert json.loads(decompress(body)) == data
+    
+    client.post('/process', data=json.dumps(VALID_PAYLOAD), content_type='application/json')
+    body, encoding = published_message(mock_sqs)
+    assert encoding is None
+    assert json.loads(body) == VALID_PAYLOAD['data']
+
+
+def test_oversized_email_uses_claim_check(client, mock_aws):
+    """Test that bodies too large for SQS are stored in S3 and replaced by a pointer"""
+    _, mock_sqs = mock_aws
+    data = dict(VALID_PAYLOAD['data'], email_content='Happy new year! ' * 4000)
+    payload = json.dumps({'token': VALID_PAYLOAD['token'], 'data': data})
+    
+    with patch.object(payload_encoder, 'claim_check_threshold', 100), \
+         patch.object(payload_encoder, 'bucket', 'claim-bucket'), \
+         patch('app.s3_client') as mock_s3:
+        response = client.post('/process', data=payload, content_type='application/json')
+        assert response.status_code == 200
+        
+        body, encoding = published_message(mock_sqs)
+        assert encoding == CLAIM_CHECK
+        put = mock_s3.put_object.call_args.kwargs
+        assert put['Bucket'] == 'claim-bucket'
+        assert json.loads(body)['claim_check']['key'] == put['Key']
+        
+        def fetch(bucket, key):
+            assert (bucket, key) == (put['Bucket'], put['Key'])
+            return put['Body']
+        assert json.loads(decode_body(body, encoding, fetch)) == data
+    
+    with patch.object(payload_encoder, 'claim_check_threshold', 100):
+        mock_sqs.send_message.reset_mock()
+        response = client.post('/process', data=payload, content_type='application/json')
+        assert response.status_code == 413
+        mock_sqs.send_message.assert_not_called()
+
+
+def test_spool_recovers_after_restart(tmp_path):
+    """Test that unforwarded records survive a restart and a torn tail is skipped"""
+    spool = Spool(str(tmp_path), fsync_interval=0)
+    spool.append_many([b'one', b'two', b'three'])
+    payloads, position = spool.read_batch(2, 1024)
+    assert payloads == [b'one', b'two']
+    spool.commit(position, len(payloads))
+    spool.append(b'four')
+    spool.close()
+    
+    # Simulate a crash in the middle of an append
+    with open(tmp_path / segment_name(1), 'ab') as f:
+        f.write(b'\x00\x00\x00\x10partial')
+    
+    spool = Spool(str(tmp_path), fsync_interval=0)
+    assert spool.pending == 2
+    spool.append(b'five')
+    payloads, position = spool.read_batch(10, 1024, timeout=0)
+    assert payloads == [b'three', b'four', b'five']
+    spool.commit(position, len(payloads))
+    assert spool.snapshot()['pending'] == 0
+    assert spool.snapshot()['segments'] == 1
+    spool.close()
+
+
+def test_spool_full_rejects_appends(tmp_path):
+    """Test that appends beyond the size limit raise SpoolFullError"""
+    spool = Spool(str(tmp_path), max_bytes=100, segment_bytes=40, fsync_interval=0)
+    spool.append(b'x' * 20)
+    spool.append(b'y' * 20)
+    with pytest.raises(SpoolFullError):
+        spool.append(b'z' * 60)
+    assert spool.snapshot()['rejected'] == 1
+    assert spool.snapshot()['segments'] == 2
+    spool.close()
+
+
+def test_spool_fsync_failure_fails_appends(tmp_path):
+    """Test that a failed fsync fails the waiting append and later ones instead of blocking them"""
+    spool = Spool(str(tmp_path), fsync_interval=0)
+    spool.append(b'one')
+    errors = []
+    
+    def append():
+        try:
+            spool.append(b'two')
+        except SpoolFullError as e:
+            errors.append(e)
+    
+    with patch('spool.os.fsync', side_effect=OSError(5, 'Input/output error')):
+        thread = threading.Thread(target=append)
+        thread.start()
+        thread.join(5)
+    assert not thread.is_alive()
+    assert len(errors) == 1 and isinstance(errors[0].__cause__, OSError)
+    with pytest.raises(SpoolFullError):
+        spool.append(b'three')
+    assert spool.snapshot()['broken'] is True
+    
+    # Records made durable before the failure are still forwarded
+    payloads, position = spool.read_batch(10, 1024, timeout=0)
+    assert payloads == [b'one']
+    spool.close()
+
+
+def test_spool_write_failure_keeps_size_accounting(tmp_path):
+    """Test that a failed write is not counted in the spool size"""
+    spool = Spool(str(tmp_path), fsync_interval=0)
+    spool.append(b'one')
+    size = spool.size()
+    with patch.object(spool, '_write_file') as write_file:
+        write_file.write.side_effect = OSError(28, 'No space left on device')
+        with pytest.raises(SpoolFullError):
+            spool.append(b'two')
+    assert spool.size() == size
+    assert spool.snapshot()['appended'] == 1
+    spool.close()
+
+
+def test_spool_mode_accepts_during_sqs_outage(client, mock_aws, tmp_path):
+    """Test that spool mode answers 202 while SQS fails and forwards in order once it recovers"""
+    sent = []
+    
+    def send_batch(entries):
+        if len(sent) < 1:
+            sent.append(None)
+            raise ConnectionError('SQS unavailable')
+        sent.extend(json.loads(entry['MessageBody'])['email_subject'] for entry in entries)
+        return {'Successful': [{'Id': e['Id'], 'MessageId': f"id-{e['Id']}"} for e in entries]}
+    
+    sqs_spool = SQSSpool(str(tmp_path), send_batch, max_bytes=1024 * 1024,
+                         segment_bytes=4096, fsync_interval=0.001)
+    for _ in range(sqs_resilience.breaker.failure_threshold):
+        sqs_resilience.breaker.record_failure()
+    
+    with patch('app.SQS_PUBLISH_MODE', 'spool'), patch('app.sqs_spool', sqs_spool):
+        for i in range(3):
+            data = dict(VALID_PAYLOAD['data'], email_subject=f"Test {i}")
+            response = client.post('/process', data=json.dumps({'token': VALID_PAYLOAD['token'], 'data': data}),
+                                   content_type='application/json')
+            assert response.status_code == 202
+            assert json.loads(response.data)['status'] == 'accepted'
+        
+        response = client.post('/process/batch', data=json.dumps({
+            'token': VALID_PAYLOAD['token'],
+            'data': [dict(VALID_PAYLOAD['data'], email_subject='Test 3'), {'email_subject': 'Bad'}]
+        }), content_type='application/json')
+        assert response.status_code == 200
+        assert json.loads(response.data)['accepted'] == 1
+        
+        deadline = time.time() + 5
+        while len(sent) < 5 and time.time() < deadline:
+            time.sleep(0.05)
+        assert sent[1:] == ['Test 0', 'Test 1', 'Test 2', 'Test 3']
+        assert client.get('/health').get_json()['spool']['pending'] == 0
+    sqs_spool.close()
+    mock_aws[1].send_message.assert_not_called()
+
+
+def test_spool_forwarder_starts_eagerly_and_skips_corrupt_records(tmp_path):
+    """Test that a worker forwards a previous worker's spool at start, dropping undecodable records"""
+    (tmp_path / 'worker-0').mkdir()
+    leftover = Spool(str(tmp_path / 'worker-0'), fsync_interval=0)
+    good = json.dumps({'body': 'kept', 'attributes': {}}).encode()
+    leftover.append_many([good, b'not json', json.dumps({'body': 'no attributes'}).encode(), good])
+    leftover.close()
+    
+    sent = []
+    forwarded = []
+    
+    def send_batch(entries):
+        sent.extend(entry['MessageBody'] for entry in entries)
+        return {'Successful': [{'Id': e['Id'], 'MessageId': f"id-{e['Id']}"} for e in entries]}
+    
+    def on_forwarded(delivered, dropped, snapshot):
+        forwarded.append((delivered, dropped))
+        raise RuntimeError('metrics backend down')
+    
+    sqs_spool = SQSSpool(str(tmp_path), send_batch, max_bytes=1024 * 1024,
+                         segment_bytes=4096, fsync_interval=0.001, on_forwarded=on_forwarded)
+    sqs_spool.start()
+    deadline = time.time() + 5
+    while not forwarded and time.time() < deadline:
+        time.sleep(0.05)
+    assert sent == ['kept', 'kept']
+    assert forwarded == [(2, 2)]
+    
+    # The forwarder keeps running after a failing callback
+    sqs_spool.append('later', {})
+    deadline = time.time() + 5
+    while len(sent) < 3 and time.time() < deadline:
+        time.sleep(0.05)
+    assert sent[2] == 'later'
+    assert sqs_spool.snapshot()['dropped'] == 2
+    sqs_spool.close()
+
+
+def test_spool_mode_sheds_load_when_full(client, mock_aws, tmp_path):
+    """Test that a full spool answers 503 with Retry-After"""
+    sqs_spool = SQSSpool(str(tmp_path), lambda entries: {}, max_bytes=10,
+                         segment_bytes=4096, fsync_interval=0)
+    with patch('app.SQS_PUBLISH_MODE', 'spool'), patch('app.sqs_spool', sqs_spool):
+        response = client.post('/process', data=json.dumps(VALID_PAYLOAD), content_type='application/json')
+    assert response.status_code == 503
+    assert int(response.headers['Retry-After']) >= 1
+    sqs_spool.close()
+
+
+def test_token_bucket_limiter_refills_and_evicts_idle_keys():
+    """Test token bucket refill, Retry-After and eviction of idle keys"""
+    clock = FakeClock()
+    limiter = TokenBucketLimiter(rate=2, burst=2, max_keys=3, clock=clock)
+    assert limiter.acquire('a') == 0
+    assert limiter.acquire('a') == 0
+    assert limiter.acquire('a') == pytest.approx(0.5)
+    clock.now += 0.5
+    assert limiter.acquire('a') == 0
+    
+    # 'a' is full again after an idle second, so it is dropped when another key is used
+    clock.now += 1
+    limiter.acquire('b')
+    assert limiter.snapshot()['keys'] == 1
+    for key in 'bcde':
+        limiter.acquire(key)
+    assert limiter.snapshot()['keys'] == 3
+
+
+def test_rate_limiter_fails_open_when_shared_backend_fails():
+    """Test that a failing shared backend leaves only the local limit in force"""
+    class BrokenBackend:
+        def acquire(self, key, cost=1):
+            raise ConnectionError('redis down')
+    
+    errors = []
+    limiter = RateLimiter(TokenBucketLimiter(rate=1, burst=1), BrokenBackend(), on_error=errors.append)
+    assert limiter.acquire('a') == 0
+    assert limiter.acquire('a') > 0
+    assert len(errors) == 1
+
+
+def test_sender_key_and_client_address():
+    """Test rate-limit key normalization and X-Forwarded-For handling"""
+    assert sender_key('John Doe <John@Example.com>') == 'john@example.com'
+    assert sender_key('John Doe') == 'john doe'
+    assert client_address('10.0.0.5', '1.2.3.4, 203.0.113.9', trusted_proxies=1) == '203.0.113.9'
+    assert client_address('10.0.0.5', '203.0.113.9', trusted_proxies=0) == '10.0.0.5'
+    assert client_address('10.0.0.5', None, trusted_proxies=1) == '10.0.0.5'
+
+
+def test_sender_rate_limit_returns_429(client, mock_aws):
+    """Test that a sender over its limit gets 429 with Retry-After while others are served"""
+    _, mock_sqs = mock_aws
+    mock_sqs.send_message_batch.side_effect = _batch_send_side_effect
+    limiter = RateLimiter(TokenBucketLimiter(rate=0.1, burst=2))
+    with patch('app.sender_limiter', limiter):
+        statuses = [client.post('/process', data=json.dumps(VALID_PAYLOAD),
+                                content_type='application/json') for _ in range(3)]
+        assert [response.status_code for response in statuses] == [200, 200, 429]
+        assert int(statuses[-1].headers['Retry-After']) >= 1
+        
+        other = dict(VALID_PAYLOAD['data'], email_sender='Other <other@example.com>')
+        response = client.post('/process', data=json.dumps({'token': VALID_PAYLOAD['token'], 'data': other}),
+                               content_type='application/json')
+        assert response.status_code == 200
+        
+        response = client.post('/process/batch', data=json.dumps({
+            'token': VALID_PAYLOAD['token'], 'data': [other, VALID_PAYLOAD['data']]
+        }), content_type='application/json')
+        results = response.get_json()['results']
+        assert results[0]['status'] == 'success'
+        assert results[1]['message'] == 'Rate limit exceeded'
+    assert mock_sqs.send_message.call_count == 3
+
+
+def test_client_rate_limit_uses_forwarded_address(client, mock_aws):
+    """Test that the client limit is keyed by the address the trusted proxy saw"""
+    mock_ssm, _ = mock_aws
+    limiter = RateLimiter(TokenBucketLimiter(rate=0.1, burst=1))
+    with patch('app.client_limiter', limiter), patch('app.TRUSTED_PROXY_COUNT', 1):
+        def post(address):
+            return client.post('/process', data=json.dumps(VALID_PAYLOAD), content_type='application/json',
+                               headers={'X-Forwarded-For': address}).status_code
+        assert [post('203.0.113.1'), post('203.0.113.1'), post('203.0.113.2')] == [200, 429, 200]
+    # The limited request never reached token validation
+    assert mock_ssm.get_parameter.call_count == 1
+
+
+def test_concurrency_limit_sheds_requests(client, mock_aws):
+    """Test that requests over the concurrency limit get 503 without touching AWS"""
+    _, mock_sqs = mock_aws
+    limiter = ConcurrencyLimiter(1)
+    assert limiter.acquire()
+    with patch('app.concurrency_limiter', limiter):
+        response = client.post('/process', data=json.dumps(VALID_PAYLOAD), content_type='application/json')
+        assert response.status_code == 503
+        assert response.headers['Retry-After'] == '1'
+        
+        limiter.release()
+        response = client.post('/process', data=json.dumps(VALID_PAYLOAD), content_type='application/json')
+        assert response.status_code == 200
+    assert limiter.snapshot() == {'limit': 1, 'in_flight': 0, 'rejected': 1}
+    assert mock_sqs.send_message.call_count == 1
+
+
+def test_content_key_ignores_formatting_differences():
+    """Test that resubmissions differing only in whitespace, case or line endings match"""
+    data = dict(VALID_PAYLOAD['data'], email_content='Line one\r\nLine two')
+    resubmitted = dict(data, email_sender=' TEST ', email_timestream=1693561101,
+                       email_content='Line one\nLine two\n')
+    assert content_key(data) == content_key(resubmitted)
+    assert content_key(data) != content_key(dict(data, email_subject='Other'))
+
+
+def test_dedup_window_expires_and_survives_store_errors():
+    """Test the dedup window expiry, size bound and fail-open shared store"""
+    clock = FakeClock()
+    window = DedupWindow(window=60, max_entries=2, clock=clock)
+    window.put('a', 'id-a')
+    assert window.get('a') == 'id-a'
+    clock.now += 61
+    assert window.get('a') is None
+    window.put('b', 'id-b')
+    window.put('c', 'id-c')
+    window.put('d', 'id-d')
+    assert window.snapshot()['keys'] == 2
+    
+    class BrokenStore:
+        def get(self, key):
+            raise ConnectionError('redis down')
+        
+        def put(self, key, message_id, ttl):
+            raise ConnectionError('redis down')
+    
+    errors = []
+    window = DedupWindow(window=60, store=BrokenStore(), on_error=errors.append)
+    assert window.get('a') is None
+    window.put('a', 'id-a')
+    assert window.get('a') == 'id-a'
+    assert len(errors) == 2
+
+
+def test_dedup_window_keeps_shared_expiry():
+    """Test that a key found in the shared store expires locally when it expires there"""
+    clock = FakeClock()
+    store = MagicMock()
+    store.get.return_value = ('id-a', 10.0)
+    window = DedupWindow(window=60, store=store, clock=clock)
+    assert window.get('a') == 'id-a'
+    
+    store.get.return_value = None
+    clock.now += 9
+    assert window.get('a') == 'id-a'
+    assert store.get.call_count == 1
+    clock.now += 2
+    assert window.get('a') is None
+    
+    client = MagicMock()
+    client.pipeline.return_value.execute.return_value = [b'id-a', 10000]
+    assert RedisDedupStore(client).get('a') == ('id-a', 10.0)
+    client.pipeline.return_value.execute.return_value = [None, -2]
+    assert RedisDedupStore(client).get('a') is None
+
+
+def test_redis_client_warning_names_its_setting(caplog):
+    """Test that the missing-redis warning names the setting that asked for Redis"""
+    with patch('rate_limit.redis', None):
+        assert redis_client('redis://localhost', 0.1, 'DEDUP_REDIS_URL', 'dedup is per process') is None
+    assert 'DEDUP_REDIS_URL is set' in caplog.text
+
+
+def test_duplicate_submission_returns_original_message_id(client, mock_aws):
+    """Test that a repeated email is answered from the dedup window without a second message"""
+    _, mock_sqs = mock_aws
+    with patch('app.ingest_dedup', DedupWindow(window=60)):
+        first = client.post('/process', data=json.dumps(VALID_PAYLOAD), content_type='application/json')
+        second = client.post('/process', data=json.dumps(VALID_PAYLOAD), content_type='application/json')
+        
+        mock_sqs.send_message_batch.side_effect = _batch_send_side_effect
+        other = dict(VALID_PAYLOAD['data'], email_subject='Other')
+        response = client.post('/process/batch', data=json.dumps({
+            'token': VALID_PAYLOAD['token'], 'data': [VALID_PAYLOAD['data'], other, other]
+        }), content_type='application/json')
+    
+    assert first.status_code == second.status_code == 200
+    assert second.get_json()['message_id'] == first.get_json()['message_id']
+    assert second.get_json()['duplicate'] is True
+    assert mock_sqs.send_message.call_count == 1
+    
+    results = response.get_json()['results']
+    assert results[0] == {'index': 0, 'status': 'success', 'duplicate': True,
+                          'message_id': first.get_json()['message_id']}
+    assert results[2]['message_id'] == results[1]['message_id']
+    assert results[2]['duplicate'] is True
+    assert len(mock_sqs.send_message_batch.call_args.kwargs['Entries']) == 1
+
+
+def test_fifo_queue_sets_group_and_deduplication_id(client, mock_aws):
+    """Test that FIFO messages are grouped by sender and deduplicated by content key"""
+    _, mock_sqs = mock_aws
+    with patch('app.SQS_FIFO_QUEUE', True):
+        response = client.post('/process', data=json.dumps(VALID_PAYLOAD), content_type='application/json')
+    assert response.status_code == 200
+    kwargs = mock_sqs.send_message.call_args.kwargs
+    assert kwargs['MessageDeduplicationId'] == content_key(VALID_PAYLOAD['data'])
+    assert kwargs['MessageGroupId'] == 'test'
+    
+    sender = 'Jöhn Doe <jöhn@example.com>'
+    assert message_group_id(dict(VALID_PAYLOAD['data'], email_sender='John <John@Example.com>')) == 'john@example.com'
+    assert len(message_group_id(dict(VALID_PAYLOAD['data'], email_sender=sender))) == 64
@@ -0,0 +1,186 @@
+"""
+In-process cache for the API token stored in SSM Parameter Store
+Avoids a KMS-decrypting SSM round trip on every request
+"""
+import hmac
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class TokenCache:
+    """
+    Thread-safe TTL cache around a token loader function
+
+    - Entries are fresh for `ttl` seconds; within the last `refresh_ahead`
+      seconds a single background thread refreshes the token so request
+      threads never wait on SSM while a value is cached.
+    - If SSM fails after expiry, the last known token keeps being served for
+      up to `stale_grace` seconds (stale-while-error). After a failure, in the
+      background or not, SSM is not called again until a backoff
+      (`retry_base` doubling up to `retry_max` seconds) has passed, so an
+      outage costs one SSM call per backoff instead of one per request.
+      Only one SSM call is made at a time.
+    - When the token changes, the previous one is still accepted for
+      `rotation_overlap` seconds so clients can roll over without 401s.
+    """
+
+    def __init__(self, loader, ttl=300, refresh_ahead=60, stale_grace=600,
+                 rotation_overlap=300, retry_base=1, retry_max=30, clock=time.monotonic):
+        self._loader = loader
+        self.ttl = ttl
+        self.refresh_ahead = min(refresh_ahead, ttl)
+        self.stale_grace = stale_grace
+        self.rotation_overlap = rotation_overlap
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self._clock = clock
+
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._token = None
+        self._loaded_at = None
+        self._previous_token = None
+        self._previous_expires_at = None
+        self._refreshing = False
+        self._failures = 0
+        self._retry_at = None
+        self._last_error = None
+
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'refreshes': 0,
+            'refresh_errors': 0,
+            'stale_served': 0
+        }
+
+    def _store(self, token, now):
+        """Store a freshly loaded token, keeping the old one for the overlap window"""
+        if self._token is not None and token != self._token:
+            logger.info("API token rotated, accepting previous token during overlap window")
+            self._previous_token = self._token
+            self._previous_expires_at = now + self.rotation_overlap
+        self._token = token
+        self._loaded_at = now
+        self._failures = 0
+        self._retry_at = None
+        self._last_error = None
+
+    def _load(self):
+        """Call the loader and store the result; caller must not hold the lock"""
+        token = self._loader()
+        with self._lock:
+            self._store(token, self._clock())
+            self.stats['refreshes'] += 1
+        return token
+
+    def _record_failure(self, error, now):
+        """Back off after a failed load (lock held)"""
+        self.stats['refresh_errors'] += 1
+        self._failures += 1
+        self._retry_at = now + min(self.retry_base * 2 ** (self._failures - 1), self.retry_max)
+        self._last_error = error
+
+    def _refresh_in_background(self):
+        try:
+            # Shares the load lock with request threads, so SSM is called once at a time
+            with self._load_lock:
+                with self._lock:
+                    now = self._clock()
+                    if self._loaded_at is not None and now - self._loaded_at < self.ttl - self.refresh_ahead:
+                        # A request thread reloaded the token while we waited
+                        return
+                try:
+                    self._load()
+                except Exception as e:
+                    with self._lock:
+                        self._record_failure(e, now)
+                    logger.warning(f"Background token refresh failed: {e}")
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    def get_tokens(self):
+        """
+        Return the list of currently accepted tokens (current first)
+        Raises the loader's exception if no usable token is available
+        """
+        now = self._clock()
+        with self._lock:
+            age = None if self._loaded_at is None else now - self._loaded_at
+            if age is not None and age < self.ttl:
+                self.stats['hits'] += 1
+                if (age >= self.ttl - self.refresh_ahead and not self._refreshing
+                        and (self._retry_at is None or now >= self._retry_at)):
+                    self._refreshing = True
+                    threading.Thread(target=self._refresh_in_background, daemon=True).start()
+                return self._accepted(now)
+            if self._retry_at is not None and now < self._retry_at:
+                return self._serve_stale(now)
+            self.stats['misses'] += 1
+
+        # Only one thread goes to SSM on expiry; the others wait for its result
+        with self._load_lock:
+            with self._lock:
+                now = self._clock()
+                if self._loaded_at is not None and now - self._loaded_at < self.ttl:
+                    return self._accepted(now)
+                if self._retry_at is not None and now < self._retry_at:
+                    # The thread before us just failed: share its result
+                    return self._serve_stale(now)
+            try:
+                self._load()
+            except Exception as e:
+                with self._lock:
+                    self._record_failure(e, now)
+                    return self._serve_stale(now)
+
+        with self._lock:
+            return self._accepted(self._clock())
+
+    def _serve_stale(self, now):
+        """
+        Serve the last known token after a failed load (lock held)
+        Raises the load error once the token is older than ttl + stale_grace
+        """
+        if self._loaded_at is None or now - self._loaded_at >= self.ttl + self.stale_grace:
+            raise self._last_error
+        self.stats['stale_served'] += 1
+        logger.warning("SSM unavailable, serving stale API token")
+        return self._accepted(now)
+
+    def _accepted(self, now):
+        tokens = [self._token]
+        if self._previous_token is not None and now < self._previous_expires_at:
+            tokens.append(self._previous_token)
+        return tokens
+
+    def is_valid(self, provided_token):
+        """Check a provided token against the current (and overlapping previous) token"""
+        if not isinstance(provided_token, str):
+            return False
+        provided = provided_token.encode()
+        # Evaluate every candidate so timing does not reveal which one matched
+        matches = [hmac.compare_digest(provided, token.encode()) for token in self.get_tokens()]
+        return any(matches)
+
+    def snapshot(self):
+        """Return a copy of the cache counters for monitoring"""
+        with self._lock:
+            return dict(self.stats)
+
+    def clear(self):
+        """Drop cached tokens and reset counters"""
+        with self._lock:
+            self._token = None
+            self._loaded_at = None
+            self._previous_token = None
+            self._previous_expires_at = None
+            self._failures = 0
+            self._retry_at = None
+            self._last_error = None
+            for key in self.stats:
+                self.stats[key] = 0
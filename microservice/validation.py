@@ -0,0 +1,216 @@
+"""
+Fast-path request decoding and validation
+decode_json uses orjson when it is installed; EmailValidator checks an email payload
+(required and non-empty fields, types, lengths, sender format, timestamp range) in one
+pass over a field table built once at startup. iter_json_batch parses a batch body
+incrementally, one array element at a time.
+"""
+import re
+import json
+import codecs
+
+try:
+    import orjson
+except ImportError:  # Fall back to the standard library decoder
+    orjson = None
+
+# Unix timestamps accepted for email_timestream (years 2000 to 2100)
+MIN_TIMESTAMP = 946684800
+MAX_TIMESTAMP = 4102444800
+
+# A display name ("John Doe"), an address ("john@example.com") or both ("John Doe <john@example.com>");
+# control characters are rejected so the value is safe to use in mail headers
+_ADDRESS = r'[^\s@<>]+@[^\s@<>]+\.[^\s@<>]+'
+_NAME = r'[^\x00-\x1f\x7f<>@]+'
+SENDER_PATTERN = re.compile(rf'^(?:{_NAME}|{_ADDRESS}|{_NAME}<{_ADDRESS}>)$')
+
+# Field kinds of the compiled field table
+TEXT = 'text'
+SENDER = 'sender'
+TIMESTAMP = 'timestamp'
+
+
+def decode_json(body):
+    """
+    Decode a JSON request body (bytes); raises ValueError on invalid JSON
+    """
+    if orjson is not None:
+        return orjson.loads(body)
+    return json.loads(body)
+
+
+class JSONStreamReader:
+    """
+    Decodes JSON values one at a time from a body read in chunks with read(size)
+    """
+
+    WHITESPACE = ' \t\n\r'
+
+    def __init__(self, read, chunk_size=64 * 1024):
+        self._read = read
+        self._chunk_size = chunk_size
+        self._utf8 = codecs.getincrementaldecoder('utf-8')()
+        self._decoder = json.JSONDecoder()
+        self._buffer = ''
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self):
+        """
+        Append the next chunk of the body to the buffer; returns False at the end of the body
+        At least as much as is already buffered is read, so a value spanning many chunks is
+        retried a logarithmic number of times
+        """
+        if self._eof:
+            return False
+        chunk = self._read(max(self._chunk_size, len(self._buffer) - self._pos))
+        self._eof = not chunk
+        self._buffer = self._buffer[self._pos:] + self._utf8.decode(chunk, final=self._eof)
+        self._pos = 0
+        return True
+
+    def peek(self):
+        """
+        Next character after any whitespace, or '' at the end of the body
+        """
+        while True:
+            while self._pos < len(self._buffer) and self._buffer[self._pos] in self.WHITESPACE:
+                self._pos += 1
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._fill():
+                return ''
+
+    def expect(self, characters):
+        """
+        Consume the next character, which must be one of characters; returns it
+        """
+        character = self.peek()
+        if not character or character not in characters:
+            raise ValueError(f"Expected one of {characters!r}, found {character or 'end of body'!r}")
+        self._pos += 1
+        return character
+
+    def value(self):
+        """
+        Decode the next JSON value; raises ValueError if it is invalid
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+            except json.JSONDecodeError:
+                # Possibly a value cut off at the end of the buffer
+                if not self._fill():
+                    raise
+                continue
+            if end == len(self._buffer) and self._fill():
+                # A number or literal may continue in the next chunk
+                continue
+            self._pos = end
+            return value
+
+
+def iter_json_batch(read, chunk_size=64 * 1024):
+    """
+    Parse a {"token": ..., "data": [...]} batch body incrementally
+    Yields, in body order: ('token', value); ('array', None) when the data array starts,
+    then ('item', value) for each of its elements; or ('data', value) when data is not an
+    array. Only one element is held in memory at a time; other fields are skipped.
+    Raises ValueError when the body is not a JSON object.
+    """
+    reader = JSONStreamReader(read, chunk_size)
+    reader.expect('{')
+    if reader.peek() == '}':
+        reader.expect('}')
+    else:
+        while True:
+            key = reader.value()
+            if not isinstance(key, str):
+                raise ValueError('Expected a field name')
+            reader.expect(':')
+            if key == 'data' and reader.peek() == '[':
+                reader.expect('[')
+                yield 'array', None
+                if reader.peek() == ']':
+                    reader.expect(']')
+                else:
+                    while True:
+                        yield 'item', reader.value()
+                        if reader.expect(',]') == ']':
+                            break
+            else:
+                value = reader.value()
+                if key in ('token', 'data'):
+                    yield key, value
+            if reader.expect(',}') == '}':
+                break
+    if reader.peek():
+        raise ValueError('Unexpected content after the JSON object')
+
+
+class EmailValidator:
+    """
+    Compiled single-pass validator for the `data` object of a /process request
+    Returns the same error messages as the original field and timestamp checks
+
+    Args:
+        required_fields (list): Fields that must be present and non-empty
+        max_lengths (dict): Field -> maximum length in characters
+        sender_pattern (re.Pattern): Accepted email_sender values
+    """
+
+    def __init__(self, required_fields, max_lengths, sender_pattern=SENDER_PATTERN):
+        # (name, kind, max_length) in the order errors are reported
+        self._fields = tuple(
+            (name, TIMESTAMP if name == 'email_timestream' else SENDER if name == 'email_sender' else TEXT,
+             max_lengths.get(name))
+            for name in required_fields
+        )
+        self._sender_match = sender_pattern.match
+
+    def validate(self, data):
+        """
+        Returns tuple: (is_valid, error_message)
+        """
+        if not isinstance(data, dict):
+            return False, "Data must be a dictionary"
+
+        missing = []
+        empty = []
+        error = None
+        timestamp = None
+        for name, kind, max_length in self._fields:
+            value = data.get(name)
+            if not value:
+                (empty if name in data else missing).append(name)
+            elif error is not None:
+                continue
+            elif kind is TIMESTAMP:
+                # Fractional seconds are truncated, as int() did in the original check
+                if isinstance(value, (str, int, float)):
+                    timestamp = value
+                else:
+                    error = "Invalid timestamp: Invalid timestamp format"
+            elif not isinstance(value, str):
+                error = f"Field {name} must be a string"
+            elif max_length is not None and len(value) > max_length:
+                error = f"Field {name} exceeds {max_length} characters"
+            elif kind is SENDER and not self._sender_match(value):
+                error = "Invalid email_sender format"
+
+        if missing:
+            return False, f"Missing required fields: {', '.join(missing)}"
+        if empty:
+            return False, f"Empty fields not allowed: {', '.join(empty)}"
+        if error is not None:
+            return False, error
+
+        if timestamp is not None:
+            try:
+                timestamp = int(timestamp)
+            except (ValueError, OverflowError):
+                return False, "Invalid timestamp: Invalid timestamp format"
+            if timestamp < MIN_TIMESTAMP or timestamp > MAX_TIMESTAMP:
+                return False, "Invalid timestamp: Timestamp out of reasonable range"
+        return True, None
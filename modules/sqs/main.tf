@@ -1,25 +1,38 @@
+locals {
+  # FIFO queue names must end in .fifo, and the DLQ of a FIFO queue must be FIFO too
+  name_suffix = var.fifo_queue ? ".fifo" : ""
+}
+
 # Optional Dead Letter Queue
 resource "aws_sqs_queue" "dlq" {
   count = var.create_dlq ? 1 : 0
 
-  name                       = "${var.queue_name}-dlq"
+  name                       = "${var.queue_name}-dlq${local.name_suffix}"
+  fifo_queue                 = var.fifo_queue ? true : null
   message_retention_seconds  = var.dlq_message_retention_seconds
   sqs_managed_sse_enabled    = var.kms_master_key_id == null ? true : false
   kms_master_key_id          = var.kms_master_key_id
 
   tags = merge(var.tags, {
-    Name = "${var.queue_name}-dlq"
+    Name = "${var.queue_name}-dlq${local.name_suffix}"
   })
 }
 
 resource "aws_sqs_queue" "main" {
-  name                       = var.queue_name
+  name                       = "${var.queue_name}${local.name_suffix}"
   delay_seconds              = var.delay_seconds
   max_message_size           = var.max_message_size
   message_retention_seconds  = var.message_retention_seconds
   receive_wait_time_seconds  = var.receive_wait_time_seconds
   visibility_timeout_seconds = var.visibility_timeout_seconds
 
+  # FIFO queues keep order within a message group; with high throughput the
+  # per-group limits let many groups be consumed in parallel
+  fifo_queue                  = var.fifo_queue ? true : null
+  content_based_deduplication = var.fifo_queue ? var.content_based_deduplication : null
+  deduplication_scope         = var.fifo_queue ? (var.high_throughput_fifo ? "messageGroup" : "queue") : null
+  fifo_throughput_limit       = var.fifo_queue ? (var.high_throughput_fifo ? "perMessageGroupId" : "perQueue") : null
+
   # Enable encryption if KMS key is provided
   sqs_managed_sse_enabled = var.kms_master_key_id == null ? true : false
   kms_master_key_id       = var.kms_master_key_id
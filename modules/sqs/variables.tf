@@ -68,3 +68,21 @@ variable "tags" {
   type        = map(string)
   default     = {}
 }
+
+variable "fifo_queue" {
+  description = "Whether to create a FIFO queue (the .fifo suffix is added to the queue and DLQ names)"
+  type        = bool
+  default     = false
+}
+
+variable "content_based_deduplication" {
+  description = "FIFO only: deduplicate messages by a SHA-256 of the body when the sender sets no MessageDeduplicationId"
+  type        = bool
+  default     = false
+}
+
+variable "high_throughput_fifo" {
+  description = "FIFO only: scope deduplication and throughput limits to each message group instead of the whole queue"
+  type        = bool
+  default     = true
+}
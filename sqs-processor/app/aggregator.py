@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+"""
+Aggregation of many SQS messages into a single S3 object.
+
+Records are appended to a gzip-compressed newline-delimited JSON batch.
+A batch is written to S3 when it reaches a record count, an uncompressed
+size or an age threshold, followed by a manifest listing the message IDs it
+contains. Messages are only acknowledged (deleted from SQS) after both the
+batch object and its manifest have been written.
+
+Batch objects are streamed to S3 while records are added (see multipart.py),
+so a batch is never held in memory in full. Each batch has its own lock for
+encoding and uploading; the aggregator lock only guards the table of open
+batches, so a slow part upload for one partition never blocks other
+partitions, the age flusher or readers of the aggregator's state.
+"""
+
+import gzip
+import json
+import time
+import uuid
+import logging
+import threading
+from datetime import datetime
+from metrics import S3_UPLOAD_LATENCY, timed
+
+logger = logging.getLogger(__name__)
+
+
+class BatchBoundary(Exception):
+    """The record cannot join the batch it was asked to follow (add(after=...))."""
+
+
+class NDJSONGzipEncoder:
+    """Streams records as gzip-compressed newline-delimited JSON."""
+
+    extension = 'ndjson.gz'
+    content_type = 'application/x-ndjson'
+    content_encoding = 'gzip'
+
+    def __init__(self, fileobj):
+        self._gzip = gzip.GzipFile(fileobj=fileobj, mode='wb')
+
+    def write(self, record):
+        """Append a record; returns the number of uncompressed bytes written."""
+        line = json.dumps(record, separators=(',', ':')).encode('utf-8') + b'\n'
+        self._gzip.write(line)
+        return len(line)
+
+    def close(self):
+        self._gzip.close()
+
+
+class Batch:
+    """
+    An open batch: its encoder, destination writer and the messages it contains.
+
+    The encoder is created by the first write, since encoders may write
+    headers to the destination. `lock` serialises writes to the encoder; `closed` is set (under `lock`)
+    once the batch has been taken out of the aggregator to be flushed or
+    failed, after which no more records may be written to it.
+    """
+
+    def __init__(self, batch_id, partition, object_key, writer, encoder=None):
+        self.batch_id = batch_id
+        self.partition = partition
+        self.object_key = object_key
+        self.created_at = time.time()
+        self.writer = writer
+        self.encoder = encoder
+        self.messages = []
+        self.raw_bytes = 0
+        self.lock = threading.Lock()
+        self.closed = False
+
+
+class BatchAggregator:
+    """
+    Buffers records per partition and writes them as batch objects.
+
+    Args:
+        open_object (callable): open_object(key, content_type, content_encoding, metadata)
+            returning a writable file object with close() and abort()
+        write_object (callable): write_object(key, body, content_type, content_encoding, metadata)
+        on_flushed (callable): on_flushed(messages, success) after a batch is written or fails
+        key_prefix (str): S3 prefix for batch and manifest objects
+        max_records (int): Flush when a batch holds this many records
+        max_bytes (int): Flush when a batch holds this many uncompressed bytes
+        max_age (float): Flush when the oldest record in a batch is this old (seconds)
+        encoder_class: Encoder used for batch objects
+        partition_for (callable): partition_for(record) -> partition path, defaults to processing hour
+    """
+
+    def __init__(self, open_object, write_object, on_flushed, key_prefix, max_records=1000,
+                 max_bytes=32 * 1024 * 1024, max_age=60, encoder_class=NDJSONGzipEncoder,
+                 partition_for=None):
+        self._open_object = open_object
+        self._write_object = write_object
+        self._on_flushed = on_flushed
+        self.key_prefix = key_prefix
+        self.max_records = max_records
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._encoder_class = encoder_class
+        self._partition_for = partition_for or (lambda record: datetime.utcnow().strftime('%Y/%m/%d/%H'))
+        self._batches = {}
+        self._buffered = 0  # Messages added and not yet acknowledged; read without the lock
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._timer = None
+        self.stats = {'batches_written': 0, 'batches_failed': 0, 'records_written': 0}
+
+    def start(self):
+        """Start the thread that flushes batches reaching max_age."""
+        self._timer = threading.Thread(target=self._run_timer, name='batch-age-flusher', daemon=True)
+        self._timer.start()
+
+    def add(self, message, record, after=None):
+        """
+        Add a message's record to the open batch of its partition.
+        Flushes the batch from the calling thread when it is full.
+
+        With `after` (a batch ID returned by an earlier add), the record is
+        only added to that batch, right behind the records already in it;
+        BatchBoundary is raised, without writing anything, if that batch is
+        no longer open or the record belongs to another partition.
+
+        Returns:
+            str: ID of the batch the record was added to
+        """
+        partition = self._partition_for(record)
+        full = failed = None
+        while True:
+            with self._lock:
+                batch = self._batches.get(partition)
+                if after is not None and (batch is None or batch.batch_id != after):
+                    raise BatchBoundary(f"Batch {after} is not open for partition {partition}")
+                if batch is None:
+                    batch = self._batches[partition] = self._open_batch(partition)
+            # Encoding may upload a part to S3: hold only this batch's lock
+            with batch.lock:
+                if batch.closed:
+                    if after is not None:
+                        raise BatchBoundary(f"Batch {after} was closed")
+                    # Taken for flushing after we looked it up; use its successor
+                    continue
+                try:
+                    if batch.encoder is None:
+                        batch.encoder = self._encoder_class(batch.writer)
+                    batch.raw_bytes += batch.encoder.write(record)
+                except Exception:
+                    # The stream to S3 is broken: give up on the whole batch
+                    batch.closed = True
+                    failed = batch
+                else:
+                    batch.messages.append(message)
+                    with self._lock:
+                        self._buffered += 1
+                    if len(batch.messages) >= self.max_records or batch.raw_bytes >= self.max_bytes:
+                        batch.closed = True
+                        full = batch
+            break
+        if full is not None or failed is not None:
+            self._detach(partition, batch)
+        if failed is not None:
+            self._fail(failed)
+            raise RuntimeError(f"Batch {failed.batch_id} failed while streaming to S3")
+        if full is not None:
+            self._flush(full)
+        return batch.batch_id
+
+    def _open_batch(self, partition):
+        batch_id = str(uuid.uuid4())
+        object_key = f"{self.key_prefix}batches/{partition}/{batch_id}.{self._encoder_class.extension}"
+        writer = self._open_object(
+            object_key,
+            self._encoder_class.content_type,
+            self._encoder_class.content_encoding,
+            {'batch-id': batch_id}
+        )
+        return Batch(batch_id, partition, object_key, writer)
+
+    def _detach(self, partition, batch):
+        """Remove a closed batch from the open batches, unless already replaced."""
+        with self._lock:
+            if self._batches.get(partition) is batch:
+                del self._batches[partition]
+
+    def _take(self, batches):
+        """
+        Close batches removed from the open batches for flushing, waiting for
+        any write in progress; returns those not closed by a writer already.
+        """
+        taken = []
+        for batch in batches:
+            with batch.lock:
+                if batch.closed:
+                    continue
+                batch.closed = True
+            if batch.messages:
+                taken.append(batch)
+            else:
+                # Opened by a writer that has not written to it yet
+                batch.writer.abort()
+        return taken
+
+    def _fail(self, batch):
+        batch.writer.abort()
+        logger.error(f"Error writing batch {batch.batch_id} ({len(batch.messages)} records)")
+        with self._lock:
+            self.stats['batches_failed'] += 1
+            self._buffered -= len(batch.messages)
+        self._on_flushed(batch.messages, False)
+
+    def _run_timer(self):
+        while not self._stop.wait(1):
+            self.flush_expired()
+
+    def flush_expired(self):
+        """Flush batches whose oldest record has reached max_age."""
+        now = time.time()
+        with self._lock:
+            expired = [
+                self._batches.pop(partition)
+                for partition, batch in list(self._batches.items())
+                if now - batch.created_at >= self.max_age
+            ]
+        for batch in self._take(expired):
+            self._flush(batch)
+
+    def flush_all(self):
+        """Flush every open batch (used on shutdown)."""
+        with self._lock:
+            batches = list(self._batches.values())
+            self._batches.clear()
+        for batch in self._take(batches):
+            self._flush(batch)
+
+    def stop(self, timeout=None):
+        """
+        Stop the age flusher and write out open batches, waiting at most
+        `timeout` seconds. Returns False if batches were still being written
+        then; their messages stay unsettled, for the caller to release.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        def remaining():
+            return None if deadline is None else max(deadline - time.monotonic(), 0)
+
+        self._stop.set()
+        if self._timer is not None:
+            self._timer.join(remaining())
+        flusher = threading.Thread(target=self.flush_all, name='batch-final-flush', daemon=True)
+        flusher.start()
+        flusher.join(remaining())
+        if flusher.is_alive():
+            logger.warning(f"Open batches still being written after {timeout}s; leaving "
+                           f"{self._buffered} message(s) unsettled")
+            return False
+        return True
+
+    def buffered_count(self):
+        """
+        Number of messages in batches not yet written; a plain read, so
+        metrics and health probes never wait for the aggregator lock.
+        """
+        return self._buffered
+
+    def _flush(self, batch):
+        manifest_key = f"{self.key_prefix}manifests/{batch.partition}/{batch.batch_id}.json"
+        message_ids = [message['MessageId'] for message in batch.messages]
+
+        try:
+            with timed(S3_UPLOAD_LATENCY.labels(kind='batch')):
+                self._finish(batch, manifest_key, message_ids)
+        except Exception as e:
+            logger.error(f"Error writing batch {batch.batch_id}: {e}")
+            self._fail(batch)
+            return
+
+        logger.info(f"Wrote batch of {len(message_ids)} record(s) to {batch.object_key}")
+        with self._lock:
+            self.stats['batches_written'] += 1
+            self.stats['records_written'] += len(message_ids)
+            self._buffered -= len(message_ids)
+        self._on_flushed(batch.messages, True)
+
+    def _finish(self, batch, manifest_key, message_ids):
+        """Complete the batch object, then write its manifest."""
+        batch.encoder.close()
+        batch.writer.close()
+        manifest = {
+            'batch_id': batch.batch_id,
+            'object_key': batch.object_key,
+            'record_count': len(message_ids),
+            'uncompressed_bytes': batch.raw_bytes,
+            'message_ids': message_ids,
+            'created_at': datetime.utcnow().isoformat()
+        }
+        self._write_object(
+            manifest_key,
+            json.dumps(manifest, indent=2).encode('utf-8'),
+            'application/json',
+            None,
+            {'batch-id': batch.batch_id}
+        )
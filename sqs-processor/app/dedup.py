@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+Seen-set of archived messages for idempotent processing.
+
+SQS delivers at least once, so the same MessageId can arrive again after a
+visibility timeout or a failed delete. Message keys are remembered here
+once their S3 object has been written; a redelivery found in the set is
+deleted from the queue without touching S3.
+
+Keys live in an in-memory LRU bounded by `max_entries` and expire after
+`ttl` seconds. With a `path`, they are also stored in SQLite so the set
+survives a process restart (e.g. on a volume shared by container restarts).
+"""
+
+import time
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class SeenSet:
+    """
+    Args:
+        max_entries (int): Keys kept in memory
+        ttl (float): Seconds a key is remembered
+        path (str): Optional SQLite database file for persistence
+    """
+
+    # Expired rows are purged from SQLite every this many additions
+    PURGE_EVERY = 1000
+
+    def __init__(self, max_entries=100000, ttl=86400, path=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.path = path
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        self._added = 0
+        self.stats = {'hits': 0, 'misses': 0}
+        if path:
+            self._open_db(path)
+
+    def _open_db(self, path):
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS seen (key TEXT PRIMARY KEY, seen_at REAL NOT NULL)')
+        self._purge()
+        logger.info(f"Loaded dedup seen-set from {path}")
+
+    def _purge(self):
+        self._db.execute('DELETE FROM seen WHERE seen_at < ?', (time.time() - self.ttl,))
+
+    def contains(self, key):
+        """True if the key was added less than `ttl` seconds ago."""
+        now = time.time()
+        with self._lock:
+            seen_at = self._entries.get(key)
+            if seen_at is None and self._db is not None:
+                row = self._db.execute('SELECT seen_at FROM seen WHERE key = ?', (key,)).fetchone()
+                if row is not None:
+                    seen_at = row[0]
+                    self._remember(key, seen_at)
+            if seen_at is not None and now - seen_at < self.ttl:
+                self._entries.move_to_end(key)
+                self.stats['hits'] += 1
+                return True
+            self.stats['misses'] += 1
+            return False
+
+    def add(self, key):
+        """Remember a key as processed."""
+        self.add_many([key])
+
+    def add_many(self, keys):
+        """Remember several keys in one transaction."""
+        now = time.time()
+        with self._lock:
+            for key in keys:
+                self._remember(key, now)
+            if self._db is None:
+                return
+            self._db.execute('BEGIN')
+            self._db.executemany(
+                'INSERT OR REPLACE INTO seen (key, seen_at) VALUES (?, ?)',
+                [(key, now) for key in keys]
+            )
+            self._db.execute('COMMIT')
+            self._added += len(keys)
+            if self._added >= self.PURGE_EVERY:
+                self._added = 0
+                self._purge()
+
+    def _remember(self, key, seen_at):
+        self._entries[key] = seen_at
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def close(self):
+        if self._db is not None:
+            with self._lock:
+                self._db.close()
+                self._db = None
@@ -1,54 +1,201 @@
 #!/usr/bin/env python3
 """
-Health check endpoint for the SQS processor.
-Simple HTTP server that returns health status.
+Status endpoints for the SQS processor.
+
+A threaded HTTP server answers each probe on its own thread, so a slow
+metrics scrape never delays a liveness check. Handlers only read the
+StatusBoard's current snapshot, which the processing loop replaces
+atomically; they never take a lock the processor holds.
+
+Endpoints:
+    /livez   - 200 while the processing loop keeps making progress (or is shutting down)
+    /readyz  - 200 while polls succeed and the pipeline is not stuck in backpressure;
+               503 once a shutdown has started
+    /health  - legacy status document (always 200)
+    /metrics - Prometheus metrics
 """
 
 import json
-from http.server import HTTPServer, BaseHTTPRequestHandler
-import threading
+import time
 import logging
+import threading
+from types import MappingProxyType
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from metrics import render_metrics
 
 logger = logging.getLogger(__name__)
 
-# Import health_status from processor
-import sys
-sys.path.append('/app')
+# Statuses after SIGTERM: finishing or releasing in-flight messages, then done
+SHUTDOWN_STATES = ('draining', 'stopped')
+
+
+class StatusBoard:
+    """
+    Copy-on-write processor status.
+
+    Writers build a new immutable snapshot under a lock and publish it with
+    a single reference assignment; readers use the published snapshot
+    without locking.
+
+    Args:
+        max_poll_age (float): Seconds without a successful poll before the pod is not ready
+        max_backpressure (float): Seconds the pipeline may stay full before the pod is not ready
+        max_stall (float): Seconds without loop progress before the pod is not live
+    """
+
+    def __init__(self, max_poll_age=120, max_backpressure=60, max_stall=300):
+        self.max_poll_age = max_poll_age
+        self.max_backpressure = max_backpressure
+        self.max_stall = max_stall
+        self._lock = threading.Lock()
+        now = time.time()
+        self._snapshot = MappingProxyType({
+            'status': 'starting',
+            'last_poll': None,
+            'messages_processed': 0,
+            'saturated_since': None,
+            'last_progress': now
+        })
+
+    def snapshot(self):
+        """Current status; an immutable mapping."""
+        return self._snapshot
+
+    def _publish(self, **changes):
+        with self._lock:
+            state = dict(self._snapshot)
+            # Late poll results must not overwrite the shutdown states
+            if state['status'] in SHUTDOWN_STATES and changes.get('status') in ('healthy', 'unhealthy'):
+                del changes['status']
+            state.update(changes)
+            self._snapshot = MappingProxyType(state)
+
+    def poll_succeeded(self):
+        """Record a successful receive (with or without messages)."""
+        now = time.time()
+        self._publish(status='healthy', last_poll=now, saturated_since=None, last_progress=now)
+
+    def poll_failed(self):
+        """Record a failed receive or loop iteration."""
+        self._publish(status='unhealthy', last_progress=time.time())
+
+    def saturated(self):
+        """Record that the loop is waiting for pipeline capacity."""
+        now = time.time()
+        if self._snapshot['saturated_since'] is None:
+            self._publish(saturated_since=now, last_progress=now)
+        else:
+            self._publish(last_progress=now)
+
+    def set_status(self, status):
+        self._publish(status=status, last_progress=time.time())
+
+    def messages_processed(self, count=1):
+        with self._lock:
+            state = dict(self._snapshot)
+            state['messages_processed'] += count
+            self._snapshot = MappingProxyType(state)
+
+    def liveness(self, now=None):
+        """Return (alive, details)."""
+        state = self._snapshot
+        now = now or time.time()
+        stalled_for = now - state['last_progress']
+        alive = state['status'] in SHUTDOWN_STATES or stalled_for <= self.max_stall
+        return alive, {'status': state['status'], 'stalled_seconds': round(stalled_for, 1)}
+
+    def readiness(self, now=None):
+        """Return (ready, details) with the reasons the pod is not ready."""
+        state = self._snapshot
+        now = now or time.time()
+        reasons = []
+        if state['status'] != 'healthy':
+            reasons.append(f"status is {state['status']}")
+        poll_age = None if state['last_poll'] is None else now - state['last_poll']
+        if poll_age is not None and poll_age > self.max_poll_age:
+            reasons.append(f"no successful poll for {int(poll_age)}s")
+        saturated_for = None if state['saturated_since'] is None else now - state['saturated_since']
+        if saturated_for is not None and saturated_for > self.max_backpressure:
+            reasons.append(f"pipeline full for {int(saturated_for)}s")
+        details = {
+            'status': state['status'],
+            'last_poll_age_seconds': None if poll_age is None else round(poll_age, 1),
+            'backpressure_seconds': None if saturated_for is None else round(saturated_for, 1),
+            'reasons': reasons
+        }
+        return not reasons, details
+
+    def legacy_health(self):
+        """Document served on /health."""
+        state = self._snapshot
+        last_poll = state['last_poll']
+        return {
+            'status': state['status'],
+            'last_poll': None if last_poll is None else time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(last_poll)),
+            'messages_processed': state['messages_processed']
+        }
 
 
 class HealthCheckHandler(BaseHTTPRequestHandler):
-    """HTTP handler for health check endpoint."""
+    """HTTP handler for the status endpoints."""
+    
+    # Drop clients that stall mid-request instead of holding a thread
+    timeout = 5
+    board = None
+    extra_details = None
     
     def do_GET(self):
         """Handle GET requests."""
-        if self.path == '/health':
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
-            
-            try:
-                from processor import health_status
-                response = {
-                    'status': health_status.get('status', 'unknown'),
-                    'last_poll': health_status.get('last_poll'),
-                    'messages_processed': health_status.get('messages_processed', 0)
-                }
-                self.wfile.write(json.dumps(response).encode())
-            except Exception as e:
-                self.wfile.write(json.dumps({'status': 'error', 'message': str(e)}).encode())
-        else:
-            self.send_response(404)
-            self.end_headers()
+        try:
+            if self.path == '/livez':
+                alive, details = self.board.liveness()
+                self._send_json(200 if alive else 503, details)
+            elif self.path == '/readyz':
+                ready, details = self.board.readiness()
+                if self.extra_details is not None:
+                    details.update(self.extra_details())
+                self._send_json(200 if ready else 503, details)
+            elif self.path == '/health':
+                self._send_json(200, self.board.legacy_health())
+            elif self.path == '/metrics':
+                body, content_type = render_metrics()
+                self._send(200, body, content_type)
+            else:
+                self._send(404, b'', 'text/plain')
+        except Exception as e:
+            self._send_json(500, {'status': 'error', 'message': str(e)})
+    
+    def _send_json(self, status_code, body):
+        self._send(status_code, json.dumps(body).encode(), 'application/json')
+    
+    def _send(self, status_code, body, content_type):
+        self.send_response(status_code)
+        self.send_header('Content-type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
     
     def log_message(self, format, *args):
         """Suppress default logging."""
         pass
 
 
-def start_health_server(port=8080):
-    """Start the health check HTTP server in a separate thread."""
-    server = HTTPServer(('', port), HealthCheckHandler)
-    thread = threading.Thread(target=server.serve_forever, daemon=True)
+def start_health_server(board, port=8080, extra_details=None):
+    """
+    Start the status server in a separate thread.
+    
+    Args:
+        board (StatusBoard): Status read by the endpoints
+        port (int): Listen port
+        extra_details (callable): Optional callable returning more fields for /readyz
+    """
+    handler = type('BoundHealthCheckHandler', (HealthCheckHandler,), {
+        'board': board,
+        'extra_details': staticmethod(extra_details) if extra_details else None
+    })
+    server = ThreadingHTTPServer(('', port), handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name='status-server', daemon=True)
     thread.start()
     logger.info(f"Health check server started on port {port}")
     return server
@@ -3,9 +3,10 @@
 Main entry point that starts both the health check server and the processor.
 """
 
+import os
 import logging
 from health import start_health_server
-from processor import main
+from processor import main, status_board, pipeline_details
 
 # Configure logging
 logging.basicConfig(
@@ -16,8 +17,9 @@ logger = logging.getLogger(__name__)
 
 if __name__ == '__main__':
     # Start health check server
-    start_health_server(port=8080)
-    logger.info("Health check endpoint available at http://localhost:8080/health")
+    port = int(os.getenv('HEALTH_PORT', '8080'))
+    start_health_server(status_board, port=port, extra_details=pipeline_details)
+    logger.info(f"Status endpoints available at http://localhost:{port}/livez, /readyz, /health and /metrics")
     
     # Start the main processor
     main()
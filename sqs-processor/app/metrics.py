@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+"""
+Prometheus metrics for the SQS processor.
+
+Besides per-pod throughput and upload latency, a background sampler exports
+the queue backlog (ApproximateNumberOfMessages, ApproximateAgeOfOldestMessage)
+so an external-metrics autoscaler can scale on backlog per pod.
+"""
+
+import time
+import logging
+import threading
+from prometheus_client import Counter, Gauge, Histogram, REGISTRY, CONTENT_TYPE_LATEST, generate_latest
+
+logger = logging.getLogger(__name__)
+
+QUEUE_MESSAGES = Gauge(
+    'sqs_processor_queue_messages',
+    'ApproximateNumberOfMessages visible in the SQS queue'
+)
+
+QUEUE_MESSAGES_NOT_VISIBLE = Gauge(
+    'sqs_processor_queue_messages_not_visible',
+    'ApproximateNumberOfMessagesNotVisible (received by some consumer, not yet deleted)'
+)
+
+QUEUE_OLDEST_MESSAGE_AGE = Gauge(
+    'sqs_processor_queue_oldest_message_age_seconds',
+    'ApproximateAgeOfOldestMessage in the SQS queue'
+)
+
+MESSAGES_RECEIVED = Counter(
+    'sqs_processor_messages_received_total',
+    'Messages received from SQS by this pod'
+)
+
+MESSAGES_PROCESSED = Counter(
+    'sqs_processor_messages_processed_total',
+    'Messages archived and deleted from SQS by this pod'
+)
+
+MESSAGES_FAILED = Counter(
+    'sqs_processor_messages_failed_total',
+    'Messages that could not be archived and were left for redelivery'
+)
+
+DUPLICATES_SUPPRESSED = Counter(
+    'sqs_processor_duplicates_suppressed_total',
+    'Redelivered messages deleted without rewriting S3 because they were already archived'
+)
+
+PAYLOADS_DECODED = Counter(
+    'sqs_processor_payloads_decoded_total',
+    'Compressed or claim-check message bodies resolved before archiving, by encoding',
+    ['encoding']
+)
+
+IN_FLIGHT = Gauge(
+    'sqs_processor_in_flight_messages',
+    'Messages received by this pod and not yet deleted or released'
+)
+
+ACTIVE_MESSAGE_GROUPS = Gauge(
+    'sqs_processor_active_message_groups',
+    'FIFO message groups with messages queued or being processed (ordered mode)'
+)
+
+GROUP_WAIT = Histogram(
+    'sqs_processor_group_wait_seconds',
+    'Time a message waited behind earlier messages of its FIFO group before processing started',
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0)
+)
+
+S3_UPLOAD_LATENCY = Histogram(
+    'sqs_processor_s3_upload_duration_seconds',
+    'Time to write an object to S3 (one message, or one batch with its manifest)',
+    ['kind'],
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+)
+
+SINK_RECORDS = Counter(
+    'sqs_processor_sink_records_total',
+    'Records handed to each output sink, by outcome (written, failed, dropped)',
+    ['sink', 'outcome']
+)
+
+SINK_ACK_LATENCY = Histogram(
+    'sqs_processor_sink_ack_duration_seconds',
+    'Time from handing a record to a sink until the sink acknowledged it (includes batching delay)',
+    ['sink'],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+)
+
+SINK_BUFFERED = Gauge(
+    'sqs_processor_sink_buffered_records',
+    'Records handed to a sink and not yet acknowledged (queued writes or open batches)',
+    ['sink']
+)
+
+AWS_RETRIES = Counter(
+    'sqs_processor_aws_retries_total',
+    'AWS calls retried by the resilience layer, by service and error code',
+    ['service', 'code']
+)
+
+CIRCUIT_BREAKER_OPENS = Counter(
+    'sqs_processor_circuit_breaker_opens_total',
+    'Times a dependency circuit breaker opened',
+    ['service']
+)
+
+CIRCUIT_BREAKER_STATE = Gauge(
+    'sqs_processor_circuit_breaker_state',
+    'Circuit breaker state by dependency (0 closed, 1 half open, 2 open)',
+    ['service']
+)
+BREAKER_STATE_VALUES = {'closed': 0, 'half_open': 1, 'open': 2}
+
+QUEUE_ATTRIBUTES = [
+    'ApproximateNumberOfMessages',
+    'ApproximateNumberOfMessagesNotVisible',
+    'ApproximateAgeOfOldestMessage'
+]
+
+
+class QueueDepthSampler:
+    """
+    Periodically samples queue attributes into the backlog gauges.
+
+    Args:
+        get_queue_attributes (callable): Returns the Attributes dict for QUEUE_ATTRIBUTES
+        interval (float): Seconds between samples
+    """
+
+    def __init__(self, get_queue_attributes, interval=15):
+        self._get_queue_attributes = get_queue_attributes
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Start sampling in a background thread."""
+        self._thread = threading.Thread(target=self._run, name='queue-depth-sampler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop sampling."""
+        self._stop.set()
+
+    def _run(self):
+        while True:
+            self.sample()
+            if self._stop.wait(self.interval):
+                return
+
+    def sample(self):
+        """Read the queue attributes once and update the gauges."""
+        try:
+            attributes = self._get_queue_attributes()
+        except Exception as e:
+            logger.warning(f"Could not sample queue attributes: {e}")
+            return
+        QUEUE_MESSAGES.set(int(attributes.get('ApproximateNumberOfMessages', 0)))
+        QUEUE_MESSAGES_NOT_VISIBLE.set(int(attributes.get('ApproximateNumberOfMessagesNotVisible', 0)))
+        QUEUE_OLDEST_MESSAGE_AGE.set(int(attributes.get('ApproximateAgeOfOldestMessage', 0)))
+
+
+class timed:
+    """Context manager observing elapsed time on a histogram child."""
+
+    def __init__(self, histogram):
+        self._histogram = histogram
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._histogram.observe(time.perf_counter() - self._start)
+        return False
+
+
+def record_retry(service, code):
+    """Count one retried AWS call."""
+    AWS_RETRIES.labels(service=service, code=code).inc()
+
+
+def record_breaker_state(service, state):
+    """Export a circuit breaker state change."""
+    CIRCUIT_BREAKER_STATE.labels(service=service).set(BREAKER_STATE_VALUES[state])
+    if state == 'open':
+        CIRCUIT_BREAKER_OPENS.labels(service=service).inc()
+
+
+def render_metrics():
+    """Return (body, content_type) for the /metrics endpoint."""
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
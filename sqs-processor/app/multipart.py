@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""
+Streaming S3 writer built on multipart upload.
+
+MultipartUploadWriter is a write-only file object: data is buffered until a
+part is full, then uploaded in the background while writing continues.
+At most `max_pending_parts` parts are buffered or uploading at once, so
+memory stays flat regardless of object size; writers given the same `slots`
+semaphore share that limit, so it also holds however many objects are
+open. Objects smaller than one part
+are written with a single PutObject; on failure the multipart upload is
+aborted so no orphaned parts are left behind.
+"""
+
+import io
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# S3 requires every part except the last to be at least 5 MiB
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+
+class MultipartUploadWriter(io.RawIOBase):
+    """
+    Args:
+        s3_client: boto3 S3 client
+        bucket (str): Destination bucket
+        key (str): Destination key
+        executor (Executor): Pool used for part uploads (shared between writers)
+        part_size (int): Bytes per part
+        max_pending_parts (int): Parts that may be in flight for this object
+        slots (Semaphore): Part slots shared with other writers, replacing the
+            writer's own `max_pending_parts` slots
+        content_type, content_encoding, metadata: Object properties
+        call (callable): call(fn, **kwargs) wrapper for S3 requests (e.g. retries)
+    """
+
+    def __init__(self, s3_client, bucket, key, executor, part_size=8 * 1024 * 1024,
+                 max_pending_parts=4, content_type='application/octet-stream',
+                 content_encoding=None, metadata=None, call=None, slots=None):
+        super().__init__()
+        self._s3 = s3_client
+        self._call = call or (lambda fn, **kwargs: fn(**kwargs))
+        self.bucket = bucket
+        self.key = key
+        self._executor = executor
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        self._slots = slots if slots is not None else threading.BoundedSemaphore(max_pending_parts)
+        self._object_params = {'ContentType': content_type, 'Metadata': metadata or {}}
+        if content_encoding:
+            self._object_params['ContentEncoding'] = content_encoding
+
+        self._buffer = bytearray()
+        self._upload_id = None
+        self._futures = []
+        self._part_number = 0
+        self._position = 0
+        self._error = None
+        self._finished = False
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def write(self, data):
+        if self._finished:
+            raise ValueError("write to a closed MultipartUploadWriter")
+        self._raise_if_failed()
+        self._buffer += data
+        self._position += len(data)
+        while len(self._buffer) >= self.part_size:
+            self._upload_part(self.part_size)
+        return len(data)
+
+    def _raise_if_failed(self):
+        if self._error is not None:
+            raise self._error
+
+    def _upload_part(self, size):
+        """Upload the first `size` bytes of the buffer as the next part."""
+        if self._upload_id is None:
+            response = self._call(
+                self._s3.create_multipart_upload, Bucket=self.bucket, Key=self.key, **self._object_params
+            )
+            self._upload_id = response['UploadId']
+        self._part_number += 1
+        # Blocks while all part slots are in flight (bounded memory); the part
+        # is only copied out of the buffer once it has a slot
+        self._slots.acquire()
+        part = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        self._futures.append(self._executor.submit(self._send_part, self._part_number, part))
+
+    def _send_part(self, part_number, part):
+        try:
+            response = self._call(
+                self._s3.upload_part,
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self._upload_id,
+                PartNumber=part_number,
+                Body=part
+            )
+            return {'PartNumber': part_number, 'ETag': response['ETag']}
+        except Exception as e:
+            self._error = e
+            raise
+        finally:
+            self._slots.release()
+
+    def close(self):
+        """Upload the remaining data and complete the object."""
+        if self._finished:
+            return
+        try:
+            if self._upload_id is None:
+                # Small object: a single request is cheaper than a multipart upload
+                self._call(
+                    self._s3.put_object, Bucket=self.bucket, Key=self.key, Body=bytes(self._buffer), **self._object_params
+                )
+            else:
+                if self._buffer:
+                    self._upload_part(len(self._buffer))
+                parts = [future.result() for future in self._futures]
+                self._call(
+                    self._s3.complete_multipart_upload,
+                    Bucket=self.bucket,
+                    Key=self.key,
+                    UploadId=self._upload_id,
+                    MultipartUpload={'Parts': parts}
+                )
+                logger.debug(f"Completed multipart upload of s3://{self.bucket}/{self.key} ({len(parts)} parts)")
+        except Exception:
+            self.abort()
+            raise
+        finally:
+            self._buffer = bytearray()
+            self._finished = True
+            super().close()
+
+    def abort(self):
+        """Discard the object and any uploaded parts."""
+        self._finished = True
+        self._buffer = bytearray()
+        if self._upload_id is None:
+            return
+        for future in self._futures:
+            try:
+                future.result()
+            except Exception:
+                pass
+        try:
+            self._call(self._s3.abort_multipart_upload, Bucket=self.bucket, Key=self.key, UploadId=self._upload_id)
+            logger.warning(f"Aborted multipart upload of s3://{self.bucket}/{self.key}")
+        except Exception as e:
+            logger.error(f"Error aborting multipart upload of s3://{self.bucket}/{self.key}: {e}")
+        self._upload_id = None
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""
+Parquet output for archived emails.
+
+Provides an encoder for the BatchAggregator that writes the parsed email
+fields plus SQS metadata as Parquet row groups, and a partitioner that
+places records by the email's own timestamp rather than processing time.
+"""
+
+import logging
+from datetime import datetime, timezone
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Only required by the s3-parquet sink
+    pa = None
+    pq = None
+
+logger = logging.getLogger(__name__)
+
+EMAIL_FIELDS = ['email_subject', 'email_sender', 'email_content']
+
+
+def _schema():
+    return pa.schema([
+        ('message_id', pa.string()),
+        ('email_subject', pa.string()),
+        ('email_sender', pa.string()),
+        ('email_timestream', pa.timestamp('s', tz='UTC')),
+        ('email_content', pa.string()),
+        ('sent_timestamp', pa.timestamp('ms', tz='UTC')),
+        ('approximate_receive_count', pa.int32()),
+        ('received_at', pa.timestamp('us', tz='UTC'))
+    ])
+
+
+def require_pyarrow():
+    """Fail fast at startup if the s3-parquet sink is selected without pyarrow."""
+    if pa is None:
+        raise RuntimeError("The s3-parquet sink (in SINKS or OPTIONAL_SINKS) requires the 'pyarrow' package")
+
+
+def event_time(record):
+    """
+    Event time of a record: the email's email_timestream, falling back to the
+    SQS SentTimestamp and finally to the processing time.
+    """
+    body = record.get('parsed_body')
+    if isinstance(body, dict):
+        try:
+            return datetime.fromtimestamp(int(body['email_timestream']), tz=timezone.utc)
+        except (KeyError, ValueError, TypeError, OverflowError, OSError):
+            pass
+    try:
+        return datetime.fromtimestamp(int(record['attributes']['SentTimestamp']) / 1000, tz=timezone.utc)
+    except (KeyError, ValueError, TypeError):
+        return datetime.now(timezone.utc)
+
+
+def partition_by_event_date(record):
+    """Hive-style partition path (dt=YYYY-MM-DD) from the record's event time."""
+    return event_time(record).strftime('dt=%Y-%m-%d')
+
+
+def _to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class ParquetEncoder:
+    """
+    Streams records into a Parquet file, writing a row group every
+    `row_group_size` rows so memory use does not grow with the batch.
+    """
+
+    extension = 'parquet'
+    content_type = 'application/vnd.apache.parquet'
+    content_encoding = None
+    row_group_size = 10000
+    compression = 'snappy'
+
+    def __init__(self, fileobj):
+        require_pyarrow()
+        self._schema = _schema()
+        self._writer = pq.ParquetWriter(fileobj, self._schema, compression=self.compression)
+        self._columns = {name: [] for name in self._schema.names}
+        self._rows = 0
+
+    def write(self, record):
+        """Append a record; returns its approximate uncompressed size in bytes."""
+        body = record.get('parsed_body')
+        body = body if isinstance(body, dict) else {}
+        attributes = record.get('attributes', {})
+
+        timestream = _to_int(body.get('email_timestream'))
+        sent = _to_int(attributes.get('SentTimestamp'))
+        row = {
+            'message_id': record['message_id'],
+            'email_timestream': datetime.fromtimestamp(timestream, tz=timezone.utc) if timestream is not None else None,
+            'sent_timestamp': datetime.fromtimestamp(sent / 1000, tz=timezone.utc) if sent is not None else None,
+            'approximate_receive_count': _to_int(attributes.get('ApproximateReceiveCount')),
+            'received_at': datetime.fromisoformat(record['received_at']).replace(tzinfo=timezone.utc)
+        }
+        for field in EMAIL_FIELDS:
+            value = body.get(field)
+            row[field] = str(value) if value is not None else None
+
+        for name, value in row.items():
+            self._columns[name].append(value)
+        self._rows += 1
+        if self._rows >= self.row_group_size:
+            self._write_row_group()
+
+        return sum(len(value) for value in row.values() if isinstance(value, str)) + 32
+
+    def _write_row_group(self):
+        if not self._rows:
+            return
+        table = pa.table(self._columns, schema=self._schema)
+        self._writer.write_table(table, row_group_size=self._rows)
+        self._columns = {name: [] for name in self._schema.names}
+        self._rows = 0
+
+    def close(self):
+        self._write_row_group()
+        self._writer.close()
+
+
+def parquet_encoder(row_group_size, compression):
+    """Return a ParquetEncoder class configured with the given options."""
+    return type('ParquetEncoder', (ParquetEncoder,), {
+        'row_group_size': row_group_size,
+        'compression': compression
+    })
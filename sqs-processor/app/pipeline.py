@@ -0,0 +1,424 @@
+#!/usr/bin/env python3
+"""
+Concurrent processing pipeline for the SQS processor.
+
+Messages received from SQS are recorded in an in-flight registry (in receive
+order) and handed to a bounded worker pool. The registry bounds how many
+messages the pollers may hold at once, which is the backpressure between
+polling and uploading. For FIFO queues, GroupedUploadPipeline runs different
+message groups in parallel and the messages of one group one at a time.
+"""
+
+import time
+import logging
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, wait
+
+logger = logging.getLogger(__name__)
+
+# Handler result: the message cannot be appended behind its group's pending
+# messages yet and is retried once they have settled (GroupedUploadPipeline)
+HOLD = 'hold'
+
+
+class InFlightRegistry:
+    """
+    Ordered record of messages received from SQS that have not yet been
+    deleted or released back to the queue.
+    """
+
+    def __init__(self, max_in_flight):
+        self.max_in_flight = max_in_flight
+        self._entries = OrderedDict()
+        self._condition = threading.Condition()
+
+    def add(self, message, visibility_timeout=None):
+        """Record a received message and when its visibility timeout expires."""
+        now = time.time()
+        with self._condition:
+            self._entries[message['MessageId']] = {
+                'message': message,
+                'received_at': now,
+                'visibility_deadline': now + visibility_timeout if visibility_timeout else None
+            }
+
+    def update(self, message_id, **fields):
+        """Update bookkeeping fields of an in-flight message."""
+        with self._condition:
+            entry = self._entries.get(message_id)
+            if entry is not None:
+                entry.update(fields)
+
+    def remove(self, message_id):
+        """Forget a message once it has been deleted or given up on."""
+        with self._condition:
+            self._entries.pop(message_id, None)
+            self._condition.notify_all()
+
+    def capacity(self):
+        """Number of additional messages that may be received."""
+        with self._condition:
+            return max(self.max_in_flight - len(self._entries), 0)
+
+    def wait_for_capacity(self, timeout=None):
+        """
+        Block until at least one more message may be received.
+
+        Returns:
+            bool: True if capacity is available, False on timeout
+        """
+        with self._condition:
+            return self._condition.wait_for(
+                lambda: len(self._entries) < self.max_in_flight, timeout
+            )
+
+    def wait_until_empty(self, timeout=None):
+        """Block until every in-flight message has been settled."""
+        with self._condition:
+            return self._condition.wait_for(lambda: not self._entries, timeout)
+
+    def snapshot(self):
+        """Return a list of in-flight entries, oldest first."""
+        with self._condition:
+            return list(self._entries.values())
+
+    def __len__(self):
+        with self._condition:
+            return len(self._entries)
+
+
+class UploadPipeline:
+    """
+    Bounded worker pool that runs a handler for each message.
+
+    The handler returns True when the message can be deleted from SQS and
+    False when it should be left for redelivery; `on_complete(message, result)`
+    is then called from the worker thread. A handler result of None defers
+    the message: its owner reports the outcome later through settle().
+    """
+
+    def __init__(self, handler, on_complete, concurrency):
+        self._handler = handler
+        self._on_complete = on_complete
+        self.concurrency = concurrency
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='upload')
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def submit(self, message):
+        """Schedule a message for processing."""
+        future = self._executor.submit(self._run, message)
+        with self._lock:
+            self._pending[future] = message
+        future.add_done_callback(self._forget)
+
+    def _forget(self, future):
+        with self._lock:
+            self._pending.pop(future, None)
+
+    def drain(self, timeout=None):
+        """
+        Stop accepting work, cancel messages that have not started and wait
+        up to `timeout` seconds for running handlers.
+
+        Returns:
+            list: Messages that were cancelled before being handled
+        """
+        with self._lock:
+            pending = list(self._pending.items())
+        cancelled = [message for future, message in pending if future.cancel()]
+        running = [future for future, message in pending if not future.cancelled()]
+        self._executor.shutdown(wait=False)
+        done, not_done = wait(running, timeout=timeout)
+        if not_done:
+            logger.warning(f"{len(not_done)} handler(s) still running after the drain deadline")
+        return cancelled
+
+    def _run(self, message):
+        try:
+            result = self._handler(message)
+        except Exception as e:
+            logger.error(f"Unexpected error processing message {message.get('MessageId')}: {e}")
+            result = False
+        try:
+            self._on_complete(message, result)
+        except Exception as e:
+            logger.error(f"Error completing message {message.get('MessageId')}: {e}")
+
+    def settle(self, message, result):
+        """Complete a message whose handler returned None."""
+        try:
+            self._on_complete(message, result)
+        except Exception as e:
+            logger.error(f"Error completing message {message.get('MessageId')}: {e}")
+
+    def shutdown(self, wait=True):
+        """Stop accepting work and optionally wait for running handlers."""
+        self._executor.shutdown(wait=wait)
+
+
+def message_group(message):
+    """
+    MessageGroupId of a message received from a FIFO queue, or None.
+    """
+    return message.get('Attributes', {}).get('MessageGroupId')
+
+
+class GroupedUploadPipeline:
+    """
+    Worker pool that keeps the order of messages within a FIFO message group.
+
+    Messages of different groups are handled concurrently, up to `concurrency`
+    at a time; the messages of one group are handled one after the other in
+    the order they were submitted. Each group gets one message handled per
+    turn, so a busy group cannot starve the others. Messages without a group
+    (standard queues) are independent and handled in parallel.
+
+    When a handler fails (False), the group's queued messages are completed
+    with False without being handled: SQS then redelivers the group starting
+    with the failed message, so nothing is processed out of order.
+
+    A handler result of None means the message joined a batch whose outcome
+    is reported later through settle(). If `chain_token(message)` returns a
+    token for it, the group's next message is handled with `after=token` and
+    may join the same batch: a batch keeps append order and is written or
+    fails as a whole, so the group stays in order without waiting for the
+    flush. A handler that cannot append the message right behind the earlier
+    one (it would start a new batch) returns HOLD, and the group waits until
+    its pending messages have settled; without a token the group always
+    waits. Results are completed in group order, so a later message is never
+    deleted before an earlier one has settled.
+
+    Per-group counts are kept for the `max_tracked_groups` most recently
+    active groups.
+
+    Args:
+        handler (callable): handler(message[, after=token]) -> True, False, None or HOLD
+        on_complete (callable): on_complete(message, result), called from the worker thread
+        concurrency (int): Messages handled at once
+        max_tracked_groups (int): Groups whose throughput is tracked
+        on_wait (callable): on_wait(seconds) with how long each message waited behind its group
+        chain_token (callable): chain_token(message) -> token letting the group's next
+            message follow a deferred message into its batch, or None
+    """
+
+    def __init__(self, handler, on_complete, concurrency, max_tracked_groups=1000, on_wait=None,
+                 chain_token=None):
+        self._handler = handler
+        self._on_complete = on_complete
+        self.concurrency = concurrency
+        self.max_tracked_groups = max_tracked_groups
+        self._on_wait = on_wait
+        self._chain_token = chain_token
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='upload')
+        self._groups = {}  # group -> deque of (message, submitted_at) not yet started
+        self._running = set()  # groups with a message being handled or scheduled
+        self._parked = set()  # groups waiting for their pending messages to settle
+        self._pending = {}  # group -> deque of [message, result] handled, not yet completed
+        self._tokens = {}  # group -> chain token of the group's latest deferred message
+        self._failing = set()  # groups with a turn running when a pending message failed
+        self._futures = set()
+        self._deferred = {}  # MessageId -> group of a message waiting to be settled
+        self._settled_early = {}  # MessageId -> result reported before its handler returned
+        self._stats = OrderedDict()  # group -> {'processed', 'failed', 'skipped', 'last_at'}
+        self._lock = threading.Lock()
+        self._stopped = False
+
+    def submit(self, message):
+        """Queue a message behind the earlier messages of its group."""
+        group = message_group(message)
+        if group is None:
+            # Independent message: a group of its own
+            group = ('message', message['MessageId'])
+        with self._lock:
+            self._groups.setdefault(group, deque()).append((message, time.monotonic()))
+            self._continue(group)
+
+    def _schedule(self, group):
+        """Run the next message of a group on the pool (called with the lock held)."""
+        future = self._executor.submit(self._run_next, group)
+        self._futures.add(future)
+        future.add_done_callback(self._forget)
+
+    def _forget(self, future):
+        with self._lock:
+            self._futures.discard(future)
+
+    def _run_next(self, group):
+        with self._lock:
+            entry = self._groups[group].popleft()
+            token = self._tokens.get(group)
+        message, submitted_at = entry
+        if self._on_wait is not None:
+            self._on_wait(time.monotonic() - submitted_at)
+        try:
+            result = self._handler(message) if token is None else self._handler(message, after=token)
+        except Exception as e:
+            logger.error(f"Unexpected error processing message {message.get('MessageId')}: {e}")
+            result = False
+
+        completions = []
+        with self._lock:
+            self._running.discard(group)
+            if group in self._failing:
+                self._failing.discard(group)
+                if result is HOLD:
+                    # An earlier message failed meanwhile; this one follows it back to the queue
+                    result = False
+            pending = self._pending.get(group)
+            if result is HOLD:
+                self._groups.setdefault(group, deque()).appendleft(entry)
+                if pending:
+                    self._parked.add(group)
+            elif result is None and message['MessageId'] not in self._settled_early:
+                self._deferred[message['MessageId']] = group
+                self._pending.setdefault(group, deque()).append([message, None])
+                token = self._chain_token(message) if self._chain_token is not None else None
+                if token is None:
+                    self._parked.add(group)
+                else:
+                    self._tokens[group] = token
+            else:
+                if result is None:
+                    result = self._settled_early.pop(message['MessageId'])
+                if result is not False and pending:
+                    # Completed once the group's earlier messages have settled
+                    pending.append([message, result])
+                else:
+                    completions.append((message, result))
+                    if result is False:
+                        completions.extend(self._skip_queued(group, message))
+                        if pending:
+                            self._parked.add(group)
+            self._continue(group)
+        self._complete_all(group, completions)
+
+    def settle(self, message, result):
+        """
+        Report the outcome of a message whose handler returned None; completes
+        it (and any later messages of its group waiting behind it) and lets
+        the group continue, or skips the rest of the group if it failed.
+        """
+        with self._lock:
+            group = self._deferred.pop(message['MessageId'], None)
+            if group is None:
+                # Settled before its handler returned; _run_next picks it up
+                self._settled_early[message['MessageId']] = result
+                return
+            pending = self._pending[group]
+            for waiting in pending:
+                if waiting[0]['MessageId'] == message['MessageId']:
+                    waiting[1] = result
+            completions = []
+            while pending and pending[0][1] is not None:
+                completions.append(tuple(pending.popleft()))
+            if not pending:
+                del self._pending[group]
+                self._tokens.pop(group, None)
+                self._parked.discard(group)
+            if result is False:
+                completions.extend(self._skip_queued(group, message))
+                if group in self._running:
+                    self._failing.add(group)
+            self._continue(group)
+        self._complete_all(group, completions)
+
+    def _skip_queued(self, group, failed):
+        """Take a group's queued messages after a failure (called with the lock held)."""
+        queue = self._groups.get(group)
+        if not queue:
+            return []
+        skipped = [(queued, False) for queued, _ in queue]
+        queue.clear()
+        self._count(group, 'skipped', len(skipped))
+        logger.warning(f"Message {failed.get('MessageId')} failed; leaving {len(skipped)} later "
+                       f"message(s) of its group for redelivery in order")
+        return skipped
+
+    def _continue(self, group):
+        """Schedule a group's next turn if it may run one (called with the lock held)."""
+        if group in self._running or group in self._parked:
+            return
+        queue = self._groups.get(group)
+        if queue and not self._stopped:
+            self._running.add(group)
+            self._schedule(group)
+        elif not queue:
+            self._groups.pop(group, None)
+
+    def _complete_all(self, group, completions):
+        with self._lock:
+            for message, result in completions:
+                self._count(group, 'failed' if result is False else 'processed')
+        for message, result in completions:
+            self._complete(message, result)
+
+    def _complete(self, message, result):
+        try:
+            self._on_complete(message, result)
+        except Exception as e:
+            logger.error(f"Error completing message {message.get('MessageId')}: {e}")
+
+    def _active(self):
+        """Groups with a turn scheduled or messages not yet completed (called with the lock held)."""
+        return self._running | self._parked | self._pending.keys()
+
+    def _count(self, group, outcome, count=1):
+        """Count a group's messages by outcome (called with the lock held)."""
+        if isinstance(group, tuple) or not count:
+            return
+        stats = self._stats.get(group)
+        if stats is None:
+            stats = self._stats[group] = {'processed': 0, 'failed': 0, 'skipped': 0, 'last_at': 0}
+            if len(self._stats) > self.max_tracked_groups:
+                self._stats.popitem(last=False)
+        else:
+            self._stats.move_to_end(group)
+        stats[outcome] += count
+        stats['last_at'] = time.time()
+
+    def active_groups(self):
+        """Number of groups with messages queued or being handled."""
+        with self._lock:
+            return len(self._active())
+
+    def snapshot(self, top=10):
+        """Group activity and the `top` tracked groups by messages processed."""
+        with self._lock:
+            busiest = sorted(self._stats.items(), key=lambda item: item[1]['processed'], reverse=True)[:top]
+            return {
+                'active_groups': len(self._active()),
+                'queued_messages': sum(len(queue) for queue in self._groups.values()),
+                'tracked_groups': len(self._stats),
+                'top_groups': [dict(stats, group=group) for group, stats in busiest]
+            }
+
+    def drain(self, timeout=None):
+        """
+        Stop accepting work, cancel turns that have not started and wait up
+        to `timeout` seconds for running handlers.
+
+        Returns:
+            list: Messages that were not handled
+        """
+        with self._lock:
+            self._stopped = True
+            scheduled = list(self._futures)
+        # A cancelled turn leaves its message at the head of the group's queue
+        running = [future for future in scheduled if not future.cancel()]
+        self._executor.shutdown(wait=False)
+        done, not_done = wait(running, timeout=timeout)
+        if not_done:
+            logger.warning(f"{len(not_done)} handler(s) still running after the drain deadline")
+        with self._lock:
+            cancelled = [message for queue in self._groups.values() for message, _ in queue]
+            for queue in self._groups.values():
+                queue.clear()
+        return cancelled
+
+    def shutdown(self, wait=True):
+        """Stop accepting work and optionally wait for running handlers."""
+        with self._lock:
+            self._stopped = True
+        self._executor.shutdown(wait=wait)
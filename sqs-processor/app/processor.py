@@ -2,17 +2,37 @@
 """
 SQS to S3 Processor Microservice
 
-This microservice continuously polls an SQS queue for messages and uploads them to S3.
-It runs in a loop, checking for messages at configurable intervals.
+This microservice continuously polls an SQS queue for messages and archives them to
+one or more sinks (S3 objects, S3 batches, local files, stdout; see sinks.py).
+It either checks for messages at configurable intervals (CONSUMER_MODE=interval)
+or runs several continuous long-poll loops (CONSUMER_MODE=streaming).
 """
 
 import os
 import json
 import time
+import signal
 import logging
-import boto3
+import threading
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 from botocore.exceptions import ClientError
+from aws_clients import create_client, pool_size
+from pipeline import HOLD, InFlightRegistry, UploadPipeline, GroupedUploadPipeline
+from health import StatusBoard
+from sqs_batch import BatchDeleter, VisibilityHeartbeat, release_messages
+from aggregator import BatchAggregator, BatchBoundary
+from sinks import SinkFanOut, S3ObjectSink, BatchSink, FileSink, StreamSink
+from multipart import MultipartUploadWriter
+from parquet_sink import parquet_encoder, partition_by_event_date, require_pyarrow, event_time
+from dedup import SeenSet
+from resilience import Resilience, RetryBudget, CircuitBreaker, CircuitOpenError
+from payload_codec import decode_body, message_encoding
+from metrics import (
+    QueueDepthSampler, QUEUE_ATTRIBUTES, MESSAGES_RECEIVED, MESSAGES_PROCESSED, MESSAGES_FAILED,
+    DUPLICATES_SUPPRESSED, IN_FLIGHT, PAYLOADS_DECODED, ACTIVE_MESSAGE_GROUPS, GROUP_WAIT,
+    record_retry, record_breaker_state
+)
 
 # Configure logging
 logging.basicConfig(
@@ -28,36 +48,141 @@ S3_BUCKET_NAME = os.getenv('S3_BUCKET_NAME')
 POLL_INTERVAL = int(os.getenv('POLL_INTERVAL_SECONDS', '30'))  # Poll every 30 seconds by default
 MAX_MESSAGES = int(os.getenv('MAX_MESSAGES_PER_POLL', '10'))  # Max messages per poll
 S3_PREFIX = os.getenv('S3_PREFIX', 'sqs-messages/')  # S3 folder path
+UPLOAD_CONCURRENCY = int(os.getenv('UPLOAD_CONCURRENCY', '8'))  # Parallel S3 uploads
+OUTPUT_MODE = os.getenv('OUTPUT_MODE', 'message')  # 'message', 'aggregate' or 'parquet'; the default for SINKS
+SINKS = [name.strip() for name in os.getenv(
+    'SINKS',
+    {'message': 's3', 'aggregate': 's3-batch', 'parquet': 's3-parquet'}.get(OUTPUT_MODE, OUTPUT_MODE)
+).split(',') if name.strip()]  # Destinations every message is written to
+OPTIONAL_SINKS = [name.strip() for name in os.getenv('OPTIONAL_SINKS', '').split(',') if name.strip()]  # Best effort, never block deletion
+SINK_FILE_DIR = os.getenv('SINK_FILE_DIR', '/var/lib/sqs-processor/archive')  # Root directory of the file sink
+SINK_MAX_PENDING = int(os.getenv('SINK_MAX_PENDING', '1000'))  # Queued writes per optional sink before records are dropped
+AGGREGATE_MAX_RECORDS = int(os.getenv('AGGREGATE_MAX_RECORDS', '1000'))  # Records per batch object
+AGGREGATE_MAX_BYTES = int(os.getenv('AGGREGATE_MAX_BYTES', str(32 * 1024 * 1024)))  # Uncompressed bytes per batch
+AGGREGATE_MAX_AGE = float(os.getenv('AGGREGATE_MAX_AGE_SECONDS', '60'))  # Max time a record waits in a batch
+PARQUET_ROW_GROUP_SIZE = int(os.getenv('PARQUET_ROW_GROUP_SIZE', '10000'))  # Rows per Parquet row group
+PARQUET_COMPRESSION = os.getenv('PARQUET_COMPRESSION', 'snappy')  # snappy, zstd, gzip or none
+S3_PART_SIZE = int(os.getenv('S3_PART_SIZE_MB', '8')) * 1024 * 1024  # Multipart part size for batch objects
+S3_PART_CONCURRENCY = int(os.getenv('S3_PART_CONCURRENCY', '4'))  # Parts buffered or uploading at once, across all batch objects
+BATCHED_SINKS = ('s3-batch', 's3-parquet')
+RECORD_SINKS = ('s3', 'file', 'stdout')
+BATCHED_OUTPUT = any(name in BATCHED_SINKS for name in SINKS)
+MAX_IN_FLIGHT = int(os.getenv(
+    'MAX_IN_FLIGHT_MESSAGES',
+    str(AGGREGATE_MAX_RECORDS if BATCHED_OUTPUT else UPLOAD_CONCURRENCY * 4)
+))  # Received but not yet deleted
+CONSUMER_MODE = os.getenv('CONSUMER_MODE', 'interval')  # 'interval' or 'streaming'
+ORDER_BY_MESSAGE_GROUP = os.getenv(
+    'ORDER_BY_MESSAGE_GROUP',
+    'true' if (SQS_QUEUE_URL or '').endswith('.fifo') else 'false'
+).lower() == 'true'  # Keep FIFO group order: groups in parallel, one message per group at a time
+MAX_TRACKED_GROUPS = int(os.getenv('MAX_TRACKED_GROUPS', '1000'))  # Groups whose throughput is reported
+POLLER_COUNT = int(os.getenv('POLLER_COUNT', '2'))  # Parallel receive loops in streaming mode
+IDLE_BACKOFF_MAX = float(os.getenv('IDLE_BACKOFF_MAX_SECONDS', '10'))  # Max extra wait when the queue is empty
+VISIBILITY_TIMEOUT = int(os.getenv('VISIBILITY_TIMEOUT_SECONDS', '30'))  # Requested on every receive
+VISIBILITY_HEARTBEAT = int(os.getenv('VISIBILITY_HEARTBEAT_SECONDS', '10'))  # How often in-flight messages are checked
+VISIBILITY_EXTENSION = int(os.getenv('VISIBILITY_EXTENSION_SECONDS', '60'))  # Extension for slow messages
+DELETE_FLUSH_INTERVAL = int(os.getenv('DELETE_FLUSH_INTERVAL_MS', '200')) / 1000.0  # Max wait before a partial delete batch
+QUEUE_METRICS_INTERVAL = int(os.getenv('QUEUE_METRICS_INTERVAL_SECONDS', '15'))  # How often queue depth is sampled
+READY_MAX_POLL_AGE = float(os.getenv('READY_MAX_POLL_AGE_SECONDS', str(max(POLL_INTERVAL * 2 + 20, 120))))  # Not ready without a recent poll
+READY_MAX_BACKPRESSURE = float(os.getenv('READY_MAX_BACKPRESSURE_SECONDS', '60'))  # Not ready while the pipeline stays full
+LIVENESS_MAX_STALL = float(os.getenv('LIVENESS_MAX_STALL_SECONDS', '300'))  # Not live without loop progress
+DRAIN_DEADLINE = float(os.getenv('DRAIN_DEADLINE_SECONDS', '25'))  # Time allowed to drain in-flight work on SIGTERM
+DEDUP_CACHE_SIZE = int(os.getenv('DEDUP_CACHE_SIZE', '100000'))  # Archived MessageIds remembered in memory
+DEDUP_TTL = float(os.getenv('DEDUP_TTL_SECONDS', '86400'))  # How long an archived MessageId is remembered
+DEDUP_DB_PATH = os.getenv('DEDUP_DB_PATH', '')  # Optional SQLite file persisting the seen-set
+AWS_RETRY_MAX_ATTEMPTS = int(os.getenv('AWS_RETRY_MAX_ATTEMPTS', '3'))  # Attempts per AWS call, including the first
+AWS_RETRY_BASE_DELAY_MS = int(os.getenv('AWS_RETRY_BASE_DELAY_MS', '50'))  # Minimum backoff between attempts
+AWS_RETRY_MAX_DELAY_MS = int(os.getenv('AWS_RETRY_MAX_DELAY_MS', '2000'))  # Maximum backoff between attempts
+AWS_RETRY_BUDGET_RATIO = float(os.getenv('AWS_RETRY_BUDGET_RATIO', '0.1'))  # Retries allowed per call made
+CIRCUIT_BREAKER_FAILURES = int(os.getenv('CIRCUIT_BREAKER_FAILURES', '5'))  # Consecutive failures that open a circuit
+CIRCUIT_BREAKER_RESET_SECONDS = float(os.getenv('CIRCUIT_BREAKER_RESET_SECONDS', '30'))  # Pause before probing again
 
 # Validate required environment variables
 if not SQS_QUEUE_URL:
     raise ValueError("SQS_QUEUE_URL environment variable is required")
 if not S3_BUCKET_NAME:
     raise ValueError("S3_BUCKET_NAME environment variable is required")
+for sink_name in SINKS + OPTIONAL_SINKS:
+    if sink_name not in BATCHED_SINKS + RECORD_SINKS:
+        raise ValueError(f"Unknown sink '{sink_name}' in SINKS/OPTIONAL_SINKS")
+
+# Initialize AWS clients (retries are done by the resilience layer, so botocore makes
+# a single attempt). Pools cover every thread that can call the service at once.
+sqs_client = create_client(
+    'sqs',
+    AWS_REGION,
+    # Pollers, deleter, visibility heartbeat and queue sampler
+    max_pool_connections=pool_size(POLLER_COUNT, 3),
+    read_timeout=30,  # Longer than the 20 second long poll
+    max_attempts=1
+)
+s3_client = create_client(
+    's3',
+    AWS_REGION,
+    # Upload workers (messages, batch flushes) and multipart part uploads
+    max_pool_connections=pool_size(UPLOAD_CONCURRENCY, S3_PART_CONCURRENCY),
+    max_attempts=1
+)
 
-# Initialize AWS clients
-sqs_client = boto3.client('sqs', region_name=AWS_REGION)
-s3_client = boto3.client('s3', region_name=AWS_REGION)
 
-# Health check flag
-last_successful_poll = time.time()
-health_status = {'status': 'starting', 'last_poll': None, 'messages_processed': 0}
+def build_resilience(name):
+    """
+    Retry policy and circuit breaker for one AWS service.
+    """
+    return Resilience(
+        name,
+        max_attempts=AWS_RETRY_MAX_ATTEMPTS,
+        base_delay=AWS_RETRY_BASE_DELAY_MS / 1000.0,
+        max_delay=AWS_RETRY_MAX_DELAY_MS / 1000.0,
+        budget=RetryBudget(ratio=AWS_RETRY_BUDGET_RATIO),
+        breaker=CircuitBreaker(
+            failure_threshold=CIRCUIT_BREAKER_FAILURES,
+            reset_timeout=CIRCUIT_BREAKER_RESET_SECONDS,
+            on_state_change=lambda state: record_breaker_state(name, state)
+        ),
+        on_retry=record_retry
+    )
+
+
+# Receives and uploads go through the circuit breakers; deletes, visibility
+# changes and multipart parts only retry, so finished work is never shed
+sqs_resilience = build_resilience('sqs')
+s3_resilience = build_resilience('s3')
+
+# MessageIds already archived to S3, so redeliveries skip the upload
+seen_messages = SeenSet(max_entries=DEDUP_CACHE_SIZE, ttl=DEDUP_TTL, path=DEDUP_DB_PATH or None)
+
+# Status read by the /livez, /readyz and /health endpoints
+status_board = StatusBoard(
+    max_poll_age=READY_MAX_POLL_AGE,
+    max_backpressure=READY_MAX_BACKPRESSURE,
+    max_stall=LIVENESS_MAX_STALL
+)
 
+# Set to stop the polling loops
+shutdown_event = threading.Event()
 
-def poll_sqs_messages():
+
+def poll_sqs_messages(max_messages=MAX_MESSAGES):
     """
     Poll SQS queue for messages.
     
+    Args:
+        max_messages (int): Maximum number of messages to receive (1-10)
+    
     Returns:
-        list: List of messages received from SQS
+        list: List of messages received from SQS, or None if the receive failed
     """
     try:
         logger.info(f"Polling SQS queue: {SQS_QUEUE_URL}")
         
-        response = sqs_client.receive_message(
+        response = sqs_resilience.call(
+            sqs_client.receive_message,
             QueueUrl=SQS_QUEUE_URL,
-            MaxNumberOfMessages=MAX_MESSAGES,
+            MaxNumberOfMessages=max_messages,
             WaitTimeSeconds=20,  # Long polling
+            VisibilityTimeout=VISIBILITY_TIMEOUT,
             MessageAttributeNames=['All'],
             AttributeNames=['All']
         )
@@ -67,112 +192,522 @@ def poll_sqs_messages():
         
         return messages
     
+    except CircuitOpenError as e:
+        logger.warning(f"Not polling: {e}")
+        return None
     except ClientError as e:
         logger.error(f"Error polling SQS: {e}")
-        health_status['status'] = 'unhealthy'
-        return []
+        status_board.poll_failed()
+        return None
     except Exception as e:
         logger.error(f"Unexpected error polling SQS: {e}")
-        health_status['status'] = 'unhealthy'
-        return []
+        status_board.poll_failed()
+        return None
+
+
+def fetch_claim_check(bucket, key):
+    """
+    Read the S3 object holding the body of an offloaded message.
+    """
+    response = s3_resilience.call(s3_client.get_object, Bucket=bucket, Key=key)
+    return response['Body'].read()
+
+
+def resolve_body(message):
+    """
+    Original body of a message: compressed bodies are decompressed and
+    claim-check pointers are replaced by the body stored in S3.
+    """
+    encoding = message_encoding(message)
+    if encoding is None:
+        return message['Body']
+    body = decode_body(message['Body'], encoding, fetch_claim_check)
+    PAYLOADS_DECODED.labels(encoding=encoding).inc()
+    return body
 
 
-def upload_message_to_s3(message):
+def build_record(message):
     """
-    Upload a single SQS message to S3.
+    Build the archived representation of an SQS message.
     
     Args:
-        message (dict): SQS message to upload
+        message (dict): SQS message
         
     Returns:
-        bool: True if successful, False otherwise
+        dict: Record stored in S3
     """
+    message_body = resolve_body(message)
+    record = {
+        'message_id': message['MessageId'],
+        'body': message_body,
+        'attributes': message.get('Attributes', {}),
+        'message_attributes': message.get('MessageAttributes', {}),
+        'received_at': datetime.utcnow().isoformat(),
+        'receipt_handle': message['ReceiptHandle']
+    }
+    
+    # Try to parse body as JSON if possible
     try:
-        message_id = message['MessageId']
-        receipt_handle = message['ReceiptHandle']
-        message_body = message['Body']
-        
-        # Create a unique filename using timestamp and message ID
-        timestamp = datetime.utcnow().strftime('%Y/%m/%d/%H')
-        filename = f"{S3_PREFIX}{timestamp}/{message_id}.json"
-        
-        # Prepare the data to upload
-        data_to_upload = {
-            'message_id': message_id,
-            'body': message_body,
-            'attributes': message.get('Attributes', {}),
-            'message_attributes': message.get('MessageAttributes', {}),
-            'received_at': datetime.utcnow().isoformat(),
-            'receipt_handle': receipt_handle
-        }
-        
-        # Try to parse body as JSON if possible
-        try:
-            parsed_body = json.loads(message_body)
-            data_to_upload['parsed_body'] = parsed_body
-        except json.JSONDecodeError:
-            logger.debug(f"Message body is not JSON, storing as string")
-        
-        # Upload to S3
-        s3_client.put_object(
-            Bucket=S3_BUCKET_NAME,
-            Key=filename,
-            Body=json.dumps(data_to_upload, indent=2),
-            ContentType='application/json',
-            Metadata={
-                'message-id': message_id,
-                'processed-at': datetime.utcnow().isoformat()
-            }
-        )
-        
-        logger.info(f"Successfully uploaded message {message_id} to s3://{S3_BUCKET_NAME}/{filename}")
-        
-        # Delete message from SQS after successful upload
-        sqs_client.delete_message(
-            QueueUrl=SQS_QUEUE_URL,
-            ReceiptHandle=receipt_handle
-        )
-        
-        logger.info(f"Deleted message {message_id} from SQS queue")
+        record['parsed_body'] = json.loads(message_body)
+    except json.JSONDecodeError:
+        logger.debug(f"Message body is not JSON, storing as string")
+    
+    return record
+
+
+def message_key(message, record):
+    """
+    Deterministic S3 key of a message: the hour of the email's own timestamp
+    and the MessageId, so a redelivery overwrites the same object instead of
+    creating a second one.
+    """
+    return f"{S3_PREFIX}{event_time(record).strftime('%Y/%m/%d/%H')}/{message['MessageId']}.json"
+
+
+def is_duplicate(message):
+    """
+    True if the message has already been archived (a redelivery).
+    """
+    if seen_messages.contains(message['MessageId']):
+        DUPLICATES_SUPPRESSED.inc()
+        logger.info(f"Message {message['MessageId']} was already archived, skipping upload")
+        return True
+    return False
+
+
+def deliver_message(message, after=None):
+    """
+    Pipeline handler: hand the message's record to every sink.
+    
+    The message is not deleted from SQS here; the pipeline deletes it once
+    all required sinks have written it. Messages that were already archived
+    are not written again.
+    
+    Args:
+        message (dict): SQS message to archive
+        after: chain token of the previous message of the same FIFO group
         
+    Returns:
+        bool: True if every required sink wrote the message, False otherwise
+        None: a batch sink settles the message later, when its batch has been written
+        HOLD: the message cannot follow `after` into its batch yet
+    """
+    if is_duplicate(message):
         return True
     
+    try:
+        record = build_record(message)
+    except CircuitOpenError as e:
+        logger.warning(f"Not archiving message {message['MessageId']}: {e}")
+        return False
     except ClientError as e:
-        logger.error(f"Error uploading message to S3: {e}")
+        logger.error(f"Error reading the body of message {message['MessageId']} from S3: {e}")
         return False
     except Exception as e:
         logger.error(f"Unexpected error processing message: {e}")
         return False
+    
+    try:
+        result = sink_fan_out.deliver(message, record, after=after)
+    except BatchBoundary:
+        return HOLD
+    if result:
+        seen_messages.add(message['MessageId'])
+    return result
+
+
+def write_object(key, body, content_type, content_encoding=None, metadata=None):
+    """
+    Write a batch or manifest object to the S3 bucket.
+    """
+    params = {
+        'Bucket': S3_BUCKET_NAME,
+        'Key': key,
+        'Body': body,
+        'ContentType': content_type,
+        'Metadata': metadata or {}
+    }
+    if content_encoding:
+        params['ContentEncoding'] = content_encoding
+    s3_resilience.call(s3_client.put_object, **params)
+
+
+def open_object(key, content_type, content_encoding=None, metadata=None):
+    """
+    Open a streaming writer for a batch object in the S3 bucket.
+    """
+    return MultipartUploadWriter(
+        s3_client,
+        S3_BUCKET_NAME,
+        key,
+        executor=part_executor,
+        part_size=S3_PART_SIZE,
+        content_type=content_type,
+        content_encoding=content_encoding,
+        metadata=metadata,
+        call=s3_resilience.retry,
+        slots=part_slots
+    )
+
+
+def messages_settled(results):
+    """
+    Fan-out callback: messages whose batches have been written (or failed)
+    after the pipeline handler returned. They go back through the pipeline,
+    which completes them and releases their FIFO group.
+    """
+    seen_messages.add_many([message['MessageId'] for message, success in results if success])
+    for message, success in results:
+        upload_pipeline.settle(message, success)
+
+
+def delete_message_batch(entries):
+    """
+    Delete up to 10 messages from SQS in one call.
+    """
+    return sqs_resilience.retry(
+        sqs_client.delete_message_batch,
+        QueueUrl=SQS_QUEUE_URL,
+        Entries=entries
+    )
+
+
+def change_message_visibility_batch(entries):
+    """
+    Change the visibility timeout of up to 10 messages in one call.
+    """
+    return sqs_resilience.retry(
+        sqs_client.change_message_visibility_batch,
+        QueueUrl=SQS_QUEUE_URL,
+        Entries=entries
+    )
+
+
+def get_queue_attributes():
+    """
+    Read the backlog attributes of the SQS queue.
+    """
+    response = sqs_client.get_queue_attributes(
+        QueueUrl=SQS_QUEUE_URL,
+        AttributeNames=QUEUE_ATTRIBUTES
+    )
+    return response.get('Attributes', {})
+
+
+def message_deleted(message, deleted):
+    """
+    Deleter callback: the message is settled whether or not the delete worked.
+    """
+    if deleted:
+        MESSAGES_PROCESSED.inc()
+        status_board.messages_processed()
+    in_flight.remove(message['MessageId'])
+
+
+def complete_message(message, success):
+    """
+    Pipeline callback run after a message has been handled.
+    
+    Successful messages are queued for a batched delete; failed ones are only
+    dropped from the in-flight registry and become visible again after the
+    visibility timeout. A result of None means a batch sink has taken the
+    message; the pipeline calls again with the outcome once it is settled.
+    """
+    if success is None:
+        return
+    if success:
+        deleter.delete(message)
+    else:
+        MESSAGES_FAILED.inc()
+        in_flight.remove(message['MessageId'])
+
+
+# Messages received and not yet settled, in receive order
+in_flight = InFlightRegistry(max_in_flight=MAX_IN_FLIGHT)
+IN_FLIGHT.set_function(lambda: len(in_flight))
+
+# Exports queue backlog for the autoscaler
+queue_sampler = QueueDepthSampler(get_queue_attributes, interval=QUEUE_METRICS_INTERVAL)
+
+# Batched deletes of processed messages
+deleter = BatchDeleter(
+    delete_batch=delete_message_batch,
+    on_complete=message_deleted,
+    flush_interval=DELETE_FLUSH_INTERVAL
+)
+
+# Keeps messages with slow uploads invisible to other consumers
+heartbeat = VisibilityHeartbeat(
+    registry=in_flight,
+    change_visibility_batch=change_message_visibility_batch,
+    interval=VISIBILITY_HEARTBEAT,
+    extension=VISIBILITY_EXTENSION
+)
+
+# Shared pool for multipart part uploads of batch objects; the slots bound the parts
+# buffered or uploading across all open batch objects to S3_PART_CONCURRENCY
+part_executor = ThreadPoolExecutor(max_workers=S3_PART_CONCURRENCY, thread_name_prefix='s3-part')
+part_slots = threading.BoundedSemaphore(S3_PART_CONCURRENCY)
+
+
+def build_sink(name, required):
+    """
+    Sink for a SINKS/OPTIONAL_SINKS name.
+    
+    's3' writes one object per message, 's3-batch' compressed NDJSON batch
+    objects and 's3-parquet' Parquet files partitioned by the email's own
+    date; 'file' and 'stdout' write locally (e.g. for tests).
+    """
+    if name == 's3':
+        return S3ObjectSink(write_object, message_key, S3_BUCKET_NAME, required=required)
+    if name == 'file':
+        return FileSink(SINK_FILE_DIR, message_key, required=required)
+    if name == 'stdout':
+        return StreamSink(required=required)
+    if name == 's3-parquet':
+        return BatchSink(name, lambda on_flushed: BatchAggregator(
+            open_object=open_object,
+            write_object=write_object,
+            on_flushed=on_flushed,
+            key_prefix=f"{S3_PREFIX}parquet/",
+            max_records=AGGREGATE_MAX_RECORDS,
+            max_bytes=AGGREGATE_MAX_BYTES,
+            max_age=AGGREGATE_MAX_AGE,
+            encoder_class=parquet_encoder(
+                PARQUET_ROW_GROUP_SIZE,
+                None if PARQUET_COMPRESSION == 'none' else PARQUET_COMPRESSION
+            ),
+            partition_for=partition_by_event_date
+        ), required=required)
+    return BatchSink(name, lambda on_flushed: BatchAggregator(
+        open_object=open_object,
+        write_object=write_object,
+        on_flushed=on_flushed,
+        key_prefix=S3_PREFIX,
+        max_records=AGGREGATE_MAX_RECORDS,
+        max_bytes=AGGREGATE_MAX_BYTES,
+        max_age=AGGREGATE_MAX_AGE
+    ), required=required)
+
+
+# Writes every message to the configured sinks concurrently
+sink_fan_out = SinkFanOut(
+    [build_sink(name, required=True) for name in SINKS] +
+    [build_sink(name, required=False) for name in OPTIONAL_SINKS],
+    on_settled=messages_settled,
+    concurrency=UPLOAD_CONCURRENCY,
+    max_pending=SINK_MAX_PENDING
+)
+
+# Worker pool uploading messages concurrently (in group order for FIFO queues)
+if ORDER_BY_MESSAGE_GROUP:
+    upload_pipeline = GroupedUploadPipeline(
+        handler=deliver_message,
+        on_complete=complete_message,
+        concurrency=UPLOAD_CONCURRENCY,
+        max_tracked_groups=MAX_TRACKED_GROUPS,
+        on_wait=GROUP_WAIT.observe,
+        chain_token=sink_fan_out.chain_token
+    )
+    ACTIVE_MESSAGE_GROUPS.set_function(upload_pipeline.active_groups)
+else:
+    upload_pipeline = UploadPipeline(
+        handler=deliver_message,
+        on_complete=complete_message,
+        concurrency=UPLOAD_CONCURRENCY
+    )
 
 
 def process_messages():
     """
-    Main processing loop: poll SQS and upload messages to S3.
+    Main processing step: poll SQS and hand messages to the upload pipeline.
+    
+    Blocks while the pipeline already holds MAX_IN_FLIGHT messages, so the
+    poller never receives more than the uploaders can work through.
+    
+    Returns:
+        int: Number of messages received
     """
-    global last_successful_poll, health_status
+    # Backpressure: wait until the pipeline has room for more messages
+    while not in_flight.wait_for_capacity(timeout=1):
+        status_board.saturated()
+        if shutdown_event.is_set():
+            return 0
     
-    messages_processed_this_cycle = 0
+    # Shed load while SQS or S3 is failing instead of receiving messages we cannot archive
+    pause = max(sqs_resilience.retry_after(), s3_resilience.retry_after())
+    if pause > 0:
+        logger.warning(f"Circuit open, pausing polling for {pause:.1f} seconds")
+        status_board.poll_failed()
+        shutdown_event.wait(pause)
+        return 0
     
     # Poll for messages
-    messages = poll_sqs_messages()
+    messages = poll_sqs_messages(max_messages=min(MAX_MESSAGES, in_flight.capacity()))
+    if messages is None:
+        return 0
+    
+    if messages and shutdown_event.is_set():
+        # Received while shutting down: hand them straight back to the queue
+        released = release_messages(change_message_visibility_batch, messages)
+        logger.info(f"Released {released} message(s) received during shutdown")
+        return 0
     
     if messages:
-        logger.info(f"Processing {len(messages)} message(s)")
+        logger.info(f"Dispatching {len(messages)} message(s) to {UPLOAD_CONCURRENCY} upload worker(s)")
         
+        MESSAGES_RECEIVED.inc(len(messages))
         for message in messages:
-            success = upload_message_to_s3(message)
-            if success:
-                messages_processed_this_cycle += 1
-                health_status['messages_processed'] += 1
-        
-        logger.info(f"Successfully processed {messages_processed_this_cycle}/{len(messages)} message(s)")
+            in_flight.add(message, visibility_timeout=VISIBILITY_TIMEOUT)
+            upload_pipeline.submit(message)
     else:
         logger.info("No messages to process")
     
     # Update health status
-    last_successful_poll = time.time()
-    health_status['status'] = 'healthy'
-    health_status['last_poll'] = datetime.utcnow().isoformat()
+    status_board.poll_succeeded()
+    
+    return len(messages)
+
+
+def idle_backoff(empty_polls):
+    """
+    Extra wait after consecutive empty receives.
+    
+    The first empty receive already waited for the long poll, so the backoff
+    only starts from the second one and doubles up to IDLE_BACKOFF_MAX.
+    """
+    if empty_polls < 2:
+        return 0
+    return min(2 ** (empty_polls - 2), IDLE_BACKOFF_MAX)
+
+
+def poll_loop(poller_id):
+    """
+    Continuous consumer loop: re-polls immediately while messages are
+    arriving and backs off only while the queue is empty.
+    """
+    logger.info(f"Poller {poller_id} started")
+    empty_polls = 0
+    
+    while not shutdown_event.is_set():
+        try:
+            received = process_messages()
+        except Exception as e:
+            logger.error(f"Error in poller {poller_id}: {e}")
+            status_board.poll_failed()
+            received = 0
+        
+        if received:
+            empty_polls = 0
+            continue
+        
+        empty_polls += 1
+        backoff = idle_backoff(empty_polls)
+        if backoff:
+            logger.debug(f"Poller {poller_id} idle, waiting {backoff} seconds")
+            shutdown_event.wait(backoff)
+    
+    logger.info(f"Poller {poller_id} stopped")
+
+
+def run_streaming():
+    """
+    Run POLLER_COUNT poll loops feeding the shared upload pipeline until shutdown.
+    
+    Returns:
+        list: The poller threads, which may still be finishing a long poll
+    """
+    pollers = [
+        threading.Thread(target=poll_loop, args=(i,), name=f'poller-{i}', daemon=True)
+        for i in range(POLLER_COUNT)
+    ]
+    for poller in pollers:
+        poller.start()
+    
+    try:
+        while not shutdown_event.wait(1):
+            if not any(poller.is_alive() for poller in pollers):
+                break
+    except KeyboardInterrupt:
+        logger.info("Received shutdown signal, stopping gracefully...")
+        begin_shutdown()
+    return pollers
+
+
+def begin_shutdown():
+    """
+    Stop polling and report draining; drain() does the rest.
+    """
+    status_board.set_status('draining')
+    shutdown_event.set()
+
+
+def handle_shutdown_signal(signum, frame):
+    """
+    SIGTERM/SIGINT handler.
+    """
+    logger.info(f"Received signal {signal.Signals(signum).name}, draining in-flight messages...")
+    begin_shutdown()
+
+
+def drain(pollers=()):
+    """
+    Settle in-flight work within DRAIN_DEADLINE after polling has stopped.
+    
+    Running uploads and the writing of open batches are given until the
+    deadline to finish, and pending deletes are flushed. Whatever is still in
+    flight afterwards (queued or unfinished messages, and the messages of
+    batches not written in time) is released with a visibility timeout of 0
+    so another consumer picks it up immediately instead of after the
+    visibility timeout.
+    """
+    begin_shutdown()
+    deadline = time.time() + DRAIN_DEADLINE
+    
+    def remaining():
+        return max(deadline - time.time(), 0)
+    
+    logger.info(f"Draining {len(in_flight)} in-flight message(s), deadline {DRAIN_DEADLINE}s")
+    
+    cancelled = upload_pipeline.drain(timeout=remaining())
+    if cancelled:
+        logger.info(f"Cancelled {len(cancelled)} message(s) that had not started uploading")
+    sink_fan_out.stop(timeout=remaining())
+    deleter.flush()
+    
+    # A poller may still be inside a long poll; what it receives is released by process_messages
+    for poller in pollers:
+        poller.join(timeout=remaining())
+    deleter.flush()
+    
+    leftover = [entry['message'] for entry in in_flight.snapshot()]
+    if leftover:
+        released = release_messages(change_message_visibility_batch, leftover)
+        for message in leftover:
+            in_flight.remove(message['MessageId'])
+        logger.info(f"Released {released}/{len(leftover)} unfinished message(s) back to the queue")
+    
+    heartbeat.stop()
+    queue_sampler.stop()
+    seen_messages.close()
+    status_board.set_status('stopped')
+    logger.info(f"Drain finished in {DRAIN_DEADLINE - remaining():.1f}s")
+
+
+def pipeline_details():
+    """
+    Backpressure figures reported on /readyz.
+    """
+    details = {
+        'in_flight': len(in_flight),
+        'max_in_flight': MAX_IN_FLIGHT,
+        'pending_deletes': deleter.pending_count(),
+        'sinks': sink_fan_out.snapshot(),
+        'circuits': {'sqs': sqs_resilience.snapshot(), 's3': s3_resilience.snapshot()}
+    }
+    if ORDER_BY_MESSAGE_GROUP:
+        details['message_groups'] = upload_pipeline.snapshot()
+    return details
 
 
 def main():
@@ -186,13 +721,40 @@ def main():
     logger.info(f"SQS Queue URL: {SQS_QUEUE_URL}")
     logger.info(f"S3 Bucket: {S3_BUCKET_NAME}")
     logger.info(f"S3 Prefix: {S3_PREFIX}")
-    logger.info(f"Poll Interval: {POLL_INTERVAL} seconds")
+    logger.info(f"Consumer Mode: {CONSUMER_MODE}")
+    if CONSUMER_MODE == 'streaming':
+        logger.info(f"Pollers: {POLLER_COUNT}")
+    else:
+        logger.info(f"Poll Interval: {POLL_INTERVAL} seconds")
     logger.info(f"Max Messages Per Poll: {MAX_MESSAGES}")
+    logger.info(f"Upload Concurrency: {UPLOAD_CONCURRENCY}")
+    if ORDER_BY_MESSAGE_GROUP:
+        logger.info("Ordering: one message at a time per FIFO message group, groups in parallel")
+    logger.info(f"Max In-Flight Messages: {MAX_IN_FLIGHT}")
+    logger.info(f"Sinks: {', '.join(SINKS)}" + (f" (optional: {', '.join(OPTIONAL_SINKS)})" if OPTIONAL_SINKS else ""))
+    if 'file' in SINKS + OPTIONAL_SINKS:
+        logger.info(f"File Sink Directory: {SINK_FILE_DIR}")
+    if 's3-parquet' in SINKS + OPTIONAL_SINKS:
+        logger.info(f"Parquet Row Group Size: {PARQUET_ROW_GROUP_SIZE}, Compression: {PARQUET_COMPRESSION}")
+    if BATCHED_OUTPUT:
+        logger.info(f"Batch Thresholds: {AGGREGATE_MAX_RECORDS} records / {AGGREGATE_MAX_BYTES} bytes / {AGGREGATE_MAX_AGE}s")
+        if MAX_IN_FLIGHT < AGGREGATE_MAX_RECORDS:
+            logger.warning("MAX_IN_FLIGHT_MESSAGES is below AGGREGATE_MAX_RECORDS; batches will only flush on age")
+    logger.info(f"Visibility Timeout: {VISIBILITY_TIMEOUT}s (heartbeat every {VISIBILITY_HEARTBEAT}s)")
+    logger.info(f"Dedup: {DEDUP_CACHE_SIZE} MessageIds for {DEDUP_TTL}s" + (f", persisted to {DEDUP_DB_PATH}" if DEDUP_DB_PATH else ""))
     logger.info("=" * 80)
     
+    if 's3-parquet' in SINKS + OPTIONAL_SINKS:
+        try:
+            require_pyarrow()
+        except RuntimeError as e:
+            logger.error(f"✗ {e}")
+            logger.error("Exiting...")
+            return
+    
     # Verify S3 bucket exists
     try:
-        s3_client.head_bucket(Bucket=S3_BUCKET_NAME)
+        s3_resilience.retry(s3_client.head_bucket, Bucket=S3_BUCKET_NAME)
         logger.info(f"✓ S3 bucket '{S3_BUCKET_NAME}' is accessible")
     except ClientError as e:
         logger.error(f"✗ Cannot access S3 bucket '{S3_BUCKET_NAME}': {e}")
@@ -201,7 +763,8 @@ def main():
     
     # Verify SQS queue exists
     try:
-        sqs_client.get_queue_attributes(
+        sqs_resilience.retry(
+            sqs_client.get_queue_attributes,
             QueueUrl=SQS_QUEUE_URL,
             AttributeNames=['ApproximateNumberOfMessages']
         )
@@ -211,25 +774,38 @@ def main():
         logger.error("Exiting...")
         return
     
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, handle_shutdown_signal)
+        signal.signal(signal.SIGINT, handle_shutdown_signal)
+    
+    heartbeat.start()
+    queue_sampler.start()
+    sink_fan_out.start()
     logger.info("Starting message processing loop...")
     
+    if CONSUMER_MODE == 'streaming':
+        drain(run_streaming())
+        logger.info("SQS Processor stopped")
+        return
+    
     # Main processing loop
-    while True:
+    while not shutdown_event.is_set():
         try:
             process_messages()
             
             # Wait before next poll
             logger.info(f"Waiting {POLL_INTERVAL} seconds before next poll...")
-            time.sleep(POLL_INTERVAL)
+            shutdown_event.wait(POLL_INTERVAL)
             
         except KeyboardInterrupt:
             logger.info("Received shutdown signal, stopping gracefully...")
             break
         except Exception as e:
             logger.error(f"Error in main loop: {e}")
-            health_status['status'] = 'unhealthy'
-            time.sleep(POLL_INTERVAL)  # Wait before retrying
+            status_board.poll_failed()
+            shutdown_event.wait(POLL_INTERVAL)  # Wait before retrying
     
+    drain()
     logger.info("SQS Processor stopped")
 
 
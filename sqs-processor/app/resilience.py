@@ -0,0 +1,279 @@
+"""
+Retry and circuit breaking for AWS calls
+Shared by the email microservice and the SQS processor (each service ships its own copy
+because their images are built from separate directories; keep the copies identical,
+test_app.py fails when they differ).
+
+Retries use decorrelated-jitter backoff and draw from a retry budget, so a throttled
+dependency sees at most a bounded fraction of extra load. Failures that survive the
+retries feed a circuit breaker; while it is open, calls fail immediately with
+CircuitOpenError so callers can shed load (HTTP 503, paused polling) instead of queueing.
+"""
+import time
+import random
+import logging
+import threading
+from botocore.exceptions import ClientError, ConnectionError as BotoConnectionError, HTTPClientError
+
+logger = logging.getLogger(__name__)
+
+# Error codes that mean "try again later" rather than "this request is wrong"
+RETRYABLE_CODES = {
+    'Throttling', 'ThrottlingException', 'ThrottledException', 'RequestThrottled',
+    'RequestThrottledException', 'TooManyRequestsException', 'RequestLimitExceeded',
+    'ProvisionedThroughputExceededException', 'SlowDown', 'BandwidthLimitExceeded',
+    'RequestTimeout', 'RequestTimeoutException', 'InternalError', 'InternalFailure',
+    'ServiceUnavailable', 'AWS.SimpleQueueService.ServiceUnavailable'
+}
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of calling a dependency whose circuit is open
+    """
+
+    def __init__(self, name, retry_after):
+        super().__init__(f"{name} circuit is open, retry in {retry_after:.1f}s")
+        self.name = name
+        self.retry_after = retry_after
+
+
+def error_code(error):
+    """
+    AWS error code of an exception, or its class name
+    """
+    if isinstance(error, ClientError):
+        return error.response.get('Error', {}).get('Code', 'Unknown')
+    return type(error).__name__
+
+
+def is_retryable(error):
+    """
+    True for throttling, server-side and connection errors
+    """
+    if isinstance(error, (BotoConnectionError, HTTPClientError)):
+        return True
+    if isinstance(error, ClientError):
+        if error_code(error) in RETRYABLE_CODES:
+            return True
+        return error.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0) >= 500
+    return False
+
+
+def decorrelated_jitter(previous, base, cap):
+    """
+    Next backoff delay: random between base and 3x the previous delay, capped
+    """
+    return min(cap, random.uniform(base, previous * 3))
+
+
+class RetryBudget:
+    """
+    Token bucket limiting retries to a fraction of calls
+    Every call deposits `ratio` tokens and every retry withdraws one; `min_per_second`
+    tokens are added over time so low-traffic callers can still retry
+    """
+
+    def __init__(self, ratio=0.1, min_per_second=5, clock=time.monotonic):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.capacity = max(min_per_second * 10, 10)
+        self._clock = clock
+        self._tokens = float(self.capacity)
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = self._clock()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.min_per_second)
+        self._updated = now
+
+    def deposit(self):
+        with self._lock:
+            self._refill()
+            self._tokens = min(self.capacity, self._tokens + self.ratio)
+
+    def withdraw(self):
+        """
+        Take a token for one retry; False when the budget is exhausted
+        """
+        with self._lock:
+            self._refill()
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive failures; after `reset_timeout` seconds
+    one probe call is let through (half open) and its outcome closes or re-opens the circuit
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30, clock=time.monotonic, on_state_change=None):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._clock = clock
+        self._on_state_change = on_state_change
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+        self.opens = 0
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state
+
+    def _set_state(self, state):
+        if state == self._state:
+            return
+        self._state = state
+        if state == OPEN:
+            self.opens += 1
+            self._opened_at = self._clock()
+        if self._on_state_change is not None:
+            self._on_state_change(state)
+
+    def retry_after(self):
+        """
+        Seconds until the circuit lets a probe through (0 unless open)
+        """
+        with self._lock:
+            if self._state != OPEN:
+                return 0.0
+            return max(self.reset_timeout - (self._clock() - self._opened_at), 0.0)
+
+    def allow(self):
+        """
+        True if a call may be made now
+        """
+        with self._lock:
+            if self._state == CLOSED:
+                return True
+            if self._state == OPEN:
+                if self._clock() - self._opened_at < self.reset_timeout:
+                    return False
+                self._set_state(HALF_OPEN)
+            if self._probe_in_flight:
+                return False
+            self._probe_in_flight = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._probe_in_flight = False
+            self._set_state(CLOSED)
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._probe_in_flight = False
+            if self._state == HALF_OPEN or self._failures >= self.failure_threshold:
+                self._set_state(OPEN)
+
+
+class Resilience:
+    """
+    Retry policy, retry budget and circuit breaker for one dependency
+
+    Args:
+        name (str): Dependency name used in logs and metrics (e.g. 'sqs')
+        max_attempts (int): Attempts per call, including the first
+        base_delay (float): Minimum backoff in seconds
+        max_delay (float): Maximum backoff in seconds
+        budget (RetryBudget): Shared retry budget
+        breaker (CircuitBreaker): Circuit breaker, or None to never shed load
+        on_retry (callable): on_retry(name, error_code) before each retry
+        sleep (callable): Used for backoff waits
+    """
+
+    def __init__(self, name, max_attempts=3, base_delay=0.05, max_delay=2.0, budget=None,
+                 breaker=None, on_retry=None, sleep=time.sleep):
+        self.name = name
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget = budget or RetryBudget()
+        self.breaker = breaker
+        self._on_retry = on_retry
+        self._sleep = sleep
+        self.retries = 0
+
+    def retry_after(self):
+        """
+        Seconds callers should hold off before calling this dependency
+        """
+        return self.breaker.retry_after() if self.breaker is not None else 0.0
+
+    def check(self):
+        """
+        Raise CircuitOpenError while the circuit is open, without taking the probe slot
+        """
+        retry_after = self.retry_after()
+        if retry_after > 0:
+            raise CircuitOpenError(self.name, retry_after)
+
+    def call(self, fn, *args, **kwargs):
+        """
+        Call fn through the circuit breaker, retrying retryable errors with
+        decorrelated-jitter backoff
+        """
+        if self.breaker is not None and not self.breaker.allow():
+            raise CircuitOpenError(self.name, max(self.breaker.retry_after(), self.base_delay))
+        return self._call(fn, args, kwargs, self.breaker)
+
+    def retry(self, fn, *args, **kwargs):
+        """
+        Call fn with retries but without the circuit breaker, for calls that must
+        not be shed (e.g. acknowledging work that is already done)
+        """
+        return self._call(fn, args, kwargs, None)
+
+    def _call(self, fn, args, kwargs, breaker):
+        self.budget.deposit()
+        delay = self.base_delay
+        attempt = 1
+        while True:
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                if not is_retryable(e):
+                    # The dependency answered; the request itself was bad
+                    if breaker is not None:
+                        breaker.record_success()
+                    raise
+                if attempt >= self.max_attempts or not self.budget.withdraw():
+                    if breaker is not None:
+                        breaker.record_failure()
+                    raise
+                delay = decorrelated_jitter(delay, self.base_delay, self.max_delay)
+                code = error_code(e)
+                logger.warning(f"{self.name} call failed with {code}, retry {attempt} in {delay:.2f}s")
+                self.retries += 1
+                if self._on_retry is not None:
+                    self._on_retry(self.name, code)
+                self._sleep(delay)
+                attempt += 1
+            else:
+                if breaker is not None:
+                    breaker.record_success()
+                return result
+
+    def snapshot(self):
+        """
+        Breaker state and counters for health endpoints
+        """
+        return {
+            'state': self.breaker.state if self.breaker is not None else CLOSED,
+            'retries': self.retries,
+            'opens': self.breaker.opens if self.breaker is not None else 0
+        }
@@ -0,0 +1,423 @@
+#!/usr/bin/env python3
+"""
+Pluggable destinations for archived messages.
+
+The processor builds one record per SQS message and hands it to every
+configured sink. Record sinks write each record as it arrives (S3 objects,
+local files, stdout); batch sinks buffer records into batch objects (see
+aggregator.py) and acknowledge them once their batch has been written.
+
+SinkFanOut delivers a record to all sinks concurrently and settles the
+message once every required sink has acknowledged it: the message is deleted
+only if all required sinks succeeded. Optional sinks (e.g. a search index)
+are best effort: they neither hold up nor fail the delivery, and records are
+dropped rather than queued without bound when an optional sink falls behind.
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import threading
+from datetime import datetime
+from functools import partial
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait
+from aggregator import BatchBoundary
+from metrics import S3_UPLOAD_LATENCY, SINK_RECORDS, SINK_ACK_LATENCY, SINK_BUFFERED, timed
+
+logger = logging.getLogger(__name__)
+
+
+class RecordSink:
+    """
+    A destination written one record at a time.
+
+    Subclasses implement write(message, record), raising on failure.
+
+    Args:
+        name (str): Sink name used in logs and metrics
+        required (bool): Whether the message may only be deleted once this sink has written it
+    """
+
+    batched = False
+
+    def __init__(self, name, required=True):
+        self.name = name
+        self.required = required
+
+    def write(self, message, record):
+        raise NotImplementedError
+
+    def start(self):
+        pass
+
+    def stop(self, timeout=None):
+        pass
+
+
+class S3ObjectSink(RecordSink):
+    """
+    Writes each record as its own JSON object in S3.
+
+    Args:
+        write_object (callable): write_object(key, body, content_type, content_encoding, metadata)
+        key_for (callable): key_for(message, record) -> object key
+        bucket (str): Bucket name, for log messages
+    """
+
+    def __init__(self, write_object, key_for, bucket, name='s3', required=True):
+        super().__init__(name, required)
+        self._write_object = write_object
+        self._key_for = key_for
+        self.bucket = bucket
+
+    def write(self, message, record):
+        message_id = message['MessageId']
+        key = self._key_for(message, record)
+        with timed(S3_UPLOAD_LATENCY.labels(kind='message')):
+            self._write_object(
+                key,
+                json.dumps(record, indent=2),
+                'application/json',
+                None,
+                {'message-id': message_id, 'processed-at': datetime.utcnow().isoformat()}
+            )
+        logger.info(f"Successfully uploaded message {message_id} to s3://{self.bucket}/{key}")
+
+
+class FileSink(RecordSink):
+    """
+    Writes each record as a JSON file below a local directory.
+
+    Files are written to a temporary name and renamed into place, so readers
+    never see a partial record and a redelivery replaces the same file.
+
+    Args:
+        directory (str): Root directory
+        key_for (callable): key_for(message, record) -> path relative to directory
+    """
+
+    def __init__(self, directory, key_for, name='file', required=True):
+        super().__init__(name, required)
+        self.directory = directory
+        self._key_for = key_for
+
+    def write(self, message, record):
+        path = os.path.join(self.directory, self._key_for(message, record))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary = f"{path}.{threading.get_ident()}.tmp"
+        with open(temporary, 'w') as f:
+            json.dump(record, f, indent=2)
+        os.replace(temporary, path)
+
+
+class StreamSink(RecordSink):
+    """
+    Writes each record as one line of newline-delimited JSON (stdout by default).
+
+    Args:
+        stream: Text stream to write to
+    """
+
+    def __init__(self, stream=None, name='stdout', required=True):
+        super().__init__(name, required)
+        self._stream = stream or sys.stdout
+        self._lock = threading.Lock()
+
+    def write(self, message, record):
+        line = json.dumps(record, separators=(',', ':')) + '\n'
+        with self._lock:
+            self._stream.write(line)
+            self._stream.flush()
+
+
+class BatchSink:
+    """
+    A destination that buffers records into batch objects.
+
+    Records are acknowledged through the on_ack callback given to add() when
+    their batch has been written (or has failed): on_ack(messages, success)
+    is called once per batch with all of the batch's messages that were
+    added with that callback.
+
+    Args:
+        name (str): Sink name used in logs and metrics
+        make_aggregator (callable): make_aggregator(on_flushed) -> BatchAggregator
+        required (bool): Whether the message may only be deleted once its batch has been written
+    """
+
+    batched = True
+
+    def __init__(self, name, make_aggregator, required=True):
+        self.name = name
+        self.required = required
+        self.aggregator = make_aggregator(self._flushed)
+        self._acks = {}  # ReceiptHandle -> on_ack
+        self._lock = threading.Lock()
+
+    def add(self, message, record, on_ack, after=None):
+        """
+        Add a record to its batch (right behind batch `after`, see
+        BatchAggregator.add); returns the batch ID and raises if the batch
+        could not take it.
+        """
+        with self._lock:
+            self._acks[message['ReceiptHandle']] = on_ack
+        try:
+            return self.aggregator.add(message, record, after=after)
+        except Exception:
+            with self._lock:
+                self._acks.pop(message['ReceiptHandle'], None)
+            raise
+
+    def _flushed(self, messages, success):
+        by_callback = defaultdict(list)
+        with self._lock:
+            for message in messages:
+                on_ack = self._acks.pop(message['ReceiptHandle'], None)
+                if on_ack is not None:
+                    by_callback[on_ack].append(message)
+        for on_ack, acked in by_callback.items():
+            on_ack(acked, success)
+
+    def buffered_count(self):
+        return self.aggregator.buffered_count()
+
+    def start(self):
+        self.aggregator.start()
+
+    def stop(self, timeout=None):
+        """Stop the age flusher and write out open batches, for at most `timeout` seconds."""
+        self.aggregator.stop(timeout)
+
+
+class Delivery:
+    """Acknowledgements still outstanding for one message."""
+
+    __slots__ = ('message', 'waiting', 'result', 'deferred', 'started_at', 'batch_id')
+
+    def __init__(self, message, required):
+        self.message = message
+        self.waiting = set(required)
+        self.result = None  # True or False once settled
+        self.deferred = False  # The handler returned before the delivery settled
+        self.started_at = time.monotonic()
+        self.batch_id = None  # Batch of the chaining sink the record joined
+
+
+class SinkFanOut:
+    """
+    Hands each record to every sink and settles the message once all
+    required sinks have answered.
+
+    The first required record sink runs on the calling thread; every other
+    record sink has its own worker pool, so a slow sink does not delay the
+    others. deliver() waits for the required record sinks and returns their
+    combined result, or None if a required batch sink has yet to write the
+    record; on_settled is then called once the batch has been written.
+
+    A failure of any required sink settles the message as failed. Writes to
+    optional sinks are not waited for, and are dropped (counted as 'dropped')
+    while `max_pending` of their records are already queued.
+
+    When the only required sink is a batch sink, a record can be chained:
+    chain_token() returns the batch a deferred record joined, and
+    deliver(after=token) appends the next record of the same FIFO group to
+    that batch, or raises BatchBoundary without writing anywhere if it has
+    been closed. Record sinks write independently of batches and do not
+    keep that order, so with a required record sink nothing is chained.
+
+    Args:
+        sinks (list): RecordSink and BatchSink instances, at least one of them required
+        on_settled (callable): on_settled([(message, success), ...]) for deliveries
+            settled after deliver() returned None
+        concurrency (int): Worker threads per record sink that does not run inline
+        max_pending (int): Records an optional record sink may have queued
+    """
+
+    def __init__(self, sinks, on_settled, concurrency, max_pending=1000):
+        names = [sink.name for sink in sinks]
+        if len(set(names)) != len(names):
+            raise ValueError(f"Sink names must be unique: {names}")
+        if not any(sink.required for sink in sinks):
+            raise ValueError("At least one sink must be required")
+        self.sinks = sinks
+        self._on_settled = on_settled
+        self.max_pending = max_pending
+        self._required = [sink.name for sink in sinks if sink.required]
+        record_sinks = [sink for sink in sinks if not sink.batched]
+        self._inline = next((sink for sink in record_sinks if sink.required), None)
+        self._pooled = [sink for sink in record_sinks if sink is not self._inline]
+        self._batched = [sink for sink in sinks if sink.batched]
+        required = [sink for sink in sinks if sink.required]
+        self._chain_sink = required[0] if len(required) == 1 and required[0].batched else None
+        if self._chain_sink is not None:
+            # Added first, so a batch boundary is found before any other sink is written
+            self._batched.remove(self._chain_sink)
+            self._batched.insert(0, self._chain_sink)
+        self._executors = {
+            sink.name: ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix=f'sink-{sink.name}')
+            for sink in self._pooled
+        }
+        self._batch_acks = {sink.name: partial(self._batch_acked, sink) for sink in self._batched}
+        self._deliveries = {}  # ReceiptHandle -> Delivery waiting for a batch sink
+        self._pending = {sink.name: 0 for sink in record_sinks}
+        self._lock = threading.Lock()
+        self.stats = {sink.name: {'written': 0, 'failed': 0, 'dropped': 0} for sink in sinks}
+        for sink in sinks:
+            SINK_BUFFERED.labels(sink=sink.name).set_function(partial(self.buffered_count, sink))
+
+    def start(self):
+        for sink in self.sinks:
+            sink.start()
+
+    def deliver(self, message, record, after=None):
+        """
+        Hand a record to every sink.
+
+        Args:
+            after: chain_token() of the previous record of the same FIFO group
+
+        Returns:
+            bool: Whether all required sinks wrote the record
+            None: A required batch sink will settle the message later
+
+        Raises:
+            BatchBoundary: The record cannot follow `after`; nothing was written
+        """
+        delivery = Delivery(message, self._required)
+        if self._batched:
+            with self._lock:
+                self._deliveries[message['ReceiptHandle']] = delivery
+
+        for sink in self._batched:
+            chained = sink is self._chain_sink
+            try:
+                batch_id = sink.add(message, record, self._batch_acks[sink.name], after=after if chained else None)
+            except BatchBoundary:
+                with self._lock:
+                    self._deliveries.pop(message['ReceiptHandle'], None)
+                raise
+            except Exception as e:
+                logger.error(f"Sink {sink.name} could not take message {message['MessageId']}: {e}")
+                self._acked(sink, [delivery], False)
+            else:
+                if chained:
+                    delivery.batch_id = batch_id
+
+        waiting = []
+        for sink in self._pooled:
+            with self._lock:
+                if not sink.required and self._pending[sink.name] >= self.max_pending:
+                    self._count(sink, 'dropped')
+                    continue
+                self._pending[sink.name] += 1
+            future = self._executors[sink.name].submit(self._write, sink, delivery, record)
+            if sink.required:
+                waiting.append(future)
+
+        if self._inline is not None:
+            with self._lock:
+                self._pending[self._inline.name] += 1
+            self._write(self._inline, delivery, record)
+        wait(waiting)
+
+        with self._lock:
+            if delivery.result is None:
+                delivery.deferred = True
+                return None
+            self._deliveries.pop(message['ReceiptHandle'], None)
+            return delivery.result
+
+    def chain_token(self, message):
+        """
+        Batch a deferred record joined, for deliver(after=...) of the next
+        record of its group; None if records cannot be chained.
+        """
+        if self._chain_sink is None:
+            return None
+        with self._lock:
+            delivery = self._deliveries.get(message['ReceiptHandle'])
+            return delivery.batch_id if delivery is not None else None
+
+    def _write(self, sink, delivery, record):
+        start = time.perf_counter()
+        try:
+            sink.write(delivery.message, record)
+            success = True
+        except Exception as e:
+            logger.error(f"Sink {sink.name} failed to write message {delivery.message['MessageId']}: {e}")
+            success = False
+        SINK_ACK_LATENCY.labels(sink=sink.name).observe(time.perf_counter() - start)
+        with self._lock:
+            self._pending[sink.name] -= 1
+        self._acked(sink, [delivery], success)
+
+    def _batch_acked(self, sink, messages, success):
+        now = time.monotonic()
+        with self._lock:
+            deliveries = [self._deliveries.get(message['ReceiptHandle']) for message in messages]
+        deliveries = [delivery for delivery in deliveries if delivery is not None]
+        latency = SINK_ACK_LATENCY.labels(sink=sink.name)
+        for delivery in deliveries:
+            latency.observe(now - delivery.started_at)
+        self._acked(sink, deliveries, success, count=len(messages))
+
+    def _acked(self, sink, deliveries, success, count=None):
+        """Record a sink's answer for some deliveries and settle those that are complete."""
+        settled = []
+        with self._lock:
+            self._count(sink, 'written' if success else 'failed', len(deliveries) if count is None else count)
+            for delivery in deliveries:
+                if not sink.required or delivery.result is not None:
+                    continue
+                delivery.waiting.discard(sink.name)
+                if not success:
+                    delivery.result = False
+                elif not delivery.waiting:
+                    delivery.result = True
+                if delivery.result is not None and delivery.deferred:
+                    self._deliveries.pop(delivery.message['ReceiptHandle'], None)
+                    settled.append((delivery.message, delivery.result))
+        if settled:
+            try:
+                self._on_settled(settled)
+            except Exception as e:
+                logger.error(f"Error settling {len(settled)} message(s): {e}")
+
+    def _count(self, sink, outcome, count=1):
+        """Count sink outcomes (called with the lock held)."""
+        self.stats[sink.name][outcome] += count
+        SINK_RECORDS.labels(sink=sink.name, outcome=outcome).inc(count)
+
+    def buffered_count(self, sink):
+        """
+        Records handed to a sink and not yet acknowledged by it. Reads plain
+        counters without locking, so the metrics scrape and /readyz never
+        wait behind a delivery.
+        """
+        if sink.batched:
+            return sink.buffered_count()
+        return self._pending[sink.name]
+
+    def stop(self, timeout=None):
+        """
+        Write out open batches and stop the sink workers; queued writes to
+        optional sinks are abandoned. Sinks share `timeout` seconds; messages
+        of batches not written by then are left unsettled.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for sink in self.sinks:
+            sink.stop(None if deadline is None else max(deadline - time.monotonic(), 0))
+        for executor in self._executors.values():
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def snapshot(self):
+        """Per-sink counts reported on /readyz (read without locking)."""
+        return {
+            sink.name: dict(self.stats[sink.name], required=sink.required,
+                            batched=sink.batched, buffered=self.buffered_count(sink))
+            for sink in self.sinks
+        }
@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+"""
+Batched SQS bookkeeping for the processor.
+
+BatchDeleter accumulates processed messages and deletes them with
+DeleteMessageBatch. VisibilityHeartbeat extends the visibility timeout of
+messages that are still being processed so slow uploads are not redelivered.
+"""
+
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Maximum entries per SQS *Batch call
+MAX_BATCH_ENTRIES = 10
+
+
+def run_batch_call(call, entries, max_retries=2, backoff=0.1):
+    """
+    Invoke an SQS batch API, retrying entries that failed on the SQS side.
+
+    Whole-call failures are not retried here: the call goes through the
+    resilience layer, which has already retried it within the retry budget,
+    so retrying again would multiply attempts and bypass the circuit breaker.
+
+    Args:
+        call (callable): Function taking a list of entries and returning the API response
+        entries (list): Batch entries, each with a unique 'Id'
+        max_retries (int): Retries for entries SQS reports as failed
+
+    Returns:
+        dict: Entry Id -> None on success, or an error string on failure
+    """
+    pending = {entry['Id']: entry for entry in entries}
+    results = {}
+    attempt = 0
+
+    while pending:
+        try:
+            response = call(list(pending.values()))
+        except Exception as e:
+            logger.warning(f"SQS batch call failed: {e}")
+            for entry_id in pending:
+                results[entry_id] = str(e)
+            break
+
+        for success in response.get('Successful', []):
+            pending.pop(success['Id'], None)
+            results[success['Id']] = None
+
+        for failure in response.get('Failed', []):
+            # Sender faults (e.g. an expired receipt handle) will not succeed on retry
+            if failure.get('SenderFault') or attempt >= max_retries:
+                pending.pop(failure['Id'], None)
+                results[failure['Id']] = f"{failure.get('Code')}: {failure.get('Message', '')}"
+
+        if pending and attempt >= max_retries:
+            for entry_id in pending:
+                results[entry_id] = 'No result returned by SQS'
+            break
+
+        attempt += 1
+        if pending:
+            time.sleep(backoff * (2 ** (attempt - 1)))
+
+    return results
+
+
+class BatchDeleter:
+    """
+    Background deleter that flushes messages with DeleteMessageBatch.
+
+    A batch is flushed when 10 messages are pending or when the oldest
+    pending message has waited `flush_interval` seconds.
+    `on_complete(message, deleted)` is called for every message.
+    """
+
+    def __init__(self, delete_batch, on_complete, flush_interval=0.2):
+        self._delete_batch = delete_batch
+        self._on_complete = on_complete
+        self.flush_interval = flush_interval
+        self._pending = []
+        self._condition = threading.Condition()
+        self._thread = None
+        self._send_lock = threading.Lock()
+
+    def delete(self, message):
+        """Queue a message for deletion."""
+        with self._condition:
+            self._pending.append(message)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='sqs-deleter', daemon=True)
+                self._thread.start()
+            # Wake the deleter for the first pending message (starts the
+            # flush_interval wait) and again once a full batch is ready
+            if len(self._pending) == 1 or len(self._pending) >= MAX_BATCH_ENTRIES:
+                self._condition.notify()
+
+    def pending_count(self):
+        """Number of messages waiting to be deleted."""
+        with self._condition:
+            return len(self._pending)
+
+    def _take_batch(self):
+        with self._condition:
+            batch = self._pending[:MAX_BATCH_ENTRIES]
+            del self._pending[:MAX_BATCH_ENTRIES]
+            return batch
+
+    def _run(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._pending)
+                self._condition.wait_for(
+                    lambda: len(self._pending) >= MAX_BATCH_ENTRIES, timeout=self.flush_interval
+                )
+            self._send(self._take_batch())
+
+    def flush(self):
+        """Synchronously delete everything that is pending."""
+        while True:
+            batch = self._take_batch()
+            if not batch:
+                return
+            self._send(batch)
+
+    def _send(self, batch):
+        if not batch:
+            return
+        entries = [
+            {'Id': str(index), 'ReceiptHandle': message['ReceiptHandle']}
+            for index, message in enumerate(batch)
+        ]
+        with self._send_lock:
+            try:
+                results = run_batch_call(self._delete_batch, entries)
+            except Exception as e:
+                logger.error(f"Unexpected error deleting messages from SQS: {e}")
+                results = {entry['Id']: str(e) for entry in entries}
+
+        deleted = 0
+        for index, message in enumerate(batch):
+            error = results.get(str(index), 'No result returned by SQS')
+            if error is None:
+                deleted += 1
+            else:
+                logger.error(f"Failed to delete message {message['MessageId']} from SQS: {error}")
+            self._on_complete(message, error is None)
+        logger.info(f"Deleted {deleted}/{len(batch)} message(s) from SQS queue")
+
+
+class VisibilityHeartbeat:
+    """
+    Periodically extends the visibility timeout of in-flight messages.
+
+    Every `interval` seconds, messages in the registry whose visibility
+    deadline falls before the next two beats are extended by `extension`
+    seconds with ChangeMessageVisibilityBatch.
+    """
+
+    def __init__(self, registry, change_visibility_batch, interval=10, extension=60):
+        self._registry = registry
+        self._change_visibility_batch = change_visibility_batch
+        self.interval = interval
+        self.extension = extension
+        self._stop = threading.Event()
+        self._thread = None
+        self.extended = 0
+
+    def start(self):
+        """Start the heartbeat thread."""
+        self._thread = threading.Thread(target=self._run, name='sqs-visibility-heartbeat', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the heartbeat thread."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.beat()
+            except Exception as e:
+                logger.error(f"Visibility heartbeat failed: {e}")
+
+    def beat(self):
+        """Extend visibility for messages that would otherwise expire soon."""
+        now = time.time()
+        due = [
+            entry['message'] for entry in self._registry.snapshot()
+            if entry['visibility_deadline'] is not None
+            and entry['visibility_deadline'] - now < 2 * self.interval
+        ]
+
+        for start in range(0, len(due), MAX_BATCH_ENTRIES):
+            batch = due[start:start + MAX_BATCH_ENTRIES]
+            entries = [
+                {
+                    'Id': str(index),
+                    'ReceiptHandle': message['ReceiptHandle'],
+                    'VisibilityTimeout': self.extension
+                }
+                for index, message in enumerate(batch)
+            ]
+            results = run_batch_call(self._change_visibility_batch, entries)
+            deadline = time.time() + self.extension
+            for index, message in enumerate(batch):
+                error = results.get(str(index))
+                if error is None:
+                    self._registry.update(message['MessageId'], visibility_deadline=deadline)
+                    self.extended += 1
+                else:
+                    logger.warning(f"Could not extend visibility of message {message['MessageId']}: {error}")
+
+        if due:
+            logger.info(f"Extended visibility of {len(due)} in-flight message(s) by {self.extension} seconds")
+
+
+def release_messages(change_visibility_batch, messages):
+    """
+    Make messages visible again immediately (VisibilityTimeout=0).
+
+    Used on shutdown so another consumer picks the messages up right away
+    instead of after their visibility timeout.
+
+    Returns:
+        int: Number of messages released
+    """
+    released = 0
+    for start in range(0, len(messages), MAX_BATCH_ENTRIES):
+        batch = messages[start:start + MAX_BATCH_ENTRIES]
+        entries = [
+            {'Id': str(index), 'ReceiptHandle': message['ReceiptHandle'], 'VisibilityTimeout': 0}
+            for index, message in enumerate(batch)
+        ]
+        try:
+            results = run_batch_call(change_visibility_batch, entries)
+        except Exception as e:
+            logger.error(f"Unexpected error releasing messages: {e}")
+            continue
+        for index, message in enumerate(batch):
+            error = results.get(str(index))
+            if error is None:
+                released += 1
+            else:
+                logger.warning(f"Could not release message {message['MessageId']}: {error}")
+    return released
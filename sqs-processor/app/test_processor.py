@@ -0,0 +1,899 @@
+"""
+Unit tests for the SQS processor
+"""
+import io
+import os
+import gzip
+import json
+import time
+import threading
+import urllib.error
+import urllib.request
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch, MagicMock
+from botocore.exceptions import ClientError
+from prometheus_client import REGISTRY
+
+os.environ.setdefault('SQS_QUEUE_URL', 'https://sqs.us-west-1.amazonaws.com/123456789012/test-queue')
+os.environ.setdefault('S3_BUCKET_NAME', 'test-bucket')
+
+import processor
+from pipeline import HOLD, InFlightRegistry, UploadPipeline, GroupedUploadPipeline
+from sinks import SinkFanOut, RecordSink, BatchSink
+from aggregator import BatchAggregator, BatchBoundary
+from sqs_batch import BatchDeleter, VisibilityHeartbeat, run_batch_call
+from multipart import MultipartUploadWriter, MIN_PART_SIZE
+from dedup import SeenSet
+from parquet_sink import parquet_encoder, partition_by_event_date
+from metrics import QueueDepthSampler
+from health import StatusBoard, start_health_server
+
+
+def sqs_message(message_id, group=None):
+    """An SQS message as returned by ReceiveMessage"""
+    message = {'MessageId': message_id, 'ReceiptHandle': f'handle-{message_id}', 'Body': '{}'}
+    if group is not None:
+        message['Attributes'] = {'MessageGroupId': group}
+    return message
+
+
+def wait_for(condition, timeout=5):
+    """Poll until condition() is true or the timeout passes"""
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def successful(entries):
+    """SQS batch response in which every entry succeeded"""
+    return {'Successful': [{'Id': entry['Id']} for entry in entries], 'Failed': []}
+
+
+class MemoryWriter(io.RawIOBase):
+    """Stand-in for MultipartUploadWriter that keeps the object in memory"""
+
+    def __init__(self, fail=False):
+        super().__init__()
+        self.data = b''
+        self.fail = fail
+        self.aborted = False
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if self.fail:
+            raise IOError('upload failed')
+        self.data += bytes(data)
+        return len(data)
+
+    def close(self):
+        pass
+
+    def abort(self):
+        self.aborted = True
+
+
+def test_upload_pipeline_bounds_concurrency():
+    """Test that the pipeline never runs more handlers at once than its concurrency"""
+    gate = threading.Event()
+    running = []
+    peak = []
+    lock = threading.Lock()
+    completed = []
+
+    def handler(message):
+        with lock:
+            running.append(message['MessageId'])
+            peak.append(len(running))
+        gate.wait(5)
+        with lock:
+            running.remove(message['MessageId'])
+        return message['MessageId'] != 'm3'
+
+    pipeline = UploadPipeline(handler, lambda message, result: completed.append((message['MessageId'], result)),
+                              concurrency=2)
+    for message_id in ('m1', 'm2', 'm3', 'm4', 'm5'):
+        pipeline.submit(sqs_message(message_id))
+
+    assert wait_for(lambda: len(running) == 2)
+    time.sleep(0.1)
+    assert len(running) == 2 and completed == []
+    gate.set()
+    assert wait_for(lambda: len(completed) == 5)
+    assert max(peak) == 2
+    assert sorted(completed) == [('m1', True), ('m2', True), ('m3', False), ('m4', True), ('m5', True)]
+    pipeline.shutdown()
+
+
+def test_upload_pipeline_fails_message_when_handler_raises():
+    """Test that a handler exception leaves the message for redelivery"""
+    completed = []
+
+    def handler(message):
+        raise RuntimeError('boom')
+
+    pipeline = UploadPipeline(handler, lambda message, result: completed.append((message['MessageId'], result)),
+                              concurrency=1)
+    pipeline.submit(sqs_message('m1'))
+    assert wait_for(lambda: completed == [('m1', False)])
+    pipeline.shutdown()
+
+
+def test_in_flight_registry_applies_backpressure():
+    """Test that the registry blocks receives at max_in_flight until a message is settled"""
+    registry = InFlightRegistry(max_in_flight=2)
+    registry.add(sqs_message('m1'), visibility_timeout=30)
+    assert registry.capacity() == 1
+    registry.add(sqs_message('m2'))
+    assert registry.capacity() == 0
+    assert not registry.wait_for_capacity(timeout=0.05)
+
+    threading.Timer(0.1, registry.remove, args=('m1',)).start()
+    assert registry.wait_for_capacity(timeout=5)
+    assert [entry['message']['MessageId'] for entry in registry.snapshot()] == ['m2']
+    assert registry.snapshot()[0]['visibility_deadline'] is None
+
+
+def test_process_messages_receives_only_what_fits_in_flight():
+    """Test that the poller asks SQS for no more messages than the pipeline has room for"""
+    registry = InFlightRegistry(max_in_flight=3)
+    registry.add(sqs_message('m0'))
+    received = [sqs_message('m1'), sqs_message('m2')]
+    with patch('processor.in_flight', registry), \
+         patch('processor.upload_pipeline') as mock_pipeline, \
+         patch('processor.poll_sqs_messages', return_value=received) as mock_poll:
+        assert processor.process_messages() == 2
+
+    mock_poll.assert_called_once_with(max_messages=2)
+    assert [call[0][0]['MessageId'] for call in mock_pipeline.submit.call_args_list] == ['m1', 'm2']
+    assert len(registry) == 3
+
+
+def test_idle_backoff_starts_after_second_empty_poll():
+    """Test that the idle backoff skips the first empty receive and doubles up to the maximum"""
+    with patch('processor.IDLE_BACKOFF_MAX', 4):
+        assert [processor.idle_backoff(n) for n in range(7)] == [0, 0, 1, 2, 4, 4, 4]
+
+
+def test_poll_loop_repolls_at_once_while_messages_arrive():
+    """Test that the poll loop only waits once the queue is empty, and resets after a receive"""
+    received = iter([3, 2, 0, 0, 0, 5, 0, 0])
+    waits = []
+    calls = [0]
+
+    class StopAfterReceives:
+        """Shutdown event set after the last receive, recording the loop's waits"""
+
+        def is_set(self):
+            return calls[0] >= 8
+
+        def wait(self, timeout=None):
+            waits.append((calls[0], timeout))
+            return False
+
+    def process_messages():
+        calls[0] += 1
+        return next(received)
+
+    with patch('processor.process_messages', process_messages), \
+         patch('processor.shutdown_event', StopAfterReceives()):
+        processor.poll_loop(0)
+
+    assert calls[0] == 8
+    assert waits == [(4, 1), (5, 2), (8, 1)]
+
+
+def test_poll_loop_survives_errors():
+    """Test that an error in one cycle is reported and the loop keeps polling"""
+    results = [RuntimeError('boom'), 1]
+    event = threading.Event()
+
+    def process_messages():
+        result = results.pop(0)
+        if not results:
+            event.set()
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    with patch('processor.process_messages', process_messages), \
+         patch('processor.shutdown_event', event), \
+         patch.object(processor.status_board, 'poll_failed') as poll_failed:
+        processor.poll_loop(0)
+
+    assert results == []
+    poll_failed.assert_called_once_with()
+
+
+def test_grouped_pipeline_stops_group_after_failure():
+    """Test that a failed message skips the rest of its group, while other groups continue"""
+    handled = []
+    completed = []
+
+    def handler(message):
+        handled.append(message['MessageId'])
+        return message['MessageId'] != 'a2'
+
+    pipeline = GroupedUploadPipeline(handler, lambda message, result: completed.append((message['MessageId'], result)),
+                                     concurrency=4)
+    for message_id, group in [('a1', 'a'), ('a2', 'a'), ('a3', 'a'), ('a4', 'a'), ('b1', 'b'), ('b2', 'b')]:
+        pipeline.submit(sqs_message(message_id, group))
+
+    assert wait_for(lambda: len(completed) == 6)
+    assert 'a3' not in handled and 'a4' not in handled
+    assert handled.index('a1') < handled.index('a2')
+    assert handled.index('b1') < handled.index('b2')
+    assert sorted(completed) == [('a1', True), ('a2', False), ('a3', False), ('a4', False),
+                                 ('b1', True), ('b2', True)]
+    assert pipeline.active_groups() == 0
+    pipeline.shutdown()
+
+
+def test_grouped_pipeline_holds_group_until_deferred_message_settles():
+    """Test that a group does not continue while its current message waits for a batch"""
+    handled = []
+    completed = []
+
+    def handler(message):
+        handled.append(message['MessageId'])
+        return None if message['MessageId'] == 'a1' else True
+
+    pipeline = GroupedUploadPipeline(handler, lambda message, result: completed.append((message['MessageId'], result)),
+                                     concurrency=2)
+    pipeline.submit(sqs_message('a1', 'a'))
+    pipeline.submit(sqs_message('a2', 'a'))
+    assert wait_for(lambda: handled == ['a1'])
+    time.sleep(0.1)
+    assert handled == ['a1'] and completed == []
+
+    pipeline.settle(sqs_message('a1', 'a'), True)
+    assert wait_for(lambda: len(completed) == 2)
+    assert completed == [('a1', True), ('a2', True)]
+    pipeline.shutdown()
+
+
+def test_grouped_pipeline_drain_returns_queued_messages():
+    """Test that draining returns the messages that never started"""
+    gate = threading.Event()
+    pipeline = GroupedUploadPipeline(lambda message: gate.wait(5), lambda message, result: None, concurrency=1)
+    for message_id in ('a1', 'a2', 'a3'):
+        pipeline.submit(sqs_message(message_id, 'a'))
+
+    threading.Timer(0.2, gate.set).start()
+    cancelled = pipeline.drain(timeout=5)
+    assert [message['MessageId'] for message in cancelled] == ['a2', 'a3']
+
+
+class RecordingSink(RecordSink):
+    """Record sink remembering what it was given"""
+
+    def __init__(self, name, required=True, fail=False):
+        super().__init__(name, required)
+        self.fail = fail
+        self.written = []
+
+    def write(self, message, record):
+        if self.fail:
+            raise IOError('sink unavailable')
+        self.written.append(message['MessageId'])
+
+
+def batch_sink(name='s3-batch', max_records=2, writer=MemoryWriter, partition_for=lambda record: 'p'):
+    """BatchSink over an in-memory aggregator, and the objects it writes"""
+    objects = {}
+
+    def open_object(key, content_type, content_encoding, metadata):
+        objects[key] = writer()
+        return objects[key]
+
+    sink = BatchSink(name, lambda on_flushed: BatchAggregator(
+        open_object=open_object,
+        write_object=lambda key, body, *args: objects.__setitem__(key, body),
+        on_flushed=on_flushed,
+        key_prefix='test/',
+        max_records=max_records,
+        partition_for=partition_for
+    ))
+    return sink, objects
+
+
+def test_fan_out_settles_deferred_delivery_when_batch_acks():
+    """Test that a message waiting on a batch sink is settled once the batch is written"""
+    settled = []
+    record_sink = RecordingSink('file')
+    sink, objects = batch_sink()
+    fan_out = SinkFanOut([record_sink, sink], on_settled=settled.extend, concurrency=2)
+
+    assert fan_out.deliver(sqs_message('m1'), {'n': 1}) is None
+    assert record_sink.written == ['m1']
+    assert settled == []
+    assert fan_out.buffered_count(sink) == 1
+
+    # The second record fills the batch, which is written from the calling thread
+    assert fan_out.deliver(sqs_message('m2'), {'n': 2}) is True
+    assert [(message['MessageId'], success) for message, success in settled] == [('m1', True)]
+    assert fan_out.buffered_count(sink) == 0
+    assert fan_out.snapshot()['s3-batch']['written'] == 2
+    assert any(key.startswith('test/manifests/') for key in objects)
+    fan_out.stop()
+
+
+def chained_pipeline(sink, completed):
+    """Grouped pipeline delivering to a single batch sink, as the processor wires it"""
+    pipeline = None
+
+    def handler(message, after=None):
+        try:
+            return fan_out.deliver(message, json.loads(message['Body']), after=after)
+        except BatchBoundary:
+            return HOLD
+
+    def settled(results):
+        for message, success in results:
+            pipeline.settle(message, success)
+
+    fan_out = SinkFanOut([sink], on_settled=settled, concurrency=2)
+    pipeline = GroupedUploadPipeline(handler, lambda message, result: completed.append((message['MessageId'], result)),
+                                     concurrency=2, chain_token=fan_out.chain_token)
+    return pipeline, fan_out
+
+
+def grouped_record(message_id, group, record):
+    message = sqs_message(message_id, group)
+    message['Body'] = json.dumps(record)
+    return message
+
+
+def test_grouped_pipeline_chains_group_into_open_batch():
+    """Test that later messages of a group join the open batch of its deferred message, in order"""
+    completed = []
+    sink, objects = batch_sink(max_records=3)
+    pipeline, fan_out = chained_pipeline(sink, completed)
+    for n in (1, 2):
+        pipeline.submit(grouped_record(f'a{n}', 'a', {'n': n}))
+    assert wait_for(lambda: fan_out.buffered_count(sink) == 2)
+    assert completed == []
+
+    # The third record fills the batch: the group completes in order once it is written
+    pipeline.submit(grouped_record('a3', 'a', {'n': 3}))
+    assert wait_for(lambda: len(completed) == 3)
+    assert completed == [('a1', True), ('a2', True), ('a3', True)]
+    batch = next(writer for key, writer in objects.items() if key.startswith('test/batches/'))
+    assert [json.loads(line)['n'] for line in gzip.decompress(batch.data).splitlines()] == [1, 2, 3]
+    assert pipeline.active_groups() == 0
+    pipeline.shutdown()
+    fan_out.stop()
+
+
+def test_grouped_pipeline_holds_group_at_batch_boundary():
+    """Test that a message that cannot join its group's open batch waits until that batch is written"""
+    completed = []
+    sink, objects = batch_sink(max_records=10, partition_for=lambda record: record['partition'])
+    pipeline, fan_out = chained_pipeline(sink, completed)
+    pipeline.submit(grouped_record('a1', 'a', {'partition': 'p'}))
+    pipeline.submit(grouped_record('a2', 'a', {'partition': 'q'}))
+    assert wait_for(lambda: fan_out.buffered_count(sink) == 1)
+    time.sleep(0.1)
+    assert fan_out.buffered_count(sink) == 1 and completed == []
+
+    sink.aggregator.flush_all()
+    assert wait_for(lambda: fan_out.buffered_count(sink) == 1 and completed == [('a1', True)])
+    sink.aggregator.flush_all()
+    assert wait_for(lambda: len(completed) == 2)
+    assert completed == [('a1', True), ('a2', True)]
+    pipeline.shutdown()
+    fan_out.stop()
+
+
+def test_grouped_pipeline_fails_chained_messages_with_their_batch():
+    """Test that a failed batch fails every message chained into it and skips the rest of the group"""
+    class FailingWriter(MemoryWriter):
+        def close(self):
+            raise IOError('upload failed')
+
+    completed = []
+    sink, objects = batch_sink(max_records=10, writer=FailingWriter)
+    pipeline, fan_out = chained_pipeline(sink, completed)
+    for n in (1, 2):
+        pipeline.submit(grouped_record(f'a{n}', 'a', {'n': n}))
+    assert wait_for(lambda: fan_out.buffered_count(sink) == 2)
+
+    sink.aggregator.flush_all()
+    assert wait_for(lambda: len(completed) == 2)
+    assert completed == [('a1', False), ('a2', False)]
+    assert pipeline.active_groups() == 0
+    pipeline.shutdown()
+    fan_out.stop()
+
+
+def test_fan_out_fails_delivery_when_a_required_sink_fails():
+    """Test that a failing required sink fails the message, and an optional one does not"""
+    settled = []
+    fan_out = SinkFanOut([RecordingSink('s3'), RecordingSink('file', fail=True)],
+                         on_settled=settled.extend, concurrency=2)
+    assert fan_out.deliver(sqs_message('m1'), {}) is False
+
+    fan_out = SinkFanOut([RecordingSink('s3'), RecordingSink('index', required=False, fail=True)],
+                         on_settled=settled.extend, concurrency=2)
+    assert fan_out.deliver(sqs_message('m2'), {}) is True
+    assert wait_for(lambda: fan_out.snapshot()['index']['failed'] == 1)
+    assert settled == []
+    fan_out.stop()
+
+
+def test_aggregator_writes_full_batch_and_manifest():
+    """Test that a full batch is written as gzipped NDJSON followed by a manifest of its messages"""
+    objects = {}
+    flushed = []
+
+    def open_object(key, content_type, content_encoding, metadata):
+        assert (content_type, content_encoding) == ('application/x-ndjson', 'gzip')
+        objects[key] = MemoryWriter()
+        return objects[key]
+
+    aggregator = BatchAggregator(
+        open_object=open_object,
+        write_object=lambda key, body, *args: objects.__setitem__(key, body),
+        on_flushed=lambda messages, success: flushed.append(([m['MessageId'] for m in messages], success)),
+        key_prefix='test/',
+        max_records=2,
+        partition_for=lambda record: '2024/01/02/03'
+    )
+    first = aggregator.add(sqs_message('m1'), {'n': 1})
+    assert flushed == [] and aggregator.buffered_count() == 1
+    assert aggregator.add(sqs_message('m2'), {'n': 2}) == first
+    assert flushed == [(['m1', 'm2'], True)]
+
+    batch_key = f'test/batches/2024/01/02/03/{first}.ndjson.gz'
+    lines = gzip.decompress(objects[batch_key].data).splitlines()
+    assert [json.loads(line) for line in lines] == [{'n': 1}, {'n': 2}]
+    manifest = json.loads(objects[f'test/manifests/2024/01/02/03/{first}.json'])
+    assert manifest['object_key'] == batch_key
+    assert manifest['record_count'] == 2
+    assert manifest['message_ids'] == ['m1', 'm2']
+    assert aggregator.stats == {'batches_written': 1, 'batches_failed': 0, 'records_written': 2}
+
+    # The next record starts a new batch
+    assert aggregator.add(sqs_message('m3'), {'n': 3}) != first
+
+
+def test_aggregator_flushes_batches_reaching_max_age():
+    """Test that only batches whose oldest record reached max_age are flushed by age"""
+    flushed = []
+    aggregator = BatchAggregator(
+        open_object=lambda *args: MemoryWriter(),
+        write_object=MagicMock(),
+        on_flushed=lambda messages, success: flushed.append(([m['MessageId'] for m in messages], success)),
+        key_prefix='test/',
+        max_records=10,
+        max_age=60,
+        partition_for=lambda record: record['partition']
+    )
+    with patch('aggregator.time.time', return_value=1000):
+        aggregator.add(sqs_message('old'), {'partition': 'a'})
+    with patch('aggregator.time.time', return_value=1050):
+        aggregator.add(sqs_message('new'), {'partition': 'b'})
+
+    with patch('aggregator.time.time', return_value=1059):
+        aggregator.flush_expired()
+    assert flushed == []
+    with patch('aggregator.time.time', return_value=1060):
+        aggregator.flush_expired()
+    assert flushed == [(['old'], True)]
+    assert aggregator.buffered_count() == 1
+
+
+def test_aggregator_acks_messages_on_failed_flush():
+    """Test that the messages of a batch are acknowledged as failed when its upload fails"""
+    flushed = []
+    aggregator = BatchAggregator(
+        open_object=lambda *args: MemoryWriter(),
+        write_object=MagicMock(side_effect=IOError('manifest write failed')),
+        on_flushed=lambda messages, success: flushed.append(([m['MessageId'] for m in messages], success)),
+        key_prefix='test/',
+        max_records=10
+    )
+    aggregator.add(sqs_message('m1'), {'n': 1})
+    aggregator.add(sqs_message('m2'), {'n': 2})
+    assert aggregator.buffered_count() == 2
+
+    aggregator.flush_all()
+    assert flushed == [(['m1', 'm2'], False)]
+    assert aggregator.stats['batches_failed'] == 1
+    assert aggregator.buffered_count() == 0
+
+
+def test_aggregator_fails_batch_when_stream_breaks():
+    """Test that a write error fails the whole open batch and the next record starts a new one"""
+    writers = []
+    flushed = []
+
+    def open_object(*args):
+        writers.append(MemoryWriter(fail=not writers))
+        return writers[-1]
+
+    aggregator = BatchAggregator(
+        open_object=open_object,
+        write_object=MagicMock(),
+        on_flushed=lambda messages, success: flushed.append(([m['MessageId'] for m in messages], success)),
+        key_prefix='test/'
+    )
+    with pytest.raises(RuntimeError):
+        aggregator.add(sqs_message('m1'), {'n': 1})
+    assert writers[0].aborted
+    assert flushed == [([], False)]
+
+    aggregator.add(sqs_message('m2'), {'n': 2})
+    aggregator.flush_all()
+    assert flushed[-1] == (['m2'], True)
+    lines = gzip.decompress(writers[1].data).splitlines()
+    assert [json.loads(line) for line in lines] == [{'n': 2}]
+
+
+def test_aggregator_does_not_block_other_partitions_during_upload():
+    """Test that a slow write to one partition's batch does not hold up another partition"""
+    gate = threading.Event()
+
+    class SlowWriter(MemoryWriter):
+        def write(self, data):
+            gate.wait(5)
+            return super().write(data)
+
+    aggregator = BatchAggregator(
+        open_object=lambda key, *args: SlowWriter() if '/slow/' in key else MemoryWriter(),
+        write_object=MagicMock(),
+        on_flushed=lambda messages, success: None,
+        key_prefix='test/',
+        partition_for=lambda record: record['partition']
+    )
+    slow = threading.Thread(target=aggregator.add, args=(sqs_message('m1'), {'partition': 'slow'}))
+    slow.start()
+    time.sleep(0.1)
+
+    start = time.monotonic()
+    aggregator.add(sqs_message('m2'), {'partition': 'fast'})
+    assert aggregator.buffered_count() == 1
+    assert time.monotonic() - start < 1
+    gate.set()
+    slow.join()
+    aggregator.flush_all()
+
+
+def test_partition_by_event_date_prefers_email_timestamp():
+    """Test that records are partitioned by email_timestream, then SentTimestamp"""
+    sent = {'attributes': {'SentTimestamp': '1704240000000'}}  # 2024-01-03
+    assert partition_by_event_date({**sent, 'parsed_body': {'email_timestream': '1704067200'}}) == 'dt=2024-01-01'
+    assert partition_by_event_date({**sent, 'parsed_body': {'email_timestream': 'soon'}}) == 'dt=2024-01-03'
+    assert partition_by_event_date({**sent, 'parsed_body': 'not json'}) == 'dt=2024-01-03'
+
+
+def test_parquet_encoder_writes_typed_columns_in_row_groups():
+    """Test that the Parquet encoder writes email fields and SQS metadata as row groups"""
+    pq = pytest.importorskip('pyarrow.parquet')
+    buffer = io.BytesIO()
+    encoder = parquet_encoder(row_group_size=2, compression='snappy')(buffer)
+    for n in range(3):
+        encoder.write({
+            'message_id': f'm{n}',
+            'parsed_body': {'email_subject': 'Hi', 'email_sender': 'a@b.c',
+                            'email_timestream': 1704067200 + n, 'email_content': n},
+            'attributes': {'SentTimestamp': '1704067200000', 'ApproximateReceiveCount': '2'},
+            'received_at': '2024-01-01T00:00:05'
+        })
+    encoder.close()
+
+    parquet_file = pq.ParquetFile(io.BytesIO(buffer.getvalue()))
+    assert parquet_file.metadata.num_row_groups == 2
+    rows = parquet_file.read().to_pylist()
+    assert [row['message_id'] for row in rows] == ['m0', 'm1', 'm2']
+    assert rows[2]['email_content'] == '2'
+    assert rows[2]['email_timestream'].timestamp() == 1704067202
+    assert rows[0]['approximate_receive_count'] == 2
+
+
+def test_deleter_batches_deletes():
+    """Test that pending deletes are sent ten at a time and every message is reported"""
+    calls = []
+    deleted = []
+
+    def delete_batch(entries):
+        calls.append(len(entries))
+        return successful(entries)
+
+    deleter = BatchDeleter(delete_batch, lambda message, ok: deleted.append(ok), flush_interval=0.05)
+    for i in range(25):
+        deleter.delete(sqs_message(f'm{i}'))
+
+    assert wait_for(lambda: len(deleted) == 25)
+    assert all(deleted)
+    assert calls[:2] == [10, 10] and sum(calls) == 25
+
+
+def test_batch_call_does_not_retry_whole_call_failures():
+    """Test that only entries SQS reports as failed are retried; call errors are left to the resilience layer"""
+    call = MagicMock(side_effect=ConnectionError('SQS unavailable'))
+    results = run_batch_call(call, [{'Id': '0'}, {'Id': '1'}], backoff=0)
+    assert call.call_count == 1
+    assert results == {'0': 'SQS unavailable', '1': 'SQS unavailable'}
+
+    call = MagicMock(side_effect=[
+        {'Successful': [{'Id': '0'}], 'Failed': [{'Id': '1', 'Code': 'InternalError', 'SenderFault': False}]},
+        {'Successful': [{'Id': '1'}], 'Failed': []}
+    ])
+    assert run_batch_call(call, [{'Id': '0'}, {'Id': '1'}], backoff=0) == {'0': None, '1': None}
+    assert call.call_args_list[1][0][0] == [{'Id': '1'}]
+
+
+def test_heartbeat_extends_messages_about_to_expire():
+    """Test that only messages whose visibility runs out before the next beats are extended"""
+    registry = InFlightRegistry(max_in_flight=10)
+    registry.add(sqs_message('soon'), visibility_timeout=5)
+    registry.add(sqs_message('later'), visibility_timeout=300)
+    change_visibility = MagicMock(side_effect=successful)
+
+    heartbeat = VisibilityHeartbeat(registry, change_visibility, interval=10, extension=60)
+    heartbeat.beat()
+
+    entries = change_visibility.call_args[0][0]
+    assert [entry['ReceiptHandle'] for entry in entries] == ['handle-soon']
+    assert entries[0]['VisibilityTimeout'] == 60
+    assert heartbeat.extended == 1
+
+
+def test_multipart_writer_streams_parts_and_completes():
+    """Test that large objects are uploaded in parts and small ones with one PutObject"""
+    s3 = MagicMock()
+    s3.create_multipart_upload.return_value = {'UploadId': 'upload-1'}
+    s3.upload_part.side_effect = lambda **kwargs: {'ETag': f"etag-{kwargs['PartNumber']}"}
+    executor = ThreadPoolExecutor(max_workers=2)
+
+    writer = MultipartUploadWriter(s3, 'bucket', 'big', executor, part_size=MIN_PART_SIZE)
+    writer.write(b'x' * (MIN_PART_SIZE + 10))
+    writer.close()
+    parts = s3.complete_multipart_upload.call_args[1]['MultipartUpload']['Parts']
+    assert parts == [{'PartNumber': 1, 'ETag': 'etag-1'}, {'PartNumber': 2, 'ETag': 'etag-2'}]
+
+    writer = MultipartUploadWriter(s3, 'bucket', 'small', executor)
+    writer.write(b'small')
+    writer.close()
+    assert s3.put_object.call_args[1]['Body'] == b'small'
+    executor.shutdown()
+
+
+def test_multipart_writer_aborts_on_part_failure():
+    """Test that a failed part aborts the upload instead of completing it"""
+    s3 = MagicMock()
+    s3.create_multipart_upload.return_value = {'UploadId': 'upload-1'}
+    s3.upload_part.side_effect = IOError('part failed')
+    executor = ThreadPoolExecutor(max_workers=1)
+
+    writer = MultipartUploadWriter(s3, 'bucket', 'big', executor, part_size=MIN_PART_SIZE)
+    writer.write(b'x' * MIN_PART_SIZE)
+    with pytest.raises(IOError):
+        writer.close()
+    s3.abort_multipart_upload.assert_called_once()
+    s3.complete_multipart_upload.assert_not_called()
+    executor.shutdown()
+
+
+def test_multipart_writers_share_part_slots():
+    """Test that writers sharing part slots wait for each other, bounding buffered parts across objects"""
+    gate = threading.Event()
+    s3 = MagicMock()
+    s3.create_multipart_upload.return_value = {'UploadId': 'upload-1'}
+    s3.upload_part.side_effect = lambda **kwargs: gate.wait(5) and {'ETag': f"etag-{kwargs['PartNumber']}"}
+    executor = ThreadPoolExecutor(max_workers=2)
+    slots = threading.BoundedSemaphore(1)
+    first = MultipartUploadWriter(s3, 'bucket', 'first', executor, part_size=MIN_PART_SIZE, slots=slots)
+    second = MultipartUploadWriter(s3, 'bucket', 'second', executor, part_size=MIN_PART_SIZE, slots=slots)
+
+    first.write(b'x' * MIN_PART_SIZE)
+    blocked = threading.Thread(target=second.write, args=(b'y' * MIN_PART_SIZE,))
+    blocked.start()
+    blocked.join(0.2)
+    assert blocked.is_alive()
+    assert s3.upload_part.call_count == 1
+
+    gate.set()
+    blocked.join(5)
+    first.close()
+    second.close()
+    assert s3.complete_multipart_upload.call_count == 2
+    executor.shutdown()
+
+
+def test_seen_set_expires_and_persists(tmp_path):
+    """Test that keys expire after the TTL and survive a restart with a database"""
+    seen = SeenSet(max_entries=2, ttl=60, path=str(tmp_path / 'seen.db'))
+    seen.add_many(['a', 'b', 'c'])
+    assert len(seen) == 2
+    assert seen.contains('a')  # Evicted from memory, reloaded from SQLite
+    seen.close()
+
+    seen = SeenSet(ttl=60, path=str(tmp_path / 'seen.db'))
+    assert seen.contains('b') and not seen.contains('d')
+    seen.close()
+
+    seen = SeenSet(ttl=0.05)
+    seen.add('a')
+    time.sleep(0.1)
+    assert not seen.contains('a')
+
+
+def test_message_key_is_stable_across_redeliveries():
+    """Test that a redelivered message maps to the same S3 key, placed by the email's own hour"""
+    message = sqs_message('m1')
+    record = {'parsed_body': {'email_timestream': '1704164400'}, 'attributes': {}}  # 2024-01-02 03:00 UTC
+    key = processor.message_key(message, record)
+    assert key == f'{processor.S3_PREFIX}2024/01/02/03/m1.json'
+    redelivered = {**message, 'ReceiptHandle': 'handle-m1-again'}
+    assert processor.message_key(redelivered, dict(record, received_at='later')) == key
+
+
+def test_deliver_message_suppresses_duplicates():
+    """Test that an archived message is acknowledged again without being written twice"""
+    sink = RecordingSink('s3')
+    fan_out = SinkFanOut([sink], on_settled=lambda results: None, concurrency=1)
+    duplicates = REGISTRY.get_sample_value('sqs_processor_duplicates_suppressed_total')
+    with patch('processor.sink_fan_out', fan_out), \
+         patch('processor.seen_messages', SeenSet()):
+        message = sqs_message('m1')
+        assert processor.deliver_message(message) is True
+        assert processor.seen_messages.contains('m1')
+        assert processor.deliver_message(dict(message, ReceiptHandle='handle-m1-again')) is True
+
+    assert sink.written == ['m1']
+    assert REGISTRY.get_sample_value('sqs_processor_duplicates_suppressed_total') == duplicates + 1
+
+
+def test_queue_depth_sampler_exports_backlog():
+    """Test that queue attributes are exported as gauges and a failed sample keeps the last values"""
+    attributes = {
+        'ApproximateNumberOfMessages': '120',
+        'ApproximateNumberOfMessagesNotVisible': '7',
+        'ApproximateAgeOfOldestMessage': '42'
+    }
+    get_queue_attributes = MagicMock(side_effect=[attributes, ClientError({'Error': {}}, 'GetQueueAttributes')])
+    sampler = QueueDepthSampler(get_queue_attributes)
+
+    sampler.sample()
+    sampler.sample()
+    assert REGISTRY.get_sample_value('sqs_processor_queue_messages') == 120
+    assert REGISTRY.get_sample_value('sqs_processor_queue_messages_not_visible') == 7
+    assert REGISTRY.get_sample_value('sqs_processor_queue_oldest_message_age_seconds') == 42
+
+
+def test_health_server_serves_metrics():
+    """Test that the status server exposes the Prometheus metrics"""
+    server = start_health_server(StatusBoard(), port=0)
+    try:
+        with urllib.request.urlopen(f'http://127.0.0.1:{server.server_port}/metrics', timeout=5) as response:
+            body = response.read().decode()
+    finally:
+        server.shutdown()
+    assert 'sqs_processor_queue_messages ' in body
+    assert 'sqs_processor_messages_received_total ' in body
+
+
+def test_status_board_readiness_and_liveness():
+    """Test that readiness follows polls and backpressure, and liveness follows loop progress"""
+    board = StatusBoard(max_poll_age=120, max_backpressure=60, max_stall=300)
+    ready, details = board.readiness()
+    assert not ready and details['reasons'] == ['status is starting']
+
+    with patch('health.time.time', return_value=1000):
+        board.poll_succeeded()
+    assert board.readiness(now=1100)[0]
+    assert board.readiness(now=1121)[1]['reasons'] == ['no successful poll for 121s']
+
+    with patch('health.time.time', return_value=1000):
+        board.saturated()
+    with patch('health.time.time', return_value=1030):
+        board.saturated()
+    assert board.snapshot()['saturated_since'] == 1000
+    assert board.readiness(now=1061)[1]['reasons'] == ['pipeline full for 61s']
+    assert board.liveness(now=1330)[0]
+    assert not board.liveness(now=1331)[0]
+
+    with patch('health.time.time', return_value=1100):
+        board.poll_failed()
+    assert board.readiness(now=1100)[1]['reasons'] == ['status is unhealthy', 'pipeline full for 100s']
+
+
+def test_status_board_keeps_shutdown_state():
+    """Test that a late poll result does not make a draining pod ready or not live"""
+    board = StatusBoard(max_stall=1)
+    board.set_status('draining')
+    board.poll_succeeded()
+    assert board.snapshot()['status'] == 'draining'
+    assert not board.readiness()[0]
+    assert board.liveness(now=time.time() + 60)[0]
+
+
+def test_health_server_probes():
+    """Test the status codes of /livez, /readyz and /health"""
+    board = StatusBoard()
+    server = start_health_server(board, port=0, extra_details=lambda: {'in_flight': 3})
+    url = f'http://127.0.0.1:{server.server_port}'
+
+    def get(path):
+        try:
+            with urllib.request.urlopen(url + path, timeout=5) as response:
+                return response.status, json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            return e.code, json.loads(e.read())
+
+    try:
+        assert get('/livez')[0] == 200
+        status, details = get('/readyz')
+        assert status == 503 and details['in_flight'] == 3
+        board.poll_succeeded()
+        board.messages_processed(2)
+        assert get('/readyz')[0] == 200
+        assert get('/health') == (200, {'status': 'healthy', 'last_poll': board.legacy_health()['last_poll'],
+                                        'messages_processed': 2})
+    finally:
+        server.shutdown()
+
+
+@pytest.fixture
+def draining_processor():
+    """Processor globals with a fresh pipeline and mocked SQS, restored after the test"""
+    gate = threading.Event()
+    pipeline = UploadPipeline(lambda message: gate.wait(5), processor.complete_message, concurrency=1)
+    registry = InFlightRegistry(max_in_flight=10)
+    with patch('processor.sqs_client') as mock_sqs, \
+         patch('processor.upload_pipeline', pipeline), \
+         patch('processor.in_flight', registry), \
+         patch('processor.DRAIN_DEADLINE', 0.5), \
+         patch('processor.seen_messages', SeenSet()):
+        mock_sqs.change_message_visibility_batch.side_effect = lambda QueueUrl, Entries: successful(Entries)
+        yield mock_sqs, pipeline, registry
+    gate.set()
+    processor.shutdown_event.clear()
+
+
+def test_drain_releases_cancelled_messages(draining_processor):
+    """Test that messages still queued or running at the drain deadline are released at once"""
+    mock_sqs, pipeline, registry = draining_processor
+    for message_id in ('m1', 'm2', 'm3'):
+        message = sqs_message(message_id)
+        registry.add(message, visibility_timeout=30)
+        pipeline.submit(message)
+
+    processor.drain()
+
+    released = [entry for call in mock_sqs.change_message_visibility_batch.call_args_list
+                for entry in call[1]['Entries']]
+    assert sorted(entry['ReceiptHandle'] for entry in released) == ['handle-m1', 'handle-m2', 'handle-m3']
+    assert all(entry['VisibilityTimeout'] == 0 for entry in released)
+    assert len(registry) == 0
+    assert processor.status_board.snapshot()['status'] == 'stopped'
+
+
+def test_drain_bounds_the_final_batch_flush(draining_processor):
+    """Test that drain stops waiting for a slow batch write at the deadline and releases its messages"""
+    mock_sqs, pipeline, registry = draining_processor
+    gate = threading.Event()
+
+    class StuckWriter(MemoryWriter):
+        def close(self):
+            gate.wait(5)
+
+    sink, objects = batch_sink(max_records=10, writer=StuckWriter)
+    fan_out = SinkFanOut([sink], on_settled=lambda results: None, concurrency=1)
+    message = sqs_message('m1')
+    registry.add(message, visibility_timeout=30)
+    assert fan_out.deliver(message, {'n': 1}) is None
+
+    start = time.monotonic()
+    with patch('processor.sink_fan_out', fan_out):
+        processor.drain()
+    gate.set()
+    assert time.monotonic() - start < 2
+    released = [entry['ReceiptHandle'] for call in mock_sqs.change_message_visibility_batch.call_args_list
+                for entry in call[1]['Entries']]
+    assert released == ['handle-m1']
@@ -200,6 +200,7 @@ kubectl apply -f k8s/namespace.yaml
 kubectl apply -f k8s/configmap.yaml
 kubectl apply -f k8s/serviceaccount.yaml
 kubectl apply -f k8s/deployment.yaml
+kubectl apply -f k8s/hpa.yaml
 
 echo -e "${GREEN}✓ Deployed to Kubernetes${NC}"
 echo ""